@@ -8,45 +8,105 @@ veliebm@gmail.com
 # Import external libraries and modules.
 from os import PathLike
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 import yaml
-import subprocess
 
 # Import CSEA libraries and modules.
+from async_runner import ToolJob
+from nifti_header import HeaderCache
+from resources import allotted_cores
+from stage_cache import StageCache
+from tool_runner import ToolRunner
 from vmrk import Vmrk
 
-def main(vmrk_path: PathLike, func_path: PathLike, anat_path: PathLike, out_dir: PathLike, subject_id: str, remove_first_trs: int):
+# Lines afni_proc.py's script echoes as it reaches each block, in order. async_runner.py reports them as progress.
+AFNI_PROC_PROGRESS = [
+    (r"^3dTcat ", "tcat"),
+    (r"^3dTshift ", "tshift"),
+    (r"^align_epi_anat\.py ", "align"),
+    (r"^(@auto_tlrc|auto_warp\.py) ", "tlrc"),
+    (r"^3dvolreg ", "volreg"),
+    (r"^3dmerge ", "blur"),
+    (r"^3dAutomask ", "mask"),
+    (r"\.scale\b", "scale"),
+    (r"^3dDeconvolve ", "regress"),
+    (r"^3dREMLfit ", "REML"),
+]
+
+def main(vmrk_path: PathLike, func_path: PathLike, anat_path: PathLike, out_dir: PathLike, subject_id: str, remove_first_trs: int, repetition_time: Optional[float]=None, blur_size: float=4.0, basis: str="CSPLINzero(0,18,10)"):
     """
     Preprocess a contrascan subject using afni_proc.py.
+
+    The repetition time is read from the header of the functional image unless it's given.
+    """
+    out_directory, path_to_onsets = _write_onsets(vmrk_path, func_path, out_dir, remove_first_trs, repetition_time)
+
+    # Run afni_proc.py. Need path to func dataset, subject ID, path to anat dataset, path to onsets in text file, and number of TRs to remove from beginning of scan.
+    run_afni_proc(subject_id, Path(anat_path).resolve(), Path(func_path).resolve(), path_to_onsets, out_directory, remove_first_trs, blur_size, basis)
+
+    return {
+        "out_dir": str(out_directory),
+    }
+
+def job(vmrk_path: PathLike, func_path: PathLike, anat_path: PathLike, out_dir: PathLike, subject_id: str, remove_first_trs: int, repetition_time: Optional[float]=None, blur_size: float=4.0, basis: str="CSPLINzero(0,18,10)", cores: int=4) -> ToolJob:
+    """
+    Like main(), but returns the afni_proc.py run as a job for async_runner.py instead of running it.
+    """
+    out_directory, path_to_onsets = _write_onsets(vmrk_path, func_path, out_dir, remove_first_trs, repetition_time)
+    path_to_func = Path(func_path).resolve()
+    path_to_anat = Path(anat_path).resolve()
+
+    return ToolJob(
+        command=afni_proc_command(subject_id, path_to_anat, path_to_func, path_to_onsets, remove_first_trs, blur_size, basis, cores),
+        cwd=out_directory,
+        runner=ToolRunner(out_directory / "profile.jsonl", subject_id),
+        stage="afni_proc",
+        inputs=[path_to_anat, path_to_func, path_to_onsets],
+        outputs=_outputs(subject_id),
+        cores=cores,
+        progress=AFNI_PROC_PROGRESS,
+    )
+
+def _write_onsets(vmrk_path: PathLike, func_path: PathLike, out_dir: PathLike, remove_first_trs: int, repetition_time: Optional[float]=None) -> List[Path]:
     """
-    # Get Path objects we'll need.
+    Creates out_dir and writes the onsets of a subject to onsets.tsv inside it. Returns both paths.
+
+    Reads the repetition time from the header of func_path if it isn't given.
+    """
+    if repetition_time is None:
+        repetition_time = HeaderCache().repetition_time(func_path)
+
     out_directory = Path(out_dir).resolve()
     if not out_directory.exists():
         out_directory.mkdir(parents=True)
-    path_to_vmrk = Path(vmrk_path).resolve()
-    path_to_func = Path(func_path).resolve()
-    path_to_anat = Path(anat_path).resolve()
 
-    # Get onset times and write them to their own text file. For each TR we remove, we should subtract 2s from all onsets.
+    # Get onset times and write them to their own text file. For each TR we remove, we should subtract one TR from all onsets.
     path_to_onsets = out_directory / "onsets.tsv"
-    vmrk_file = Vmrk(path_to_vmrk)
-    onset_adjustment = -remove_first_trs*2
+    vmrk_file = Vmrk(Path(vmrk_path).resolve())
+    onset_adjustment = -remove_first_trs*repetition_time
     vmrk_file.write_onsets_to(path_to_onsets, add_to_onsets=onset_adjustment)
 
-    # Run afni_proc.py. Need path to func dataset, subject ID, path to anat dataset, path to onsets in text file, and number of TRs to remove from beginning of scan.
-    run_afni_proc(subject_id, path_to_anat, path_to_func, path_to_onsets, out_directory, remove_first_trs)
-
-    return {
-        "out_dir": str(out_directory),
-    }
+    return [out_directory, path_to_onsets]
 
-def run_afni_proc(subject_id: str, path_to_anat: PathLike, path_to_func: PathLike, path_to_onsets: PathLike, out_directory: PathLike, remove_first_trs: int) -> None:
+def run_afni_proc(subject_id: str, path_to_anat: PathLike, path_to_func: PathLike, path_to_onsets: PathLike, out_directory: PathLike, remove_first_trs: int, blur_size: float=4.0, basis: str="CSPLINzero(0,18,10)", jobs: Optional[int]=None) -> None:
     """
     Runs afni_proc.py for the specified subject. It'll preprocess and deconvolve everything for you.
 
+    Restores the results of an earlier run instead if the arguments, inputs and AFNI version are all the same. Either way
+    the run is profiled in out_directory/profile.jsonl and its output logged to out_directory/logs/afni_proc.log.
+    3dDeconvolve gets -jobs set to the cores allotted to this task unless jobs is given.
+
     afni_proc.py help: https://afni.nimh.nih.gov/pub/dist/doc/htmldoc/programs/afni_proc.py_sphx.html#ahelp-afni-proc-py
     """
-    arguments = f"""
+    arguments = afni_proc_command(subject_id, path_to_anat, path_to_func, path_to_onsets, remove_first_trs, blur_size, basis, jobs)
+    runner = ToolRunner(Path(out_directory) / "profile.jsonl", subject_id)
+    StageCache().run(arguments, out_directory, inputs=[path_to_anat, path_to_func, path_to_onsets], outputs=_outputs(subject_id), runner=runner, stage="afni_proc")
+
+def afni_proc_command(subject_id: str, path_to_anat: PathLike, path_to_func: PathLike, path_to_onsets: PathLike, remove_first_trs: int, blur_size: float=4.0, basis: str="CSPLINzero(0,18,10)", jobs: Optional[int]=None) -> List[str]:
+    """
+    Returns the arguments of our afni_proc.py call for a subject.
+    """
+    return f"""
         afni_proc.py
         -regress_stim_times {path_to_onsets}
         -dsets {path_to_func}
@@ -63,11 +123,11 @@ def run_afni_proc(subject_id: str, path_to_anat: PathLike, path_to_func: PathLik
         -volreg_align_to MIN_OUTLIER
         -volreg_align_e2a
         -volreg_tlrc_warp
-        -blur_size 4.0
+        -blur_size {blur_size}
         -regress_stim_labels stim
-        -regress_basis CSPLINzero(0,18,10)
+        -regress_basis {basis}
         -regress_opts_3dD
-        -jobs 4
+        -jobs {jobs or allotted_cores()}
         -regress_motion_per_run
         -regress_censor_motion 0.3
         -regress_censor_outliers 0.05
@@ -80,4 +140,8 @@ def run_afni_proc(subject_id: str, path_to_anat: PathLike, path_to_func: PathLik
         -execute
     """.split()
 
-    subprocess.run(arguments, cwd=out_directory)
+def _outputs(subject_id: str) -> List[str]:
+    """
+    Returns glob patterns matching everything afni_proc.py writes for a subject.
+    """
+    return [f"proc.{subject_id}", f"output.proc.{subject_id}", f"{subject_id}.results"]
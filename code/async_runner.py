@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Drive long-running tools like afni_proc.py for many subjects at once from a single asyncio controller.
+
+Every tool runs in its own process group. Its stdout and stderr are streamed line by line into a rotating log per
+subject and stage, while progress markers in the output are reported to the console. A tool that runs past its stage's
+timeout, or stops printing for too long, gets killed. Failures that look transient, like a stall or the OOM killer,
+are retried with exponential backoff after clearing the partial outputs. Results are cached and profiled just like
+runs through StageCache and ToolRunner.
+
+The controller waits on processes by polling, so no threads sit blocked on them. Slow file work, like hashing inputs
+for the stage cache or deleting partial outputs, runs in threads so it doesn't hold up the event loop.
+"""
+# Import external libraries and modules.
+from dataclasses import dataclass, field
+from logging.handlers import RotatingFileHandler
+from os import PathLike
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+import argparse
+import asyncio
+import logging
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import time
+
+# Import CSEA libraries and modules.
+from resources import THREAD_VARIABLES, node_capacity
+from stage_cache import StageCache
+from tool_runner import BLOCK_SIZE, ERROR_TAIL_LINES, ToolRunner
+
+# Seconds a stage may run in total, and may go without printing anything, before it gets killed.
+STAGE_TIMEOUTS = {
+    "afni_proc": (12 * 3600, 3600),
+    "deconvolve": (4 * 3600, 3600),
+    "merge": (3600, 1800),
+    "tstat": (1800, 1800),
+    "calc": (1800, 1800),
+}
+DEFAULT_TIMEOUTS = (4 * 3600, 3600)
+
+# Output that means a failure is worth retrying: flaky network mounts and memory pressure.
+TRANSIENT_PATTERNS = re.compile(r"Stale file handle|Resource temporarily unavailable|Cannot allocate memory|Input/output error|Connection timed out")
+
+# Seconds to wait before the first retry. Each retry after that waits twice as long.
+BACKOFF_SECONDS = 60
+
+# Seconds a killed tool gets to exit after SIGTERM before it gets SIGKILL.
+KILL_GRACE_SECONDS = 30
+
+# Seconds between checks on whether a tool has exited.
+POLL_SECONDS = 0.5
+
+# Size each log may grow to before it's rotated, and how many rotated logs to keep.
+LOG_BYTES = 16 << 20
+LOG_BACKUPS = 3
+
+@dataclass
+class ToolJob():
+    """
+    Class describing one run of an external tool for async_runner to drive.
+
+    Parameters
+    ----------
+    command : list of str
+        The command to run. Its first item is the tool.
+    cwd : str or Path
+        Directory to run the command in.
+    runner : ToolRunner
+        Where to profile the run and log its output.
+    stage : str, optional
+        Name of the stage. Defaults to the name of the tool. Picks the timeouts in STAGE_TIMEOUTS.
+    inputs : list of str or Path
+        Files the command reads. Part of its key in the stage cache.
+    outputs : list of str
+        Glob patterns relative to cwd matching what the command writes. Cleared before a retry.
+    cores : int
+        Threads the tool may use.
+    timeout : float, optional
+        Seconds the tool may run in total.
+    idle_timeout : float, optional
+        Seconds the tool may go without printing anything.
+    retries : int
+        How many times to retry a transient failure.
+    progress : list of (str, str)
+        Regular expressions matching lines that mark progress, each with a label to report. In the order they occur.
+    """
+    command: List[str]
+    cwd: PathLike
+    runner: ToolRunner
+    stage: Optional[str] = None
+    inputs: List[PathLike] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    cores: int = 1
+    timeout: Optional[float] = None
+    idle_timeout: Optional[float] = None
+    retries: int = 2
+    progress: List[Tuple[str, str]] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.command = [str(argument) for argument in self.command]
+        self.cwd = Path(self.cwd).resolve()
+        self.stage = self.stage or Path(self.command[0]).name
+        timeout, idle_timeout = STAGE_TIMEOUTS.get(self.stage, DEFAULT_TIMEOUTS)
+        self.timeout = self.timeout or timeout
+        self.idle_timeout = self.idle_timeout or idle_timeout
+
+    @property
+    def name(self) -> str:
+        return f"{self.stage} {self.runner.subject_id}" if self.runner.subject_id else self.stage
+
+def run_all(jobs: List[ToolJob], max_concurrent: Optional[int]=None) -> List[Union[Dict[str, Any], BaseException]]:
+    """
+    Runs jobs, at most max_concurrent at a time, and returns the profile of each or the error it failed with.
+
+    max_concurrent defaults to as many jobs as fit in the cores of the node.
+    """
+    return asyncio.run(run_jobs(jobs, max_concurrent))
+
+async def run_jobs(jobs: List[ToolJob], max_concurrent: Optional[int]=None) -> List[Union[Dict[str, Any], BaseException]]:
+    """
+    Coroutine version of run_all().
+    """
+    if not jobs:
+        return []
+    semaphore = asyncio.Semaphore(max_concurrent or max(1, node_capacity()["cores"] // max(job.cores for job in jobs)))
+    cache = StageCache()
+
+    async def run_when_allowed(job: ToolJob) -> Dict[str, Any]:
+        async with semaphore:
+            return await run_job(job, cache)
+
+    return await asyncio.gather(*(run_when_allowed(job) for job in jobs), return_exceptions=True)
+
+async def run_job(job: ToolJob, cache: Optional[StageCache]=None) -> Dict[str, Any]:
+    """
+    Runs a job, retrying transient failures with exponential backoff, and returns the profile of its last attempt.
+
+    Restores the job's outputs from the stage cache instead if an identical run is cached. The cache hashes, copies
+    and deletes whole directories, so it runs in a thread to keep the other jobs' logs and timeouts going meanwhile.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the job fails for good. The error's output holds the end of its log.
+    """
+    cache = cache or StageCache()
+    started = time.time()
+    key = await asyncio.to_thread(cache.key, job.command, job.inputs)
+    if await asyncio.to_thread(cache.restore, key, job.cwd):
+        print(f"{job.name}: restored from the stage cache")
+        return job.runner.record(job.stage, Command=job.command, Start=started, WallSeconds=time.time() - started, ExitCode=0, Cached=True)
+
+    await asyncio.to_thread(cache.release, job.cwd, job.outputs)
+    for attempt in range(job.retries + 1):
+        if attempt:
+            delay = BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(1, 1.25)
+            print(f"{job.name}: retrying in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            await asyncio.to_thread(_clear_outputs, job)
+
+        profile = await _attempt(job, attempt)
+        if profile["ExitCode"] == 0:
+            await asyncio.to_thread(cache.store, key, job.cwd, job.outputs)
+            await asyncio.to_thread(cache.evict)
+            return profile
+        if not profile["Transient"]:
+            break
+
+    with open(job.runner.log_path(job.stage), errors="replace") as log_file:
+        tail = "".join(log_file.readlines()[-ERROR_TAIL_LINES:])
+    raise subprocess.CalledProcessError(profile["ExitCode"], job.command, output=tail)
+
+async def _attempt(job: ToolJob, attempt: int) -> Dict[str, Any]:
+    """
+    Runs a job once, streaming its output into its log, and returns its profile.
+    """
+    logger = _logger(job)
+    logger.info(f"$ {' '.join(job.command)}", extra={"stream": "runner"})
+    environment = {**os.environ, **{name: str(job.cores) for name in THREAD_VARIABLES}}
+
+    state = {"last_output": time.perf_counter(), "progress": None, "transient": False}
+    started = time.time()
+    start_wall = time.perf_counter()
+    process = subprocess.Popen(job.command, cwd=job.cwd, env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    pumps = [asyncio.create_task(_pump(pipe, name, job, logger, state)) for pipe, name in ((process.stdout, "stdout"), (process.stderr, "stderr"))]
+    waiter = asyncio.create_task(_wait(process.pid))
+
+    killed_because = None
+    try:
+        while not waiter.done():
+            await asyncio.wait({waiter}, timeout=5)
+            elapsed = time.perf_counter() - start_wall
+            if not waiter.done() and elapsed > job.timeout:
+                killed_because = f"ran past its timeout of {job.timeout:g} s"
+            elif not waiter.done() and time.perf_counter() - state["last_output"] > job.idle_timeout:
+                killed_because = f"printed nothing for {job.idle_timeout:g} s"
+            if killed_because:
+                print(f"{job.name}: {killed_because}, killing it")
+                logger.error(f"Killed: {killed_because}", extra={"stream": "runner"})
+                await _kill(process.pid, waiter)
+                break
+        status, usage = await waiter
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        # Whatever the tool left running in its group could still hold the pipes open.
+        _signal_group(process.pid, signal.SIGKILL)
+        await asyncio.wait(pumps, timeout=KILL_GRACE_SECONDS)
+    finally:
+        if not waiter.done():
+            _signal_group(process.pid, signal.SIGKILL)
+            waiter.cancel()
+            os.waitpid(process.pid, 0)
+            process.returncode = -signal.SIGKILL
+        for pump in pumps:
+            pump.cancel()
+        for handler in logger.handlers:
+            handler.close()
+        logger.handlers.clear()
+
+    # A stall is often a hung network mount, and a signal we didn't send is usually the OOM killer. A tool that merely
+    # ran past its timeout would only run long again.
+    stalled = (killed_because or "").startswith("printed nothing")
+    transient = process.returncode != 0 and (state["transient"] or stalled or (process.returncode < 0 and killed_because is None))
+    return job.runner.record(
+        job.stage,
+        Command=job.command,
+        Start=started,
+        WallSeconds=time.perf_counter() - start_wall,
+        UserSeconds=usage.ru_utime,
+        SystemSeconds=usage.ru_stime,
+        MaxRSSMB=usage.ru_maxrss / 1024,
+        BytesRead=usage.ru_inblock * BLOCK_SIZE,
+        BytesWritten=usage.ru_oublock * BLOCK_SIZE,
+        ExitCode=process.returncode,
+        Cached=False,
+        Log=str(job.runner.log_path(job.stage)),
+        Attempt=attempt,
+        Killed=killed_because,
+        Progress=state["progress"],
+        Transient=transient,
+    )
+
+async def _pump(pipe, name: str, job: ToolJob, logger: logging.Logger, state: Dict[str, Any]) -> None:
+    """
+    Copies the lines of one of a tool's output streams into its log, watching for progress markers and transient errors.
+    """
+    reader = asyncio.StreamReader(limit=1 << 20)
+    await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    labels = [label for _, label in job.progress]
+    async for raw_line in reader:
+        line = raw_line.decode(errors="replace").rstrip()
+        state["last_output"] = time.perf_counter()
+        logger.info(line, extra={"stream": name})
+        if TRANSIENT_PATTERNS.search(line):
+            state["transient"] = True
+        for pattern, label in job.progress:
+            reached = labels.index(label)
+            if re.search(pattern, line) and (state["progress"] is None or reached > labels.index(state["progress"])):
+                state["progress"] = label
+                print(f"{job.name}: {label} ({reached + 1}/{len(labels)})")
+
+async def _wait(pid: int) -> Tuple[int, Any]:
+    """
+    Waits for a process to exit and returns its wait status and resource usage.
+    """
+    while True:
+        reaped_pid, status, usage = os.wait4(pid, os.WNOHANG)
+        if reaped_pid:
+            return status, usage
+        await asyncio.sleep(POLL_SECONDS)
+
+async def _kill(pid: int, waiter: asyncio.Task) -> None:
+    """
+    Asks the process group of a tool to stop, then kills it if it hasn't exited within KILL_GRACE_SECONDS.
+    """
+    _signal_group(pid, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(asyncio.shield(waiter), KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        _signal_group(pid, signal.SIGKILL)
+
+def _signal_group(pid: int, signal_number: int) -> None:
+    try:
+        os.killpg(pid, signal_number)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def _logger(job: ToolJob) -> logging.Logger:
+    """
+    Returns a logger writing to the rotating log of a job.
+    """
+    log_path = job.runner.log_path(job.stage)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    handler = RotatingFileHandler(log_path, maxBytes=LOG_BYTES, backupCount=LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(stream)s %(message)s"))
+
+    logger = logging.getLogger(f"{__name__}.{job.name}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.handlers = [handler]
+    return logger
+
+def _clear_outputs(job: ToolJob) -> None:
+    """
+    Deletes whatever a failed attempt left behind, since afni_proc.py and friends refuse to overwrite it.
+    """
+    for pattern in job.outputs:
+        for path in job.cwd.glob(pattern):
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run afni_proc.py for many subjects at once with streaming logs, timeouts and retries.")
+    parser.add_argument("subject_ids", nargs="+", help="Subjects to run.")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="Subjects to run at once. Defaults to as many as fit in the cores of the node.")
+    parser.add_argument("--cores", type=int, default=4, help="Cores each subject may use.")
+    parser.add_argument("--tr", type=float, default=None, help="Repetition time in seconds. Read from each functional image by default.")
+    args = parser.parse_args()
+
+    import afniproc
+
+    jobs = []
+    for id in args.subject_ids:
+        in_dir = Path(f"../outputs/bids/sub-{id}").resolve()
+        jobs.append(afniproc.job(
+            vmrk_path=in_dir / f"eeg/sub-{id}_task-contrascan_eeg.vmrk",
+            func_path=in_dir / f"func/sub-{id}_task-contrascan_bold.nii",
+            anat_path=in_dir / f"anat/sub-{id}_T1w.nii",
+            out_dir=Path(f"../outputs/afniproc/sub-{id}").resolve(),
+            subject_id=id,
+            remove_first_trs=1,
+            repetition_time=args.tr,
+            cores=args.cores,
+        ))
+
+    failures = 0
+    for job, result in zip(jobs, run_all(jobs, args.max_concurrent)):
+        if isinstance(result, BaseException):
+            failures += 1
+            print(f"{job.name} failed: {result}")
+        else:
+            print(f"{job.name} finished in {result['WallSeconds']:.0f} s")
+    raise SystemExit(1 if failures else 0)
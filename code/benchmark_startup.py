@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Make sure doit starts up quickly.
+
+Times "doit list" a few times and checks that loading dodo.py doesn't import any heavy library. Exits with status 1 if
+the median startup goes over budget or a heavy library sneaks back into dodo.py's imports.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+from typing import List
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+CODE_DIR = Path(__file__).resolve().parent
+
+# Libraries that only the actions of our tasks should need.
+HEAVY_MODULES = ["numpy", "pandas", "nibabel", "yaml", "scipy"]
+
+def main(budget: float=0.5, repeats: int=5) -> bool:
+    """
+    Returns true if doit list stays within budget seconds and dodo.py imports no heavy library.
+    """
+    timings = time_doit_list(repeats)
+    median = statistics.median(timings)
+    heavy = heavy_imports()
+
+    print(f"doit list: median {median:.3f}s over {repeats} runs (budget {budget:.3f}s)")
+    if heavy:
+        print(f"dodo.py imports heavy libraries at load time: {heavy}")
+
+    return median <= budget and not heavy
+
+def time_doit_list(repeats: int) -> List[float]:
+    """
+    Returns the wall time in seconds of each of several runs of doit list.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "doit", "list"], cwd=CODE_DIR, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+def heavy_imports() -> List[str]:
+    """
+    Returns the heavy libraries that importing dodo.py drags in.
+    """
+    check = f"import sys, dodo; print(' '.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", check], cwd=CODE_DIR, capture_output=True, text=True, check=True)
+
+    return result.stdout.split()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make sure doit starts up quickly.")
+    parser.add_argument("--budget", type=float, default=0.5, help="Maximum median startup time in seconds.")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of times to run doit list.")
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args.budget, args.repeats) else 1)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Compare how long a no-op doit run takes with doit's md5 checker and with uptodate.SampledChecker.
+
+Builds a throwaway pipeline with one task that depends on a few large files, runs it once, then touches the files
+the way copying them around would. Every following run has nothing to do, so its runtime is pure up-to-date checking.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+from typing import Dict, List
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CODE_DIR = Path(__file__).resolve().parent
+
+DODO_TEMPLATE = """
+import sys
+sys.path.insert(0, {code_dir!r})
+from uptodate import SampledChecker
+
+DOIT_CONFIG = {{"check_file_uptodate": {checker}, "dep_file": {dep_file!r}, "verbosity": 0}}
+
+def task_consume():
+    return {{
+        "actions": ["touch consumed"],
+        "file_dep": {file_deps!r},
+        "targets": ["consumed"],
+    }}
+"""
+
+def main(file_count: int=4, file_megabytes: int=256, repeats: int=3) -> Dict[str, List[float]]:
+    """
+    Returns the runtime in seconds of each no-op run for each checker.
+    """
+    timings = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        file_deps = [str(work_dir / f"volume_{i}.nii") for i in range(file_count)]
+        for path in file_deps:
+            with open(path, "wb") as out_file:
+                for _ in range(file_megabytes):
+                    out_file.write(os.urandom(1 << 20))
+
+        for name, checker in (("md5", '"md5"'), ("sampled", "SampledChecker")):
+            dodo_path = work_dir / f"dodo_{name}.py"
+            dodo_path.write_text(DODO_TEMPLATE.format(code_dir=str(CODE_DIR), checker=checker, dep_file=f".doit_{name}.db", file_deps=file_deps))
+            _doit(dodo_path)
+
+            # Copying files around gives them a new mtime but the same contents.
+            for path in file_deps:
+                os.utime(path)
+
+            timings[name] = [_doit(dodo_path) for _ in range(repeats)]
+            print(f"{name}: median no-op run {statistics.median(timings[name]):.3f}s over {repeats} runs of {file_count} x {file_megabytes} MB")
+
+    return timings
+
+def _doit(dodo_path: Path) -> float:
+    """
+    Runs doit on a dodo file and returns how long it took.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "doit", "-f", str(dodo_path)], cwd=dodo_path.parent, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare no-op doit runtime with the md5 checker and with SampledChecker.")
+    parser.add_argument("--files", type=int, default=4, help="Number of dependency files.")
+    parser.add_argument("--megabytes", type=int, default=256, help="Size of each dependency file in MB.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of no-op runs to time.")
+    args = parser.parse_args()
+
+    main(args.files, args.megabytes, args.repeats)
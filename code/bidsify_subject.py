@@ -7,43 +7,34 @@ veliebm@gmail.com
 """
 # Import external libraries and modules.
 from os import PathLike
-from shutil import copy
-from typing import Dict, List
+from typing import Dict, List, Optional
 from pathlib import Path
 import json
-import pandas
-import nibabel
 
 # Import custom libraries and modules.
 from vmrk import Vmrk
 from dat import Dat
+from events import Events
+import materialize
+from nifti_header import HeaderCache
 
-def main(record: Dict) -> Dict:
+def main(record: Dict, mode: str="reflink", repetition_time: Optional[float]=None) -> Dict:
     """
     Converts a single subject into BIDS format.
+
+    Raw files are materialized in parallel. By default they're reflinked, so the BIDS dataset shares the blocks of the
+    raw files where the filesystem allows it and is a full copy elsewhere. Either way, editing a BIDS file never touches
+    the raw data. See materialize.MODES for the other options. The repetition time in seconds is read from the
+    functional image unless given.
     """
-    copy_path(record["sources"]["eeg"], record["targets"]["eeg"])
-    copy_path(record["sources"]["vmrk"], record["targets"]["vmrk"])
-    copy_path(record["sources"]["vhdr"], record["targets"]["vhdr"])
-    copy_path(record["sources"]["func"], record["targets"]["func"])
-    copy_path(record["sources"]["anat"], record["targets"]["anat"])
-    copy_path(record["sources"]["dat"], record["targets"]["dat"])
+    keys = ("eeg", "vmrk", "vhdr", "func", "anat", "dat")
+    materialize.main([(record["sources"][key], record["targets"][key]) for key in keys], mode=mode)
 
     write_func_tsv(record["targets"]["vmrk"], record["targets"]["dat"], record["targets"]["func"])
-    write_func_json(record["targets"]["func"])
+    write_func_json(record["targets"]["func"], repetition_time)
 
     return record["targets"]
 
-def copy_path(source: PathLike, destination: PathLike) -> None:
-    """
-    Copy a path to its new home.
-    """
-    destination = Path(destination).resolve()
-    if not destination.exists():
-        destination.parent.mkdir(parents=True, exist_ok=True)
-        copy(source, destination)
-        print(f"Copied {source}  ->  {destination}")
-
 def write_func_tsv(path_to_vmrk: PathLike, path_to_dat: PathLike, path_to_func: PathLike) -> None:
     """
     Given a complete dataframe of files, writes appropriate tsvs for func files.
@@ -53,25 +44,16 @@ def write_func_tsv(path_to_vmrk: PathLike, path_to_dat: PathLike, path_to_func:
     file_dataframe : DataFrame
         DataFrame created by organize_files() containing metadata about each file
     """
-    vmrk_data = Vmrk(path_to_vmrk)
-    dat_data = Dat(path_to_dat)
-
-    onsets = vmrk_data.onsets
-    duration = dat_data.average_duration
-
-    # Prep a dataframe to write to .tsv.
-    tsv_tuples = [ ("onset", "duration", "trial_type") ]
-    for onset in onsets:
-        tsv_tuples.append( (onset, duration, "gabor") )
-    tsv_dataframe = pandas.DataFrame(tsv_tuples)
+    # Label each trial with its condition code from the .dat file.
+    events = Events(Vmrk(path_to_vmrk), Dat(path_to_dat))
 
     # Get .tsv path.
     tsv_path = Path(str(path_to_func).replace("_bold.nii", "_events.tsv"))
 
     # Write the .tsv
-    tsv_dataframe.to_csv(tsv_path, sep="\t", header=False, index=False)
+    events.write_tsv(tsv_path)
 
-def write_func_json(path_to_func: PathLike) -> None:
+def write_func_json(path_to_func: PathLike, repetition_time: Optional[float]=None) -> None:
     """
     Given a full file dataframe, writes appropriate jsons for functional files.
 
@@ -79,12 +61,15 @@ def write_func_json(path_to_func: PathLike) -> None:
     ----------
     file_dataframe : DataFrame
         DataFrame created by organize_files() containing metadata about each file
+    repetition_time : float, optional
+        Repetition time in seconds. Read from the header of the functional image by default.
     """
     # Get json path.
     json_path = Path(path_to_func).with_suffix(".json")
 
     # Acquire values we'll need in the json.
-    repetition_time = 2
+    if repetition_time is None:
+        repetition_time = HeaderCache().repetition_time(path_to_func)
     task = "contrascan"
     volume_count = get_volume_count(path_to_func)
     slice_timings = _calculate_slice_timings(repetition_time, volume_count)
@@ -128,8 +113,7 @@ def _calculate_slice_timings(repetition_time: float, volume_count: int) -> List[
 def get_volume_count(path_to_func: PathLike) -> int:
     """
     Returns the number of volumes in a func image.
-    """
-    image = nibabel.load(path_to_func)
-    volume_count = image.header["slice_end"] - image.header["slice_start"] + 1
 
-    return volume_count
+    Only reads the header of the image, and only if it isn't cached already.
+    """
+    return HeaderCache().slice_count(path_to_func)
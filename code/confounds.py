@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Turn fMRIPrep's confounds file into a single nuisance matrix, and an events file into a single onsets file.
+
+Only the columns we regress out are read. They're written together as one .1D matrix with one row per volume and
+one column per regressor, ready for 3dDeconvolve -ortvec or glm.py. Optionally the regressors are reduced to their
+principal components or orthogonalized first. Matrices are cached by a hash of the confounds file's contents and the
+options used, so rerunning a subject costs one hash.
+"""
+# Import external libraries and modules.
+from os import PathLike
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+import argparse
+import hashlib
+import json
+import numpy
+import pandas
+
+# Import CSEA libraries and modules.
+from uptodate import full_file_hash
+
+CONFOUNDS_CACHE_DIR = Path(__file__).resolve().parent.parent / "outputs" / "confounds"
+
+def main(tsv_path: PathLike, columns: Sequence[str], cache_dir: PathLike=CONFOUNDS_CACHE_DIR, components: Optional[float]=None, orthogonalize: bool=False) -> Path:
+    """
+    Writes the chosen columns of a confounds file as one .1D matrix and returns its path.
+
+    Returns the cached matrix instead if the same file was processed with the same options before.
+
+    Parameters
+    ----------
+    tsv_path : str or Path
+        fMRIPrep confounds file.
+    columns : list of str
+        Names of the columns to keep.
+    cache_dir : str or Path
+        Directory to cache matrices in.
+    components : float, optional
+        Replace the regressors with their principal components. A whole number keeps that many components. A
+        fraction keeps as many as it takes to explain that fraction of the variance.
+    orthogonalize : bool
+        Make the regressors orthogonal to each other and to the mean, keeping the space they span.
+    """
+    columns = list(columns)
+    options = {"columns": columns, "components": components, "orthogonalize": orthogonalize}
+    key = hashlib.blake2b(f"{full_file_hash(tsv_path)}{json.dumps(options)}".encode(), digest_size=16).hexdigest()
+    cache_dir = Path(cache_dir)
+    out_path = cache_dir / f"{key}.1D"
+    if out_path.exists():
+        return out_path
+
+    matrix = read_confounds(tsv_path, columns).to_numpy(dtype=numpy.float64)
+    labels = columns
+    if components:
+        matrix, labels = principal_components(matrix, components)
+    elif orthogonalize:
+        matrix = orthogonalized(matrix)
+
+    # Write to a temporary name first so a crash never leaves a partial matrix in the cache.
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    temp_path = out_path.with_suffix(".1D.tmp")
+    numpy.savetxt(temp_path, matrix, fmt="%.6g", header=" ".join(labels))
+    temp_path.replace(out_path)
+
+    return out_path
+
+def read_confounds(tsv_path: PathLike, columns: Sequence[str]) -> pandas.DataFrame:
+    """
+    Reads only the given columns of a confounds file as float32, with missing values set to zero.
+
+    fMRIPrep leaves the first value of every derivative as n/a, since there's nothing to take a difference from.
+    """
+    columns = list(columns)
+    confounds = pandas.read_table(tsv_path, usecols=columns, dtype={column: numpy.float32 for column in columns}, na_values="n/a", engine="c")
+
+    return confounds.fillna(0)[columns]
+
+def read_matrix(path: PathLike) -> Tuple[numpy.ndarray, List[str]]:
+    """
+    Reads a matrix written by main(). Returns it along with the label of each column.
+    """
+    with open(path) as matrix_file:
+        labels = matrix_file.readline().lstrip("#").split()
+    matrix = numpy.loadtxt(path, ndmin=2)
+
+    return matrix, labels
+
+def principal_components(matrix: numpy.ndarray, components: float) -> Tuple[numpy.ndarray, List[str]]:
+    """
+    Returns the principal components of the columns of matrix along with a label for each.
+
+    components is either how many to keep, or the fraction of variance they should explain.
+    """
+    centered = matrix - matrix.mean(axis=0)
+    left, singular_values, _ = numpy.linalg.svd(centered, full_matrices=False)
+    if components >= 1:
+        count = min(int(components), singular_values.size)
+    else:
+        explained = numpy.cumsum(singular_values ** 2) / numpy.sum(singular_values ** 2)
+        count = int(numpy.searchsorted(explained, components) + 1)
+
+    return left[:, :count] * singular_values[:count], [f"pc{i}" for i in range(count)]
+
+def orthogonalized(matrix: numpy.ndarray) -> numpy.ndarray:
+    """
+    Orthogonalizes the columns of matrix in order against the mean and each other, keeping their scale.
+    """
+    q, r = numpy.linalg.qr(numpy.column_stack([numpy.ones(len(matrix)), matrix]))
+    return q[:, 1:] * numpy.abs(numpy.diag(r))[1:]
+
+def write_onsets(events_tsv: PathLike, out_path: PathLike) -> Path:
+    """
+    Writes the onsets of a BIDS events file on a single line, the format 3dDeconvolve -stim_times reads.
+    """
+    out_path = Path(out_path)
+    onsets = pandas.read_table(events_tsv, usecols=["onset"], dtype={"onset": numpy.float64}, engine="c")["onset"].to_numpy()
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    numpy.savetxt(out_path, onsets[numpy.newaxis], fmt="%g")
+
+    return out_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Turn fMRIPrep's confounds file into a single nuisance matrix.")
+    parser.add_argument("tsv_path", help="fMRIPrep confounds file.")
+    parser.add_argument("columns", nargs="+", help="Columns to keep.")
+    parser.add_argument("--components", type=float, default=None, help="Number of principal components to keep, or the fraction of variance to explain.")
+    parser.add_argument("--orthogonalize", action="store_true", help="Orthogonalize the regressors.")
+    args = parser.parse_args()
+
+    print(main(args.tsv_path, args.columns, components=args.components, orthogonalize=args.orthogonalize))
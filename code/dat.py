@@ -6,8 +6,21 @@ Class to organize and extract data from a .dat file.
 Created 8/20/2020 by Benjamin Velie.
 veliebm@gmail.com
 """
+from os import PathLike
 from pathlib import Path
+from typing import Iterable
+import numpy
 import pandas
+
+# Columns written by the stimulus script for each trial, in order, and their types.
+SCHEMA = {
+    "subject": numpy.int32,
+    "phase": numpy.int16,
+    "trial": numpy.int16,
+    "condition": numpy.int16,
+    "duration": numpy.float64,
+}
+
 class Dat():
     """
     Class to organize and extract data from a .dat file.
@@ -22,39 +35,67 @@ class Dat():
     path : Path
         Path to the .dat file.
     dataframe : DataFrame
-        DataFrame containing each value of the .dat table. Rows and columns are numbered from 0 onward.
+        DataFrame containing each value of the .dat table. Columns are named and typed according to SCHEMA.
+    durations : ndarray
+        Duration of each trial in seconds.
+    trial_numbers : ndarray
+        Trial number of each trial. The condition of each trial is in dataframe["condition"].
     """
 
     def __init__(self, input_path):
         self.path = Path(input_path)
         self.dataframe = self._as_dataframe()
         self.durations = self._durations()
-        self.average_duration = sum(self.durations) / len(self.durations)
-        self.trial_codes = list(self.dataframe[self.dataframe.columns[2]])
+        self.average_duration = float(self.durations.mean())
+        self.trial_numbers = self.dataframe["trial"].to_numpy()
 
-    def _durations(self) -> list:
+    def _durations(self) -> numpy.ndarray:
         """
-        Returns a list of durations extracted from the .dat file.
+        Returns an array of durations extracted from the .dat file.
 
         Automatically converts times into seconds.
         """
-        raw_durations = self.dataframe[self.dataframe.columns[4]]
-
-        # Clean the raw durations into standard float numbers, then return them.
-        return [float(duration) for duration in raw_durations]
-
+        return self.dataframe["duration"].to_numpy()
 
     def _as_dataframe(self) -> pandas.DataFrame:
         """
         Reads the .dat file and returns it as a fresh, clean DataFrame.
 
-        Columns are numbered in order. Rows are also numbered in order.
+        Columns are named and typed according to SCHEMA. Rows are numbered in order.
         """
+        return read_dat(self.path)
+
+def read_dat(path: PathLike) -> pandas.DataFrame:
+    """
+    Reads a .dat file into a DataFrame with one typed column per entry of SCHEMA.
 
-        # Format our data into a dewhitespaced list of lists
-        line_list = self.path.read_text().splitlines()
-        dewhitespaced_line_list = [" ".join(line.rstrip().split()) for line in line_list]
-        split_line_list = [line.split() for line in dewhitespaced_line_list]
+    The whole file is tokenized by the C parser of pandas. Any dangling whitespace at the end of a line is ignored.
+    """
+    return pandas.read_csv(
+        path,
+        sep=r"\s+",
+        header=None,
+        names=list(SCHEMA),
+        usecols=list(SCHEMA),
+        dtype=SCHEMA,
+        engine="c",
+    )
+
+def read_dats(paths: Iterable[PathLike]) -> pandas.DataFrame:
+    """
+    Reads many .dat files into a single DataFrame.
+
+    Adds a categorical column named "path" recording which file each row came from. A file given more than once is
+    read once. With no files the DataFrame is empty but still has the columns of SCHEMA.
+    """
+    paths = list(dict.fromkeys(Path(path) for path in paths))
+    dataframes = [read_dat(path) for path in paths]
+    if not dataframes:
+        dataframes = [pandas.DataFrame({column: pandas.Series(dtype=dtype) for column, dtype in SCHEMA.items()})]
+    dataframe = pandas.concat(dataframes, ignore_index=True)
+    dataframe["path"] = pandas.Categorical.from_codes(
+        numpy.repeat(numpy.arange(len(paths)), [len(frame) for frame in dataframes]),
+        categories=[str(path) for path in paths],
+    )
 
-        # Return the list of lists as a glorious DataFrame
-        return pandas.DataFrame(split_line_list)
+    return dataframe
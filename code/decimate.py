@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Decimate a BrainVision recording into a smaller derivative.
+
+The recording is read in overlapping chunks and run through a polyphase anti-aliasing filter, so only the samples we
+keep are ever computed and the recording never needs to fit into memory. Marker positions are rescaled to match.
+"""
+# Import external libraries and modules.
+from os import PathLike
+from pathlib import Path
+from typing import Dict
+import argparse
+import json
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Import CSEA libraries and modules.
+from eeg import Eeg
+from vhdr import write_vhdr
+from vmrk import Vmrk, write_vmrk
+
+def main(vhdr_path: PathLike, out_dir: PathLike, factor: int=10, out_format: str="brainvision", chunk_samples: int=1 << 16) -> Dict[str, str]:
+    """
+    Writes a decimated copy of a recording into out_dir.
+
+    Parameters
+    ----------
+    vhdr_path : str or Path
+        Header of the recording to decimate.
+    out_dir : str or Path
+        Directory to write the decimated recording into.
+    factor : int
+        Keep one sample out of this many.
+    out_format : str
+        "brainvision" writes a float32 .eeg file with a new .vhdr and .vmrk. "numpy" writes a float32 .npy array
+        indexed as [channel, sample] with a .json sidecar and a new .vmrk that records the new sampling interval.
+    chunk_samples : int
+        Number of decimated samples to compute at once.
+    """
+    eeg = Eeg(vhdr_path)
+    vmrk = Vmrk(eeg.header.marker_path)
+    out_dir = Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_paths = {"vmrk": out_dir / eeg.path.with_suffix(".vmrk").name}
+    out_length = -(-eeg.sample_count // factor)
+
+    if out_format == "brainvision":
+        out_paths["vhdr"] = out_dir / eeg.path.name
+        out_paths["eeg"] = out_dir / eeg.path.with_suffix(".eeg").name
+        decimated = numpy.memmap(out_paths["eeg"], dtype="<f4", mode="w+", shape=(out_length, eeg.header.channel_count)).T
+    elif out_format == "numpy":
+        out_paths["npy"] = out_dir / eeg.path.with_suffix(".npy").name
+        out_paths["json"] = out_dir / eeg.path.with_suffix(".json").name
+        decimated = numpy.lib.format.open_memmap(out_paths["npy"], dtype="<f4", mode="w+", shape=(eeg.header.channel_count, out_length))
+    else:
+        raise ValueError(f"Unknown output format {out_format}. Choose brainvision or numpy.")
+
+    decimate_into(eeg, decimated, factor, chunk_samples)
+    decimated.flush()
+
+    # Decimated sample i lines up with sample i * factor of the recording, so move each marker to the nearest one.
+    markers = vmrk.markers.copy()
+    markers["position"] = numpy.minimum((markers["position"] - 1 + factor // 2) // factor, out_length - 1) + 1
+    markers["size"] = numpy.maximum(-(-markers["size"] // factor), 1)
+    if out_format == "brainvision":
+        write_vmrk(out_paths["vmrk"], markers, out_paths["eeg"].name)
+    else:
+        # There's no .vhdr next to a .npy, so the markers carry the sampling interval themselves.
+        write_vmrk(out_paths["vmrk"], markers, out_paths["npy"].name, eeg.header.sampling_interval * factor)
+
+    if out_format == "brainvision":
+        channels = eeg.header.channels.copy()
+        channels["resolution"] = 1
+        write_vhdr(out_paths["vhdr"], out_paths["eeg"].name, out_paths["vmrk"].name, channels, eeg.header.sampling_interval * factor)
+    else:
+        sidecar = {
+            "Dimensions": ["channel", "sample"],
+            "Channels": eeg.channel_names,
+            "Units": eeg.header.channels["unit"].tolist(),
+            "SamplingFrequency": eeg.sampling_rate / factor,
+        }
+        with open(out_paths["json"], "w") as out_file:
+            json.dump(sidecar, out_file, indent="\t")
+
+    print(f"Decimated {eeg.path} from {eeg.sampling_rate:g} Hz to {eeg.sampling_rate / factor:g} Hz into {out_dir}")
+    return {key: str(path) for key, path in out_paths.items()}
+
+def anti_aliasing_filter(factor: int, half_length: int=10) -> numpy.ndarray:
+    """
+    Returns the taps of a low-pass FIR filter with its cutoff at the Nyquist frequency of the decimated signal.
+
+    It's a Kaiser-windowed sinc with half_length * factor taps on each side of its center, the same design
+    scipy.signal.resample_poly uses.
+    """
+    offsets = numpy.arange(-half_length * factor, half_length * factor + 1)
+    taps = numpy.sinc(offsets / factor) * numpy.kaiser(offsets.size, 5.0)
+
+    return (taps / taps.sum()).astype(numpy.float32)
+
+def decimate_array(data: numpy.ndarray, factor: int) -> numpy.ndarray:
+    """
+    Filters data along its last axis with anti_aliasing_filter and keeps samples 0, factor, 2 * factor and so on.
+
+    The filter is centered on each kept sample, so kept sample i lines up exactly with sample i * factor of data. The
+    edges are padded by repeating their first and last samples.
+    """
+    taps = anti_aliasing_filter(factor).astype(data.dtype)
+    half_width = taps.size // 2
+    padded = numpy.pad(data, [(0, 0)] * (data.ndim - 1) + [(half_width, half_width)], mode="edge")
+
+    return sliding_window_view(padded, taps.size, axis=-1)[..., ::factor, :] @ taps[::-1]
+
+def decimate_into(eeg: Eeg, decimated: numpy.ndarray, factor: int, chunk_samples: int=1 << 16) -> None:
+    """
+    Filters and decimates every channel of a recording into decimated, which is indexed as [channel, sample].
+
+    Each chunk is read with enough extra samples on both sides for the filter. The edges of the recording are
+    padded by repeating their first and last samples.
+    """
+    taps = anti_aliasing_filter(factor)
+    half_width = taps.size // 2
+    resolutions = eeg.header.channels["resolution"][:, numpy.newaxis].astype(numpy.float32)
+
+    for first in range(0, decimated.shape[1], chunk_samples):
+        last = min(first + chunk_samples, decimated.shape[1])
+        read_first = first * factor - half_width
+        read_last = (last - 1) * factor + half_width + 1
+
+        chunk = eeg.raw[:, max(read_first, 0):min(read_last, eeg.sample_count)].astype(numpy.float32)
+        chunk *= resolutions
+        chunk = numpy.pad(chunk, ((0, 0), (max(-read_first, 0), max(read_last - eeg.sample_count, 0))), mode="edge")
+
+        # Only compute the filter output at the samples we keep.
+        windows = sliding_window_view(chunk, taps.size, axis=1)[:, ::factor]
+        decimated[:, first:last] = windows @ taps[::-1]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decimate a BrainVision recording into a smaller derivative.")
+    parser.add_argument("vhdr_path", help="Header of the recording to decimate.")
+    parser.add_argument("--out-dir", required=True, help="Directory to write the decimated recording into.")
+    parser.add_argument("--factor", type=int, default=10, help="Keep one sample out of this many.")
+    parser.add_argument("--format", default="brainvision", choices=["brainvision", "numpy"], help="Format of the decimated recording.")
+    args = parser.parse_args()
+
+    main(args.vhdr_path, args.out_dir, args.factor, args.format)
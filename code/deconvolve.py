@@ -10,37 +10,88 @@ veliebm@gmail.com
 from os import PathLike
 from pathlib import Path
 import shutil
-from typing import List
-import pandas
-import subprocess
+from typing import List, Optional
 
-def main(subject_ids: List[str]) -> None:
+# Import CSEA libraries and modules.
+from masked import MaskedSeries
+from resources import allotted_cores, thread_environment
+from stage_cache import StageCache
+from tool_runner import ToolRunner
+import confounds
+import glm
+import smooth_scale
+
+# Confounds from fMRIPrep we regress out of every subject.
+REGRESSORS = "csf csf_derivative1 csf_power2 csf_derivative1_power2 white_matter white_matter_derivative1 white_matter_derivative1_power2 white_matter_power2 csf_wm trans_x trans_x_derivative1 trans_x_power2 trans_x_derivative1_power2 trans_y trans_y_derivative1 trans_y_derivative1_power2 trans_y_power2 trans_z trans_z_derivative1 trans_z_derivative1_power2 trans_z_power2 rot_x rot_x_derivative1 rot_x_power2 rot_x_derivative1_power2 rot_y rot_y_derivative1 rot_y_power2 rot_y_derivative1_power2 rot_z rot_z_derivative1 rot_z_power2 rot_z_derivative1_power2".split()
+
+def main(subject_ids: List[str], engine: str="numpy", keep_intermediates: bool=False, glm_engine: str="afni", components: Optional[float]=None, orthogonalize: bool=False, fwhm: float=4.0, cores: Optional[int]=None) -> None:
     """
     After running fMRIPrep, run this node to clean its results further then deconvolve them.
+
+    Parameters
+    ----------
+    subject_ids : list of str
+        IDs of the subjects to process.
+    engine : str
+        "numpy" smooths and scales each image in one pass with smooth_scale.py. "afni" runs 3dmerge, 3dTstat and
+        3dcalc instead.
+    keep_intermediates : bool
+        With the numpy engine, also write the smoothed image, the voxel means and the full scaled image. The scaled
+        image is always written when glm_engine is "afni".
+    glm_engine : str
+        "afni" runs 3dDeconvolve. "numpy" fits the GLM in-process with glm.py instead. Keep the default until
+        validate_glm.py and test_glm.py have passed their comparisons against 3dDeconvolve.
+    components : float, optional
+        Replace the nuisance regressors with their principal components. See confounds.main().
+    orthogonalize : bool
+        Orthogonalize the nuisance regressors.
+    fwhm : float
+        Full width at half maximum of the blur in mm.
+    cores : int, optional
+        Number of threads AFNI programs and our process pools may use. Defaults to the cores allotted to this task.
     """
-    regressors = "csf csf_derivative1 csf_power2 csf_derivative1_power2 white_matter white_matter_derivative1 white_matter_derivative1_power2 white_matter_power2 csf_wm trans_x trans_x_derivative1 trans_x_power2 trans_x_derivative1_power2 trans_y trans_y_derivative1 trans_y_derivative1_power2 trans_y_power2 trans_z trans_z_derivative1 trans_z_derivative1_power2 trans_z_power2 rot_x rot_x_derivative1 rot_x_power2 rot_x_derivative1_power2 rot_y rot_y_derivative1 rot_y_power2 rot_y_derivative1_power2 rot_z rot_z_derivative1 rot_z_power2 rot_z_derivative1_power2".split()
     bids_dir = Path("../outputs/bids").resolve()
 
-    for subject_id in subject_ids:
-        output_dir = Path(f"../outputs/{__name__}/sub-{subject_id}").resolve()
-        fmriprep_dir = Path(f"../outputs/fmriprep/sub-{subject_id}/fmriprep/sub-{subject_id}").resolve()
-
-        inputs = {
-            "anat_image": fmriprep_dir / f"anat/sub-{subject_id}_space-MNI152NLin2009cAsym_desc-preproc_T1w.nii.gz",
-            "events_tsv": bids_dir / f"sub-{subject_id}/func/sub-{subject_id}_task-contrascan_events.tsv",
-            "func_mask": fmriprep_dir / f"func/sub-{subject_id}_task-gabor_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz",
-            "regressors_tsv": fmriprep_dir / f"func/sub-{subject_id}_task-gabor_desc-confounds_timeseries.tsv",
-            "func_image": fmriprep_dir / f"func/sub-{subject_id}_task-gabor_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
-        }
-        for input in inputs.values():
-            _test_path_exists(input)
-
-        # Run steps of analysis.
-        func_smoothed = merge(output_dir, inputs["func_image"], subject_id)
-        func_means = tstat(output_dir, func_smoothed, subject_id)
-        func_scaled = calc(output_dir, func_smoothed, func_means, subject_id)
-        deconvolve(output_dir, inputs["anat_image"], func_scaled, inputs["events_tsv"], inputs["regressors_tsv"], regressors, subject_id)
-        #remlfit()
+    # Cap the threads of every AFNI program we start, instead of inheriting whatever the environment says.
+    with thread_environment(cores or allotted_cores()):
+        for subject_id in subject_ids:
+            output_dir = Path(f"../outputs/{__name__}/sub-{subject_id}").resolve()
+            fmriprep_dir = Path(f"../outputs/fmriprep/sub-{subject_id}/fmriprep/sub-{subject_id}").resolve()
+
+            inputs = {
+                "anat_image": fmriprep_dir / f"anat/sub-{subject_id}_space-MNI152NLin2009cAsym_desc-preproc_T1w.nii.gz",
+                "events_tsv": bids_dir / f"sub-{subject_id}/func/sub-{subject_id}_task-contrascan_events.tsv",
+                "func_mask": fmriprep_dir / f"func/sub-{subject_id}_task-gabor_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz",
+                "regressors_tsv": fmriprep_dir / f"func/sub-{subject_id}_task-gabor_desc-confounds_timeseries.tsv",
+                "func_image": fmriprep_dir / f"func/sub-{subject_id}_task-gabor_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
+            }
+            for input in inputs.values():
+                _test_path_exists(input)
+
+            # Run steps of analysis.
+            confounds_path = confounds.main(inputs["regressors_tsv"], REGRESSORS, components=components, orthogonalize=orthogonalize)
+            if engine == "numpy":
+                # The numpy GLM reads the in-mask voxels directly. Only scatter them back into a full image if AFNI or a person needs it.
+                series = smooth_scale.smooth_and_scale(inputs["func_image"], output_dir / "smooth_scale", subject_id, inputs["func_mask"], fwhm, keep_intermediates=keep_intermediates)
+                series_path = Path(series.data.filename)
+                if glm_engine == "afni" or keep_intermediates:
+                    func_scaled = series.write(output_dir / "smooth_scale" / f"sub-{subject_id}_bold_scaled.nii")
+            elif engine == "afni":
+                func_smoothed = merge(output_dir, inputs["func_image"], subject_id, fwhm)
+                func_means = tstat(output_dir, func_smoothed, subject_id)
+                func_scaled = calc(output_dir, func_smoothed, func_means, subject_id)
+                series_path = None
+            else:
+                raise ValueError(f"Unknown engine {engine!r}. Use 'numpy' or 'afni'.")
+            if glm_engine == "numpy":
+                if series_path is None:
+                    series_path = MaskedSeries.from_image(func_scaled, inputs["func_mask"]).save(output_dir / f"sub-{subject_id}_bold_scaled")
+                glm.main(series_path, inputs["events_tsv"], output_dir / "glm", subject_id, confounds_path)
+                shutil.copyfile(src=inputs["anat_image"], dst=output_dir / "glm" / inputs["anat_image"].name)
+            elif glm_engine == "afni":
+                deconvolve(output_dir, inputs["anat_image"], func_scaled, inputs["func_mask"], inputs["events_tsv"], confounds_path, subject_id)
+            else:
+                raise ValueError(f"Unknown GLM engine {glm_engine!r}. Use 'numpy' or 'afni'.")
 
 def _test_path_exists(path: PathLike) -> None:
     """
@@ -52,9 +103,9 @@ def _test_path_exists(path: PathLike) -> None:
     except AssertionError:
         raise FileNotFoundError(f"{path} doesn't exist")
 
-def merge(output_dir: Path, path_to_func: Path, subject_id: str) -> Path:
+def merge(output_dir: Path, path_to_func: Path, subject_id: str, fwhm: float=4.0) -> Path:
     """
-    Smooths a functional image.
+    Smooths a functional image with a Gaussian blur fwhm mm wide.
 
     3dmerge info: https://afni.nimh.nih.gov/pub/dist/doc/htmldoc/programs/3dmerge_sphx.html#ahelp-3dmerge
     """
@@ -66,12 +117,12 @@ def merge(output_dir: Path, path_to_func: Path, subject_id: str) -> Path:
 
     command = f"""
         3dmerge
-        -1blur_fwhm 4.0
+        -1blur_fwhm {fwhm}
         -doall
         -prefix {prefix}
         {path_to_func}
     """.split()
-    subprocess.run(command, cwd=working_dir)
+    StageCache().run(command, working_dir, inputs=[path_to_func], outputs=[f"{prefix}+*"], runner=ToolRunner(output_dir / "profile.jsonl", subject_id), stage="merge")
 
     _test_path_exists(outfile)
     return outfile
@@ -93,7 +144,7 @@ def tstat(output_dir: Path, smoothed_func: Path, subject_id: str) -> Path:
         -prefix {prefix}
         {smoothed_func}
     """.split()
-    subprocess.run(command, cwd=working_dir)
+    StageCache().run(command, working_dir, inputs=[smoothed_func], outputs=[f"{prefix}+*"], runner=ToolRunner(output_dir / "profile.jsonl", subject_id), stage="tstat")
 
     _test_path_exists(outfile)
     return outfile
@@ -119,14 +170,16 @@ def calc(output_dir: Path, smoothed_func: Path, func_means: Path, subject_id: st
         -expr ((a-b)/b)*100
         -prefix {prefix}
     """.split()
-    subprocess.run(command, cwd=working_dir)
+    StageCache().run(command, working_dir, inputs=[smoothed_func, func_means], outputs=[f"{prefix}+*"], runner=ToolRunner(output_dir / "profile.jsonl", subject_id), stage="calc")
 
     _test_path_exists(outfile)
     return outfile
 
-def deconvolve(output_dir: Path, anat_path: Path, func_scaled: Path, events_tsv: Path, regressors_tsv: Path, regressors: List[str], subject_id: str) -> List[Path]:
+def deconvolve(output_dir: Path, anat_path: Path, func_scaled: Path, func_mask: Path, events_tsv: Path, confounds_path: Path, subject_id: str) -> List[Path]:
     """
-    Runs a within-subject analysis on a smoothed functional image.
+    Runs a within-subject analysis on the voxels of a smoothed functional image that fall inside func_mask.
+
+    The nuisance matrix at confounds_path goes into the baseline model as a single -ortvec.
 
     Returns a tuple of paths to outfiles: (bucket, IRF)
 
@@ -135,10 +188,7 @@ def deconvolve(output_dir: Path, anat_path: Path, func_scaled: Path, events_tsv:
     # Prepare our directories.
     program = "3dDeconvolve"
     working_dir = output_dir / program
-    events_dir = output_dir / "temp" / "events"
-    regressors_dir = output_dir / "temp" / "regressors-all"
-    for dir in (working_dir, regressors_dir, events_dir):
-        dir.mkdir(parents=True, exist_ok=True)
+    working_dir.mkdir(parents=True, exist_ok=True)
 
     # Name our outfiles.
     bucket_prefix = f"sub-{subject_id}_bold_deconvolved"
@@ -148,36 +198,25 @@ def deconvolve(output_dir: Path, anat_path: Path, func_scaled: Path, events_tsv:
         working_dir / f"{IRF_prefix}+tlrc.HEAD",
     )
 
-    # Prepare text files to use with 3dDeconvolve.
-    _split_columns_into_text_files(events_tsv, events_dir)
-    _split_columns_into_text_files(regressors_tsv, regressors_dir)
-    onsets_path = events_dir / "onset.txt"
-
-    # Total amount of regressors to include in the analysis.
-    amount_of_regressors = 1 + len(regressors)
+    onsets_path = confounds.write_onsets(events_tsv, output_dir / "temp" / "onsets.1D")
 
     # Create list of arguments to pass to 3dDeconvolve.
     command = f"""
         {program}
         -input {func_scaled}
+        -mask {func_mask}
         -GOFORIT 4
+        -jobs {allotted_cores()}
         -polort A
         -fout
         -bucket {bucket_prefix}
-        -num_stimts {amount_of_regressors}
+        -ortvec {confounds_path} confounds
+        -num_stimts 1
         -stim_times 1 {onsets_path} CSPLINzero(0,18,10)
         -stim_label 1 all
         -iresp 1 {IRF_prefix}
     """.split()
-
-    # Add individual stim files to the string.
-    for i, regressor in enumerate(regressors):
-            stim_number = i + 2
-            stim_file_info = f"-stim_file {stim_number} {regressors_dir/regressor}.txt -stim_base {stim_number}"
-            stim_label_info = f"-stim_label {stim_number} {regressor}"
-            command += stim_file_info.split() + stim_label_info.split()
-    
-    subprocess.run(command, cwd=working_dir)
+    StageCache().run(command, working_dir, inputs=[func_scaled, func_mask, confounds_path, onsets_path], outputs=[f"{bucket_prefix}+*", f"{IRF_prefix}+*", "Decon.*"], runner=ToolRunner(output_dir / "profile.jsonl", subject_id), stage="deconvolve")
 
     # Copy anatomy file into working directory to use with AFNI viewer.
     shutil.copyfile(src=anat_path, dst=working_dir / anat_path.name)
@@ -185,61 +224,3 @@ def deconvolve(output_dir: Path, anat_path: Path, func_scaled: Path, events_tsv:
     for path in out_files:
         _test_path_exists(path)
     return out_files
-
-def remlfit():
-        """
-        Runs a 3dREMLfit within-subject analysis on a smoothed functional image using a matrix created by 3dDeconvolve.
-
-        3dREMLfit info: https://afni.nimh.nih.gov/pub/dist/doc/htmldoc/programs/3dREMLfit_sphx.html#ahelp-3dremlfit
-        """
-
-        working_directory = dirs["output"] / f"task-{task_name}" / "3dREMLfit"
-
-        # Create the list of arguments to pass to 3dREMLfit.
-        args = f"""
-                -matrix {results[task_name]["3dDeconvolve"].matrix}
-                -input {results[task_name]["3dcalc"].outfile}
-                -fout 
-                -tout
-                -Rbuck sub-{subject_id}_task-{task_name}_bold_reml_stats
-                -Rvar sub-{subject_id}_task-{task_name}_bold_reml_varianceparameters
-                -verb
-
-        """.split()
-
-        # Run 3dREMLfit.
-        results = AFNI(program="3dREMLfit", args=args, working_directory=working_directory)
-
-        # Copy anatomy file into working directory to use with AFNI viewer.
-        shutil.copyfile(src=anat_path, dst=working_directory / anat_path.name)
-
-        return results
-
-def _split_columns_into_text_files(tsv_path, output_dir) -> None:
-    """
-    Converts a tsv file into a collection of text files.
-
-    Each column name becomes the name of a text file. Each value in that column is then
-    placed into the text file. Don't worry - this won't hurt your .tsv file, which will lay
-    happily in its original location.
-
-    Parameters
-    ----------
-    tsv_path : str or Path
-            Path to the .tsv file to break up.
-    output_dir : str or Path
-        Directory to write columns of the .tsv file to.
-    """
-    # Alert the user and prepare our paths.
-    tsv_path = Path(tsv_path).resolve()
-    output_dir = Path(output_dir).resolve()
-    output_dir.mkdir(exist_ok=True, parents=True)
-    print(f"Storing the columns of {tsv_path.name} as text files in directory {output_dir}")
-
-    # Read the .tsv file into a DataFrame and fill n/a values with zero.
-    tsv_info = pandas.read_table(tsv_path, sep="\t", na_values="n/a").fillna(value=0)
-
-    # Write each column of the dataframe as a text file.
-    for column_name in tsv_info:
-        column_path = output_dir / f"{column_name}.txt"
-        tsv_info[column_name].to_csv(column_path, sep=' ', index=False, header=False)
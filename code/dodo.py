@@ -7,29 +7,60 @@ Created 6/22/21 by Benjamin Velie.
 # Import external libraries and modules.
 from os import PathLike
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
+import itertools
 import json
-import collections
+import collections.abc
 import six
 
+from doit import get_var
+from doit.tools import config_changed
+
 # Import homemade libraries and modules.
-import create_bids_root
-import bidsify_subject
-import afniproc
+# Pipeline modules are only named here. They get imported when their task actually runs. See lazy_action.py.
+from lazy_action import LazyAction
+from raw_index import RawIndex
+from uptodate import SampledChecker
+from resources import ResourcedAction, node_capacity
+from history import History
 
 DOIT_CONFIG = {
     "verbosity": 2,
-    "num_process": 8, 
+    "num_process": node_capacity()["cores"],
+    "check_file_uptodate": SampledChecker,
     "subject ids": "104 106 107 108 109 110 111 112 113 115 116 117 120 121 122 123 124 125".split()
 }
 
+# Cores and peak memory in GB each kind of task may use. A task only starts once its budget fits on the node. See resources.py.
+TASK_BUDGETS = {
+    "create_bids_root": {"cores": 1, "memory_gb": 0.5},
+    "bidsify_subject": {"cores": 1, "memory_gb": 1},
+    "afniproc": {"cores": 4, "memory_gb": 12},
+    "remove gradients": {"cores": 4, "memory_gb": 4},
+    "decimate": {"cores": 1, "memory_gb": 2},
+    "sweep smooth": {"cores": 1, "memory_gb": 4},
+    "sweep confounds": {"cores": 1, "memory_gb": 1},
+    "sweep glm": {"cores": 4, "memory_gb": 4},
+}
+
+# Past runtimes of our tasks. Subjects whose tasks took longest before start first. See history.py.
+HISTORY = History()
+
+# Settings that "doit sweep=1" compares. Every combination becomes a variant. Regressor sets are named in sweep.py.
+SWEEP_GRID = {
+    "blur": [4.0, 6.0, 8.0],
+    "basis": ["CSPLINzero(0,18,10)", "CSPLINzero(0,18,7)", "TENTzero(0,18,10)"],
+    "remove_first_trs": [0, 1],
+    "regressors": ["all"],
+}
+
 def task_create_bids_root():
     """
     Create the root of our bids dataset. We'll finish BIDSifiying the data when we add our individual subjects to the dataset.
     """
     bids_dir = Path("../outputs/bids")
 
-    action = create_bids_root.main
+    action = ResourcedAction(LazyAction("create_bids_root"), **TASK_BUDGETS["create_bids_root"], task="create_bids_root")
     args = [bids_dir]
     file_dep = ["create_bids_root.py"]
     targets = [bids_dir / "dataset_description.json"]
@@ -46,19 +77,12 @@ def task_bidsify_subject():
 
     We'll need this for fMRIPrep. Also, when we submit our dataset to the NIH, they'll want it in BIDS format.
     """
-    action = bidsify_subject.main
     bids_dir = Path("../outputs/bids").resolve()
+    raw_index = RawIndex(Path("../raw/subjects-complete"), Path("../outputs/raw_index.json"))
 
-    for id in DOIT_CONFIG["subject ids"]:
-        old_subject_dir = Path(f"../raw/subjects-complete/sub-{id}").resolve()
-        sources = {
-            "eeg": old_subject_dir / f"contrascan_{id}.eeg",
-            "vhdr": old_subject_dir / f"contrascan_{id}.vhdr",
-            "vmrk": old_subject_dir / f"contrascan_{id}.vmrk",
-            "func": the_path_that_matches(f"Keil_{id}_*EPI_2s_Gain_*_1.nii", old_subject_dir),
-            "anat": the_path_that_matches(f"Keil_{id}_*sT1W_3D_FFE_SAG_*_1.nii", old_subject_dir),
-            "dat": old_subject_dir / f"SFcontrascan_{id}.dat",
-        }
+    for id in _longest_first("bidsify"):
+        action = ResourcedAction(LazyAction("bidsify_subject"), **TASK_BUDGETS["bidsify_subject"], task=f"bidsify {id}")
+        sources = raw_index.sources(id)
         targets = {
             "anat": bids_dir / f"sub-{id}/anat/sub-{id}_T1w.nii",
             "eeg":  bids_dir / f"sub-{id}/eeg/sub-{id}_task-contrascan_eeg.eeg",
@@ -74,7 +98,7 @@ def task_bidsify_subject():
 
         yield {
             "basename": f"bidsify {id}",
-            "actions": [(action, ([{"sources": sources_json, "targets": targets_json}]), {})],
+            "actions": [(action, ([{"sources": sources_json, "targets": targets_json}]), {"repetition_time": _repetition_time()})],
             "file_dep": tuple(sources_json.values()),
             "targets": tuple(targets_json.values()),
         }
@@ -85,9 +109,8 @@ def task_afniproc():
 
     This is the base of our pipeline. We'll use the outputs of afni_proc.py for our more advanced analyses.
     """
-    action = afniproc.main
-
-    for id in DOIT_CONFIG["subject ids"]:
+    for id in _longest_first("afniproc"):
+        action = ResourcedAction(LazyAction("afniproc"), **TASK_BUDGETS["afniproc"], task=f"afniproc {id}")
         in_dir = Path(f"../outputs/bids/sub-{id}").resolve()
         out_dir = Path(f"../outputs/afniproc/sub-{id}").resolve()
         kwargs = {
@@ -97,6 +120,7 @@ def task_afniproc():
             "out_dir": out_dir,
             "subject_id": id,
             "remove_first_trs": 1,
+            "repetition_time": _repetition_time(),
         }
         
         file_dep = [kwargs["vmrk_path"], kwargs["func_path"], kwargs["anat_path"]]
@@ -118,6 +142,159 @@ def task_afniproc():
             "targets": make_json_compatible(list(targets.values())),
         }
 
+def task_remove_gradients():
+    """
+    Remove the MR gradient artifact from the EEG of each subject.
+
+    The scanner leaves the same artifact in the EEG every TR. We subtract a running average of it and store the cleaned
+    recordings as a BIDS derivative.
+    """
+
+    for id in _longest_first("remove gradients"):
+        action = ResourcedAction(LazyAction("gradient_artifacts"), **TASK_BUDGETS["remove gradients"], task=f"remove gradients {id}")
+        in_dir = Path(f"../outputs/bids/sub-{id}/eeg").resolve()
+        out_dir = Path(f"../outputs/bids/derivatives/gradients-removed/sub-{id}/eeg").resolve()
+        kwargs = {
+            "vhdr_path": in_dir / f"sub-{id}_task-contrascan_eeg.vhdr",
+            "out_dir": out_dir,
+        }
+
+        file_dep = [kwargs["vhdr_path"], in_dir / f"sub-{id}_task-contrascan_eeg.vmrk", in_dir / f"sub-{id}_task-contrascan_eeg.eeg"]
+        targets = [
+            out_dir / f"sub-{id}_task-contrascan_eeg.vhdr",
+            out_dir / f"sub-{id}_task-contrascan_eeg.vmrk",
+            out_dir / f"sub-{id}_task-contrascan_eeg.eeg",
+        ]
+
+        yield {
+            "basename": f"remove gradients {id}",
+            "actions": [(action, (), make_json_compatible(kwargs))],
+            "file_dep": make_json_compatible(file_dep),
+            "targets": make_json_compatible(targets),
+        }
+
+def task_decimate():
+    """
+    Decimate the cleaned EEG of each subject from 5000 Hz to 500 Hz.
+
+    Epoching and spectral analyses don't need the raw sampling rate, so they read this much smaller derivative instead.
+    """
+
+    for id in _longest_first("decimate"):
+        action = ResourcedAction(LazyAction("decimate"), **TASK_BUDGETS["decimate"], task=f"decimate {id}")
+        in_dir = Path(f"../outputs/bids/derivatives/gradients-removed/sub-{id}/eeg").resolve()
+        out_dir = Path(f"../outputs/bids/derivatives/decimated/sub-{id}/eeg").resolve()
+        kwargs = {
+            "vhdr_path": in_dir / f"sub-{id}_task-contrascan_eeg.vhdr",
+            "out_dir": out_dir,
+            "factor": 10,
+        }
+
+        file_dep = [kwargs["vhdr_path"], in_dir / f"sub-{id}_task-contrascan_eeg.vmrk", in_dir / f"sub-{id}_task-contrascan_eeg.eeg"]
+        targets = [
+            out_dir / f"sub-{id}_task-contrascan_eeg.vhdr",
+            out_dir / f"sub-{id}_task-contrascan_eeg.vmrk",
+            out_dir / f"sub-{id}_task-contrascan_eeg.eeg",
+        ]
+
+        yield {
+            "basename": f"decimate {id}",
+            "actions": [(action, (), make_json_compatible(kwargs))],
+            "file_dep": make_json_compatible(file_dep),
+            "targets": make_json_compatible(targets),
+        }
+
+def task_sweep():
+    """
+    Run our fMRI analysis once per combination of settings in SWEEP_GRID. Only runs when doit is called with sweep=1.
+
+    Smoothing runs once per blur and subject, and confound prep once per regressor set and subject. Each variant only
+    fits its own GLM, into ../outputs/sweep/<variant>. A manifest lists the settings of every variant.
+    """
+    if not get_var("sweep"):
+        return
+
+    sweep_dir = Path("../outputs/sweep").resolve()
+    shared_dir = sweep_dir / "shared"
+    variants = [dict(zip(SWEEP_GRID, values)) for values in itertools.product(*SWEEP_GRID.values())]
+    for variant in variants:
+        variant["name"] = _variant_name(variant)
+
+    for id in DOIT_CONFIG["subject ids"]:
+        fmriprep_dir = Path(f"../outputs/fmriprep/sub-{id}/fmriprep/sub-{id}/func").resolve()
+        func_path = fmriprep_dir / f"sub-{id}_task-gabor_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+        mask_path = fmriprep_dir / f"sub-{id}_task-gabor_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz"
+        tsv_path = fmriprep_dir / f"sub-{id}_task-gabor_desc-confounds_timeseries.tsv"
+        events_tsv = Path(f"../outputs/bids/sub-{id}/func/sub-{id}_task-contrascan_events.tsv").resolve()
+
+        series_paths = {}
+        for blur in SWEEP_GRID["blur"]:
+            out_dir = shared_dir / f"blur-{blur:g}" / f"sub-{id}"
+            series_paths[blur] = out_dir / f"sub-{id}_bold_scaled.npy"
+            yield {
+                "basename": f"sweep smooth {id} blur-{blur:g}",
+                "actions": [(ResourcedAction(LazyAction("sweep", "smooth"), **TASK_BUDGETS["sweep smooth"], task=f"sweep smooth {id} blur-{blur:g}"), (), make_json_compatible({"func_path": func_path, "mask_path": mask_path, "out_dir": out_dir, "subject_id": id, "fwhm": blur}))],
+                "file_dep": make_json_compatible([func_path, mask_path]),
+                "targets": make_json_compatible([series_paths[blur], out_dir / f"sub-{id}_bold_scaled_mask.nii.gz"]),
+            }
+
+        confound_paths = {}
+        for regressor_set in SWEEP_GRID["regressors"]:
+            confound_paths[regressor_set] = shared_dir / f"regressors-{regressor_set}" / f"sub-{id}_confounds.1D"
+            yield {
+                "basename": f"sweep confounds {id} {regressor_set}",
+                "actions": [(ResourcedAction(LazyAction("sweep", "confound_matrix"), **TASK_BUDGETS["sweep confounds"], task=f"sweep confounds {id} {regressor_set}"), (), make_json_compatible({"tsv_path": tsv_path, "regressor_set": regressor_set, "out_path": confound_paths[regressor_set]}))],
+                "file_dep": make_json_compatible([tsv_path]),
+                "targets": make_json_compatible([confound_paths[regressor_set]]),
+            }
+
+        for variant in variants:
+            out_dir = sweep_dir / variant["name"] / f"sub-{id}"
+            kwargs = {
+                "series_path": series_paths[variant["blur"]],
+                "events_tsv": events_tsv,
+                "confounds_path": confound_paths[variant["regressors"]],
+                "out_dir": out_dir,
+                "subject_id": id,
+                "basis": variant["basis"],
+                "remove_first_trs": variant["remove_first_trs"],
+            }
+            yield {
+                "basename": f"sweep glm {id} {variant['name']}",
+                "actions": [(ResourcedAction(LazyAction("sweep", "fit"), **TASK_BUDGETS["sweep glm"], task=f"sweep glm {id} {variant['name']}"), (), make_json_compatible(kwargs))],
+                "file_dep": make_json_compatible([kwargs["series_path"], kwargs["events_tsv"], kwargs["confounds_path"]]),
+                "targets": make_json_compatible([out_dir / f"sub-{id}_bold_deconvolved.nii", out_dir / f"sub-{id}_bold_IRF.nii"]),
+            }
+
+    manifest = [dict(variant, out_dir=str(sweep_dir / variant["name"]), subjects=DOIT_CONFIG["subject ids"]) for variant in variants]
+    yield {
+        "basename": "sweep manifest",
+        "actions": [(LazyAction("sweep", "write_manifest"), (manifest, str(sweep_dir / "manifest.json")), {})],
+        "targets": [str(sweep_dir / "manifest.json")],
+        "uptodate": [config_changed(json.dumps(manifest))],
+    }
+
+def _longest_first(basename: str) -> List[str]:
+    """
+    Returns our subject ids sorted so the one whose "<basename> <id>" task is predicted to take longest comes first.
+    """
+    tasks = {f"{basename} {id}": id for id in DOIT_CONFIG["subject ids"]}
+    return [tasks[task] for task in HISTORY.longest_first(tasks)]
+
+def _repetition_time() -> Optional[float]:
+    """
+    Returns the repetition time in seconds given on the command line like "doit tr=2", or None to read it from each image.
+    """
+    repetition_time = get_var("tr")
+    return float(repetition_time) if repetition_time else None
+
+def _variant_name(variant: Dict) -> str:
+    """
+    Returns a directory name describing the settings of a sweep variant, like blur-4_basis-CSPLINzero-0-18-10_trs-1_regressors-all.
+    """
+    basis = variant["basis"].translate(str.maketrans("(,", "--", ")"))
+    return f"blur-{variant['blur']:g}_basis-{basis}_trs-{variant['remove_first_trs']}_regressors-{variant['regressors']}"
+
 def make_json_compatible(data: Any) -> Any:
     """
     Makes your data json compatible. How? It converts any non-serializable object into a string.
@@ -129,7 +306,7 @@ def make_json_compatible(data: Any) -> Any:
         """
         Returns true if an object is an iterable but not a string.
         """
-        return isinstance(data, collections.Iterable) and not isinstance(data, six.string_types)
+        return isinstance(data, collections.abc.Iterable) and not isinstance(data, six.string_types)
     def is_jsonable(item: Any) -> bool:
         """
         Returns true if an object is json serializable.
@@ -210,12 +387,12 @@ def the_path_that_matches(pattern: str, in_directory: PathLike) -> Path:
         If in_directory isn't a directory.
     """
 
-    matches = list(Path(in_directory).glob(pattern))
-
     if not Path(in_directory).is_dir():
         raise NotADirectoryError(f"{in_directory} either doesn't exist or isn't a directory at all!")
 
-    elif(len(matches)) > 1:
+    matches = list(Path(in_directory).glob(pattern))
+
+    if(len(matches)) > 1:
         raise IOError(f"The directory {in_directory} exists but contains more than one path that matches '{pattern}': {matches}")
 
     elif(len(matches)) == 0:
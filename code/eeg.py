@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Class to read the signal of a BrainVision .eeg file without loading it into memory.
+"""
+
+from pathlib import Path
+import numpy
+from dataclasses import dataclass
+from os import PathLike
+from functools import cached_property
+from typing import Iterable, Optional, Union
+
+from vhdr import Vhdr
+
+@dataclass
+class Eeg():
+    """
+    Class to read the signal of a BrainVision .eeg file without loading it into memory.
+
+    Parameters
+    ----------
+    input_path : str or Path
+        Path to the .vhdr file describing the recording.
+
+    Attributes
+    ----------
+    path : Path
+        Path to the .vhdr file.
+    header : Vhdr
+        Header of the recording.
+    raw : memmap
+        The unscaled values of the .eeg file, indexed as [channel, sample]. Nothing is read until you slice it.
+    """
+    path: PathLike
+
+    def __post_init__(self):
+        self.path = Path(self.path).absolute()
+
+    @cached_property
+    def header(self) -> Vhdr:
+        """
+        Returns the header of the recording.
+        """
+        return Vhdr(self.path)
+
+    @cached_property
+    def raw(self) -> numpy.ndarray:
+        """
+        Maps the .eeg file into memory and returns it as an array indexed as [channel, sample].
+
+        Multiplexed files are stored as [sample, channel], so we return a transposed view of them. Nothing is copied.
+        """
+        dtype = self.header.binary_format
+        channel_count = self.header.channel_count
+        sample_count = self.header.data_path.stat().st_size // (dtype.itemsize * channel_count)
+
+        if self.header.orientation == "MULTIPLEXED":
+            return numpy.memmap(self.header.data_path, dtype=dtype, mode="r", shape=(sample_count, channel_count)).T
+        elif self.header.orientation == "VECTORIZED":
+            return numpy.memmap(self.header.data_path, dtype=dtype, mode="r", shape=(channel_count, sample_count))
+        else:
+            raise ValueError(f"{self.path} uses unsupported orientation {self.header.orientation}")
+
+    @cached_property
+    def sample_count(self) -> int:
+        """
+        Returns the number of samples recorded for each channel.
+        """
+        return self.raw.shape[1]
+
+    @cached_property
+    def channel_names(self) -> list:
+        """
+        Returns the name of each channel in the order they're stored.
+        """
+        return self.header.channels["name"].tolist()
+
+    @cached_property
+    def sampling_rate(self) -> float:
+        """
+        Returns the number of samples per second.
+        """
+        return self.header.sampling_rate
+
+    def channel_indices(self, channels: Optional[Iterable[Union[int, str]]]=None) -> numpy.ndarray:
+        """
+        Converts a list of channel names and/or indices into indices. None means every channel.
+        """
+        if channels is None:
+            return numpy.arange(self.header.channel_count)
+
+        indices = []
+        for channel in channels:
+            if isinstance(channel, str):
+                try:
+                    indices.append(self.channel_names.index(channel))
+                except ValueError:
+                    raise KeyError(f"{self.path} has no channel named {channel}")
+            else:
+                indices.append(int(channel))
+
+        return numpy.asarray(indices, dtype=numpy.intp)
+
+    def read(self, channels: Optional[Iterable[Union[int, str]]]=None, start: int=0, stop: Optional[int]=None, dtype=numpy.float32) -> numpy.ndarray:
+        """
+        Reads a block of the recording and returns it in its physical unit, usually µV.
+
+        Only the requested channels and samples are read from disk and scaled.
+
+        Parameters
+        ----------
+        channels : list of str or int, optional
+            Names or indices of the channels to read. Reads every channel by default.
+        start : int
+            First sample to read.
+        stop : int, optional
+            Sample to stop reading at. Reads until the end by default.
+        dtype : numpy type
+            Type of the returned array.
+
+        Returns
+        -------
+        ndarray
+            Array indexed as [channel, sample].
+        """
+        indices = self.channel_indices(channels)
+        block = numpy.asarray(self.raw[indices, start:stop], dtype=dtype)
+        block *= self.header.channels["resolution"][indices, numpy.newaxis].astype(dtype)
+
+        return block
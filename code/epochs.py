@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Cut a memory-mapped EEG recording into trials around the stimulus markers of its .vmrk file.
+"""
+# Import external libraries and modules.
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+import argparse
+import json
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Import CSEA libraries and modules.
+from decimate import decimate_array
+from eeg import Eeg
+from resources import allotted_cores
+from vmrk import Vmrk
+
+@dataclass
+class Epochs():
+    """
+    Class to cut a memory-mapped EEG recording into trials.
+
+    Parameters
+    ----------
+    eeg : Eeg
+        The recording.
+    vmrk : Vmrk
+        Markers of the recording.
+    tmin : float
+        Start of each trial in seconds relative to its marker.
+    tmax : float
+        End of each trial in seconds relative to its marker.
+    marker_codes : sequence of str
+        Marker descriptions that count as trial onsets.
+
+    Attributes
+    ----------
+    windows : ndarray
+        Read-only view of the recording indexed as [channel, first sample, sample]. Every possible window is
+        available without copying anything.
+    starts : ndarray
+        First sample of each trial that fits inside the recording.
+    trials : ndarray
+        Index of each of those trials among all the markers matching marker_codes.
+    """
+    eeg: Eeg
+    vmrk: Vmrk
+    tmin: float = -0.5
+    tmax: float = 3.0
+    marker_codes: Sequence[str] = (Vmrk.ONSET_CODE,)
+
+    @cached_property
+    def offset(self) -> int:
+        """
+        Returns the number of samples between the start of a trial and its marker.
+        """
+        return int(round(self.tmin * self.eeg.sampling_rate))
+
+    @cached_property
+    def length(self) -> int:
+        """
+        Returns the number of samples in each trial.
+        """
+        return int(round(self.tmax * self.eeg.sampling_rate)) - self.offset
+
+    @cached_property
+    def times(self) -> numpy.ndarray:
+        """
+        Returns the time of each sample of a trial in seconds relative to its marker.
+        """
+        return (numpy.arange(self.length) + self.offset) / self.eeg.sampling_rate
+
+    @cached_property
+    def windows(self) -> numpy.ndarray:
+        """
+        Returns a strided view of the recording indexed as [channel, first sample, sample].
+        """
+        return sliding_window_view(self.eeg.raw, self.length, axis=1)
+
+    @cached_property
+    def trials(self) -> numpy.ndarray:
+        """
+        Returns the index of each trial that fits inside the recording.
+        """
+        starts = self._all_starts
+        fits = (starts >= 0) & (starts + self.length <= self.eeg.sample_count)
+        if not fits.all():
+            print(f"Leaving out {numpy.count_nonzero(~fits)} trials of {self.vmrk.path} that don't fit inside the recording")
+
+        return numpy.flatnonzero(fits)
+
+    @cached_property
+    def starts(self) -> numpy.ndarray:
+        """
+        Returns the first sample of each trial. Trials that don't fit inside the recording are left out.
+        """
+        return self._all_starts[self.trials]
+
+    @cached_property
+    def _all_starts(self) -> numpy.ndarray:
+        """
+        Returns the first sample of every trial, whether it fits inside the recording or not.
+
+        Marker positions are counted from 1, samples from 0.
+        """
+        return self.vmrk.positions_for(self.marker_codes) - 1 + self.offset
+
+    def __len__(self) -> int:
+        return self.starts.size
+
+    def __getitem__(self, trial: int) -> numpy.ndarray:
+        """
+        Returns a read-only, unscaled view of one trial indexed as [channel, sample]. Nothing is copied.
+        """
+        return self.windows[:, self.starts[trial]]
+
+    def to_array(self, channels: Optional[Iterable]=None, baseline: Optional[Tuple[float, float]]=None, decimate: int=1, dtype=numpy.float32) -> numpy.ndarray:
+        """
+        Reads every trial into memory in its physical unit. Returns an array indexed as [channel, trial, sample].
+
+        Parameters
+        ----------
+        channels : list of str or int, optional
+            Names or indices of the channels to read. Reads every channel by default.
+        baseline : (float, float), optional
+            Time window in seconds relative to the marker. Its mean is subtracted from each trial and channel.
+        decimate : int
+            Keep one sample out of this many, starting with the first. Trials go through the same anti-aliasing
+            filter as decimate.py first, which doesn't shift them in time.
+        dtype : numpy type
+            Type of the returned array.
+        """
+        indices = self.eeg.channel_indices(channels)
+        epochs = numpy.asarray(self.windows[indices[:, numpy.newaxis], self.starts], dtype=dtype)
+        epochs *= self.eeg.header.channels["resolution"][indices, numpy.newaxis, numpy.newaxis].astype(dtype)
+
+        if baseline is not None:
+            in_baseline = (self.times >= baseline[0]) & (self.times <= baseline[1])
+            epochs -= epochs[..., in_baseline].mean(axis=-1, keepdims=True)
+
+        if decimate > 1:
+            epochs = decimate_array(epochs, decimate)
+
+        return epochs
+
+def main(vhdr_paths: Iterable[PathLike], out_dir: PathLike, tmin: float=-0.5, tmax: float=3.0, baseline: Optional[Tuple[float, float]]=None, decimate: int=1, processes: Optional[int]=None) -> Dict[str, str]:
+    """
+    Epochs many recordings at once in a process pool.
+
+    Writes <out_dir>/<recording>_epochs.npy as float32 indexed as [channel, trial, sample], plus a .json
+    sidecar describing its axes. Returns a dict mapping each .vhdr file to its epochs.
+    """
+    out_dir = Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    vhdr_paths = [str(Path(path).resolve()) for path in vhdr_paths]
+
+    with ProcessPoolExecutor(processes or allotted_cores()) as pool:
+        futures = [pool.submit(write_epochs, path, out_dir, tmin, tmax, baseline, decimate) for path in vhdr_paths]
+        out_paths = [future.result() for future in futures]
+
+    return {vhdr_path: str(out_path) for vhdr_path, out_path in zip(vhdr_paths, out_paths)}
+
+def write_epochs(vhdr_path: PathLike, out_dir: PathLike, tmin: float=-0.5, tmax: float=3.0, baseline: Optional[Tuple[float, float]]=None, decimate: int=1) -> Path:
+    """
+    Epochs one recording and writes its trials and their sidecar into out_dir.
+    """
+    eeg = Eeg(vhdr_path)
+    epochs = Epochs(eeg, Vmrk(eeg.header.marker_path), tmin, tmax)
+    out_path = Path(out_dir) / f"{eeg.path.stem}_epochs.npy"
+
+    numpy.save(out_path, epochs.to_array(baseline=baseline, decimate=decimate))
+
+    sidecar = {
+        "Dimensions": ["channel", "trial", "sample"],
+        "Channels": eeg.channel_names,
+        "SamplingFrequency": eeg.sampling_rate / decimate,
+        "EpochStart": float(epochs.times[0]),
+        "Trials": epochs.trials.tolist(),
+        "TrialSamples": epochs.starts.tolist(),
+        "Baseline": baseline,
+    }
+    with open(out_path.with_suffix(".json"), "w") as out_file:
+        json.dump(sidecar, out_file, indent="\t")
+
+    print(f"Wrote {len(epochs)} trials of {vhdr_path} to {out_path}")
+    return out_path
+
+def read_epochs(path: PathLike) -> Tuple[numpy.ndarray, Dict]:
+    """
+    Maps epochs written by write_epochs into memory. Returns them along with their sidecar.
+    """
+    path = Path(path)
+    with open(path.with_suffix(".json")) as in_file:
+        sidecar = json.load(in_file)
+
+    return numpy.load(path, mmap_mode="r"), sidecar
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Epoch BrainVision recordings around their stimulus markers.")
+    parser.add_argument("vhdr_paths", nargs="+", help="The .vhdr files of the recordings.")
+    parser.add_argument("--out-dir", required=True, help="Directory to write epochs to.")
+    parser.add_argument("--tmin", type=float, default=-0.5, help="Start of each trial in seconds relative to its marker.")
+    parser.add_argument("--tmax", type=float, default=3.0, help="End of each trial in seconds relative to its marker.")
+    parser.add_argument("--baseline", type=float, nargs=2, default=None, help="Baseline window in seconds relative to the marker.")
+    parser.add_argument("--decimate", type=int, default=1, help="Keep one sample out of this many.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args()
+
+    main(args.vhdr_paths, args.out_dir, args.tmin, args.tmax, args.baseline, args.decimate, args.processes)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Class to join the markers of a .vmrk file with the trials of a .dat file into a table of events.
+
+The table can be written as a BIDS events.tsv or as one AFNI stim_times file per condition.
+"""
+# Import external libraries and modules.
+from dataclasses import dataclass, field
+from functools import cached_property
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Sequence
+import numpy
+
+# Import CSEA libraries and modules.
+from vmrk import Vmrk
+from dat import Dat
+
+@dataclass
+class Events():
+    """
+    Class to join the markers of a .vmrk file with the trials of a .dat file.
+
+    The nth marker matching any of marker_codes is paired with the nth row of the .dat file.
+
+    Parameters
+    ----------
+    vmrk : Vmrk
+        Markers recorded during the scan.
+    dat : Dat
+        Trials recorded by the stimulus computer.
+    marker_codes : sequence of str
+        Marker descriptions that count as trial onsets.
+    condition_names : mapping
+        Maps each condition code of the .dat file to the name of its condition.
+    default_condition : str, optional
+        Condition name of any condition code missing from condition_names. If None, the code itself is used.
+    repetition_time : float, optional
+        If given, onsets are locked to the train of fMRI volume markers instead of to the EEG clock. This corrects
+        any drift between the EEG amplifier and the scanner.
+
+    Attributes
+    ----------
+    table : ndarray
+        Structured array with fields onset, duration, trial_type and marker. One row per trial.
+    """
+    vmrk: Vmrk
+    dat: Dat
+    marker_codes: Sequence[str] = (Vmrk.ONSET_CODE,)
+    condition_names: Mapping = field(default_factory=dict)
+    default_condition: Optional[str] = None
+    repetition_time: Optional[float] = None
+
+    @cached_property
+    def table(self) -> numpy.ndarray:
+        """
+        Returns one row per trial containing its onset, duration, condition and marker.
+        """
+        positions = self.vmrk.positions_for(self.marker_codes)
+        durations = numpy.asarray(self.dat.durations, dtype=numpy.float64)
+        if positions.size != durations.size:
+            raise ValueError(f"{self.vmrk.path} has {positions.size} markers matching {list(self.marker_codes)} but {self.dat.path} has {durations.size} trials")
+
+        if self.repetition_time is None:
+            onsets = self.vmrk.seconds_from_start(positions)
+        else:
+            onsets = self._tr_locked(positions)
+
+        table = numpy.empty(positions.size, dtype=[("onset", numpy.float64), ("duration", numpy.float64), ("trial_type", "U64"), ("marker", "U32")])
+        table["onset"] = onsets
+        table["duration"] = durations
+        table["trial_type"] = self._trial_types()
+        table["marker"] = self.vmrk.descriptions_for(self.marker_codes)
+
+        return table
+
+    @cached_property
+    def conditions(self) -> numpy.ndarray:
+        """
+        Returns the name of each condition found in the table, sorted.
+        """
+        return numpy.unique(self.table["trial_type"])
+
+    def write_tsv(self, path: PathLike, add_to_onsets: float=0) -> Path:
+        """
+        Writes the table as a BIDS events.tsv.
+
+        You may also optionally specify a value for add_to_onsets that will then be added to all onsets.
+        """
+        path = Path(path)
+        rows = self.table[["onset", "duration", "trial_type"]].copy()
+        rows["onset"] += add_to_onsets
+        numpy.savetxt(path, rows, fmt="%.4f\t%.4f\t%s", header="onset\tduration\ttrial_type", comments="")
+
+        return path
+
+    def write_stim_times(self, out_dir: PathLike, add_to_onsets: float=0) -> Dict[str, Path]:
+        """
+        Writes one AFNI stim_times file per condition into out_dir. Returns a dict mapping each condition to its file.
+
+        Each file holds the onsets of its condition on a single line, which AFNI reads as a single run.
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        paths = {}
+        for condition in self.conditions:
+            onsets = self.table["onset"][self.table["trial_type"] == condition] + add_to_onsets
+            paths[str(condition)] = out_dir / f"stim_times_{condition}.1D"
+            numpy.savetxt(paths[str(condition)], onsets[numpy.newaxis], fmt="%.4f")
+
+        return paths
+
+    def _trial_types(self) -> numpy.ndarray:
+        """
+        Returns the condition name of each trial in the .dat file.
+        """
+        unique_codes, inverse = numpy.unique(self.dat.dataframe["condition"].to_numpy(), return_inverse=True)
+        names = [self.condition_names.get(code, self.default_condition if self.default_condition is not None else str(code)) for code in unique_codes.tolist()]
+
+        return numpy.asarray(names)[inverse.ravel()]
+
+    def _tr_locked(self, positions: numpy.ndarray) -> numpy.ndarray:
+        """
+        Converts raw positions into seconds since the first fMRI volume using the volume markers as the clock.
+
+        Fits a line through the position of every volume marker against its volume number. Missing volume markers
+        are tolerated because each volume number is recovered from the typical spacing between markers.
+        """
+        volumes = self.vmrk.volume_positions
+        if volumes.size < 2:
+            raise LookupError(f"Need at least two fMRI volume markers in {self.vmrk.path} to lock onsets to the scanner.")
+
+        spacing = numpy.median(numpy.diff(volumes))
+        volume_numbers = numpy.rint((volumes - volumes[0]) / spacing)
+        samples_per_volume, first_volume = numpy.polyfit(volume_numbers, volumes, deg=1)
+
+        return numpy.round((positions - first_volume) / samples_per_volume * self.repetition_time, 4)
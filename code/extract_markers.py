@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Extract the markers and trials of every subject into a single columnar cache.
+
+Each .vmrk and .dat file is parsed by Vmrk and Dat in a process pool. The results are stored together in one .npz
+file, one array per column. Files whose size and mtime haven't changed since the last run are taken straight from
+the cache instead of being parsed again. A .vmrk file also counts as changed when the .vhdr next to it does, since the
+sampling rate that converts its markers to seconds comes from there.
+
+Replaces raw/misc/get_contrascantimes.py.
+"""
+# Import external libraries and modules.
+from concurrent.futures import ProcessPoolExecutor
+from os import PathLike
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import argparse
+import numpy
+
+# Import CSEA libraries and modules.
+from vmrk import Vmrk
+from dat import Dat
+
+SUBJECTS_DIR = Path(__file__).resolve().parent.parent / "raw" / "subjects-complete"
+CACHE_PATH = Path(__file__).resolve().parent.parent / "outputs" / "markers.npz"
+
+# Version of the layout of the cache. Bump it whenever COLUMNS or what goes into them changes, so old caches are rebuilt.
+CACHE_VERSION = 2
+
+# Columns of each table in the cache and their types.
+COLUMNS = {
+    "markers": {"path": str, "subject": str, "number": numpy.int32, "type": str, "description": str, "position": numpy.int64, "size": numpy.int32, "channel": numpy.int16, "special": str, "seconds": numpy.float64},
+    "trials": {"path": str, "subject": str, "trial_code": numpy.int16, "condition": numpy.int16, "duration": numpy.float64},
+}
+
+def main(subjects_dir: PathLike=SUBJECTS_DIR, cache_path: PathLike=CACHE_PATH, processes: Optional[int]=None) -> Dict[str, Dict[str, numpy.ndarray]]:
+    """
+    Refreshes the cache and returns its tables.
+    """
+    tables = load(subjects_dir, cache_path, processes)
+    print(f"Cached {tables['files']['path'].size} files from {Path(subjects_dir).resolve()} in {Path(cache_path).resolve()}")
+
+    return tables
+
+def load(subjects_dir: PathLike=SUBJECTS_DIR, cache_path: PathLike=CACHE_PATH, processes: Optional[int]=None) -> Dict[str, Dict[str, numpy.ndarray]]:
+    """
+    Returns the tables "files", "markers" and "trials" for every subject. Each table is a dict of equal-length columns.
+
+    Only files that are new or have changed since the cache was written get parsed. The cache is rewritten if
+    anything changed.
+
+    Parameters
+    ----------
+    subjects_dir : str or Path
+        Directory containing one sub-<id> directory per subject.
+    cache_path : str or Path
+        Where to keep the cache.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    """
+    cache_path = Path(cache_path)
+    paths = sorted(Path(subjects_dir).resolve().glob("sub-*/*.vmrk")) + sorted(Path(subjects_dir).resolve().glob("sub-*/*.dat"))
+    stats = [path.stat() for path in paths]
+    vhdr_stats = [_vhdr_stat(path) for path in paths]
+    files = {
+        "path": numpy.array([str(path) for path in paths], dtype=str),
+        "subject": numpy.array([path.parent.name[len("sub-"):] for path in paths], dtype=str),
+        "size": numpy.array([stat.st_size for stat in stats], dtype=numpy.int64),
+        "mtime": numpy.array([stat.st_mtime_ns for stat in stats], dtype=numpy.int64),
+        "vhdr_size": numpy.array([size for size, _ in vhdr_stats], dtype=numpy.int64),
+        "vhdr_mtime": numpy.array([mtime for _, mtime in vhdr_stats], dtype=numpy.int64),
+    }
+
+    cached = _read(cache_path)
+    fresh = _unchanged(files, cached["files"]) if cached else numpy.zeros(len(paths), dtype=bool)
+    stale_paths = files["path"][~fresh].tolist()
+    if cached and not stale_paths and len(paths) == cached["files"]["path"].size:
+        return cached
+
+    with ProcessPoolExecutor(processes) as pool:
+        parsed = dict(zip(stale_paths, pool.map(_parse, stale_paths)))
+
+    tables = {"files": files}
+    for name in ("markers", "trials"):
+        pieces = [_empty(name)]
+        for path in files["path"].tolist():
+            if path in parsed:
+                pieces.append(parsed[path][name])
+            elif cached:
+                pieces.append({column: values[cached[name]["path"] == path] for column, values in cached[name].items()})
+        tables[name] = {column: numpy.concatenate([piece[column] for piece in pieces]) for column in COLUMNS[name]}
+
+    _write(cache_path, tables)
+
+    return tables
+
+def onsets(tables: Dict[str, Dict[str, numpy.ndarray]], subject_id: str, code: str=Vmrk.ONSET_CODE) -> numpy.ndarray:
+    """
+    Returns the onsets in seconds of one subject's markers matching code, adjusted to the start of the fMRI scan.
+    """
+    markers = tables["markers"]
+    mask = (markers["subject"] == subject_id) & (markers["description"] == code)
+
+    return markers["seconds"][mask]
+
+def write_onsets(tables: Dict[str, Dict[str, numpy.ndarray]], out_dir: PathLike) -> List[Path]:
+    """
+    Writes the stimulus onsets of each subject into <out_dir>/sub-<id>.onsets.txt, one onset per line.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+    for subject_id in numpy.unique(tables["markers"]["subject"]).tolist():
+        paths.append(out_dir / f"sub-{subject_id}.onsets.txt")
+        numpy.savetxt(paths[-1], onsets(tables, subject_id), fmt="%.4f")
+
+    return paths
+
+def _parse(path: str) -> Dict[str, Dict[str, numpy.ndarray]]:
+    """
+    Parses a single .vmrk or .dat file into rows of the markers and trials tables.
+    """
+    subject_id = Path(path).parent.name[len("sub-"):]
+    markers, trials = _empty("markers"), _empty("trials")
+
+    if path.endswith(".vmrk"):
+        vmrk = Vmrk(path)
+        markers = {column: vmrk.markers[column] for column in vmrk.markers.dtype.names}
+        try:
+            markers["seconds"] = vmrk.seconds_from_start(vmrk.markers["position"])
+        except LookupError:
+            markers["seconds"] = numpy.full(vmrk.markers.size, numpy.nan)
+        length = vmrk.markers.size
+        markers["path"] = numpy.full(length, path)
+        markers["subject"] = numpy.full(length, subject_id)
+    else:
+        dat = Dat(path)
+        trials["trial_code"] = dat.trial_numbers
+        trials["condition"] = dat.dataframe["condition"].to_numpy()
+        trials["duration"] = dat.durations
+        length = trials["duration"].size
+        trials["path"] = numpy.full(length, path)
+        trials["subject"] = numpy.full(length, subject_id)
+
+    return {"markers": markers, "trials": trials}
+
+def _empty(table: str) -> Dict[str, numpy.ndarray]:
+    """
+    Returns a table with no rows.
+    """
+    return {column: numpy.empty(0, dtype=dtype) for column, dtype in COLUMNS[table].items()}
+
+def _unchanged(files: Dict[str, numpy.ndarray], cached_files: Dict[str, numpy.ndarray]) -> numpy.ndarray:
+    """
+    Returns a mask of the files whose path, size and mtime, and those of their .vhdr, all match an entry of the cache.
+    """
+    keys = ("path", "size", "mtime", "vhdr_size", "vhdr_mtime")
+    previous = set(zip(*(cached_files[key].tolist() for key in keys)))
+    current = zip(*(files[key].tolist() for key in keys))
+
+    return numpy.array([entry in previous for entry in current], dtype=bool)
+
+def _vhdr_stat(path: Path) -> Tuple[int, int]:
+    """
+    Returns the size and mtime of the .vhdr next to a .vmrk file, or (-1, -1) if there's none or path isn't a .vmrk file.
+    """
+    vhdr_path = path.with_suffix(".vhdr")
+    if path.suffix != ".vmrk" or not vhdr_path.exists():
+        return -1, -1
+    stat = vhdr_path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+def _read(cache_path: Path) -> Optional[Dict[str, Dict[str, numpy.ndarray]]]:
+    """
+    Reads the cache into tables of columns. Returns None if there's no usable cache, including one written with another
+    CACHE_VERSION.
+    """
+    if not cache_path.exists():
+        return None
+
+    tables = {"meta": {}, "files": {}, "markers": {}, "trials": {}}
+    try:
+        with numpy.load(cache_path) as archive:
+            for key in archive.files:
+                table, column = key.split(".", 1)
+                tables[table][column] = archive[key]
+    except (OSError, ValueError, KeyError):
+        print(f"Ignoring unreadable cache {cache_path}")
+        return None
+
+    version = tables.pop("meta").get("version")
+    if version is None or int(version) != CACHE_VERSION:
+        print(f"Ignoring cache {cache_path} written by another version of {Path(__file__).name}")
+        return None
+
+    return tables
+
+def _write(cache_path: Path, tables: Dict[str, Dict[str, numpy.ndarray]]) -> None:
+    """
+    Writes tables of columns into the cache. Each column becomes its own array named <table>.<column>.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = cache_path.with_name(cache_path.name + ".partial")
+    with partial_path.open("wb") as cache_file:
+        numpy.savez(cache_file, **{"meta.version": numpy.array(CACHE_VERSION)}, **{f"{table}.{column}": values for table, columns in tables.items() for column, values in columns.items()})
+    partial_path.replace(cache_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the markers and trials of every subject into a single columnar cache.")
+    parser.add_argument("--subjects-dir", default=SUBJECTS_DIR, help="Directory containing one sub-<id> directory per subject.")
+    parser.add_argument("--cache", default=CACHE_PATH, help="Path of the .npz cache.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--onsets-dir", default=None, help="Also write each subject's stimulus onsets into this directory.")
+    args = parser.parse_args()
+
+    tables = main(args.subjects_dir, args.cache, args.processes)
+    if args.onsets_dir:
+        for path in write_onsets(tables, args.onsets_dir):
+            print(f"Wrote onsets to {path}")
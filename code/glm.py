@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Fit a voxelwise GLM in-process, as an alternative to running 3dDeconvolve.
+
+The design matrix is built and factored once. The voxels of a MaskedSeries are then solved in blocks spread across
+a process pool. Outputs follow the layout of 3dDeconvolve -fout -bucket -iresp: the bucket holds Full_Fstat, then
+the coefficients and F-statistic of each stimulus, and the IRF holds each stimulus's estimated response sampled
+every TR.
+
+Stimulus bases are written the way 3dDeconvolve spells them, like CSPLINzero(0,18,10). TENT, TENTzero, CSPLIN and
+CSPLINzero are supported.
+"""
+# Import external libraries and modules.
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
+from os import PathLike
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import argparse
+import json
+import math
+import re
+import numpy
+import pandas
+
+# Import CSEA libraries and modules.
+from confounds import read_matrix
+from masked import MaskedSeries
+from resources import allotted_cores
+
+BASIS_PATTERN = re.compile(r"^(TENT|TENTzero|CSPLIN|CSPLINzero)\(([^,]+),([^,]+),([^,]+)\)$")
+
+@dataclass
+class Basis():
+    """
+    Class to evaluate a 3dDeconvolve tent or cardinal cubic spline response basis.
+
+    Parameters
+    ----------
+    name : str
+        TENT, TENTzero, CSPLIN or CSPLINzero.
+    start : float
+        Seconds after the stimulus where the response starts.
+    stop : float
+        Seconds after the stimulus where the response stops.
+    knot_count : int
+        Number of knots from start to stop. The zero variants drop the first and last knot, which forces the
+        response to zero there.
+
+    Attributes
+    ----------
+    knots : numpy.ndarray
+        Time of each knot that gets its own parameter, in seconds after the stimulus.
+    spacing : float
+        Seconds between neighbouring knots.
+    """
+    name: str
+    start: float
+    stop: float
+    knot_count: int
+
+    @classmethod
+    def parse(cls, spec: str) -> "Basis":
+        """
+        Reads a basis spelled the way 3dDeconvolve spells it, like CSPLINzero(0,18,10).
+
+        Raises
+        ------
+        ValueError
+            If the basis isn't one we support.
+        """
+        match = BASIS_PATTERN.match(spec.replace(" ", ""))
+        if not match:
+            raise ValueError(f"Unsupported basis {spec!r}. Use TENT, TENTzero, CSPLIN or CSPLINzero.")
+
+        name, start, stop, knot_count = match.groups()
+        return cls(name, float(start), float(stop), int(knot_count))
+
+    def __str__(self) -> str:
+        return f"{self.name}({self.start:g},{self.stop:g},{self.knot_count})"
+
+    @cached_property
+    def spacing(self) -> float:
+        return (self.stop - self.start) / (self.knot_count - 1)
+
+    @cached_property
+    def knots(self) -> numpy.ndarray:
+        knots = self.start + self.spacing * numpy.arange(self.knot_count)
+        return knots[1:-1] if self.name.endswith("zero") else knots
+
+    def __call__(self, times: numpy.ndarray) -> numpy.ndarray:
+        """
+        Evaluates each basis function at times after the stimulus. Returns an array of shape (times, knots).
+
+        Every function is zero outside of start through stop.
+        """
+        times = numpy.asarray(times, dtype=numpy.float64)
+        distances = numpy.abs(times[:, numpy.newaxis] - self.knots) / self.spacing
+        if self.name.startswith("TENT"):
+            values = numpy.clip(1 - distances, 0, None)
+        else:
+            # Catmull-Rom kernel: the cardinal cubic spline that passes through each knot.
+            values = numpy.where(
+                distances <= 1,
+                1.5 * distances ** 3 - 2.5 * distances ** 2 + 1,
+                numpy.where(distances < 2, -0.5 * distances ** 3 + 2.5 * distances ** 2 - 4 * distances + 2, 0),
+            )
+        inside = (times >= self.start - 1e-9) & (times <= self.stop + 1e-9)
+
+        return values * inside[:, numpy.newaxis]
+
+    def grid(self, repetition_time: float) -> numpy.ndarray:
+        """
+        Returns the times at which 3dDeconvolve -iresp samples the response: every TR from start through stop.
+        """
+        return self.start + repetition_time * numpy.arange(int(math.floor((self.stop - self.start) / repetition_time + 1e-9)) + 1)
+
+@dataclass
+class Design():
+    """
+    Class to hold a GLM design matrix and its factorization.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        Array of shape (time points, columns).
+    labels : list of str
+        Label of each column.
+    stimuli : dict
+        Maps the label of each stimulus to the indices of its columns.
+
+    Attributes
+    ----------
+    pseudo_inverse : numpy.ndarray
+        Array of shape (columns, time points) turning a time series into coefficients.
+    covariance : numpy.ndarray
+        Unscaled covariance of the coefficients, (X'X)^-1.
+    degrees_of_freedom : int
+        Number of time points minus the rank of the design.
+    """
+    matrix: numpy.ndarray
+    labels: List[str]
+    stimuli: Dict[str, numpy.ndarray]
+
+    @cached_property
+    def _factored(self) -> Tuple[numpy.ndarray, numpy.ndarray, int]:
+        # Factor once with QR. Like 3dDeconvolve -GOFORIT, fall back to a pseudo-inverse if columns are collinear.
+        q, r = numpy.linalg.qr(self.matrix)
+        diagonal = numpy.abs(numpy.diag(r))
+        if diagonal.min() > diagonal.max() * 1e-10:
+            r_inverse = numpy.linalg.inv(r)
+            return r_inverse @ q.T, r_inverse @ r_inverse.T, self.matrix.shape[0] - self.matrix.shape[1]
+
+        print("Design matrix is rank deficient. Solving with a pseudo-inverse.")
+        pseudo_inverse = numpy.linalg.pinv(self.matrix)
+        rank = numpy.linalg.matrix_rank(self.matrix)
+        return pseudo_inverse, pseudo_inverse @ pseudo_inverse.T, self.matrix.shape[0] - rank
+
+    @property
+    def pseudo_inverse(self) -> numpy.ndarray:
+        return self._factored[0]
+
+    @property
+    def covariance(self) -> numpy.ndarray:
+        return self._factored[1]
+
+    @property
+    def degrees_of_freedom(self) -> int:
+        return self._factored[2]
+
+    def write(self, path: PathLike) -> Path:
+        """
+        Writes the design matrix as a .1D file with one row per time point, like 3dDeconvolve -x1D.
+        """
+        path = Path(path)
+        numpy.savetxt(path, self.matrix, fmt="%.6g", header=" ".join(self.labels))
+        return path
+
+def build_design(time_count: int, repetition_time: float, onsets: Dict[str, numpy.ndarray], basis: Basis, nuisance: Optional[pandas.DataFrame]=None, polort="A") -> Design:
+    """
+    Builds the design matrix: Legendre drift terms, then nuisance regressors, then the basis of each stimulus.
+
+    Parameters
+    ----------
+    time_count : int
+        Number of time points.
+    repetition_time : float
+        Seconds between time points.
+    onsets : dict
+        Maps the label of each stimulus to its onsets in seconds.
+    basis : Basis
+        Response basis shared by every stimulus.
+    nuisance : DataFrame
+        One column per nuisance regressor, one row per time point.
+    polort : int or "A"
+        Degree of the Legendre drift polynomial. "A" picks 1 + floor(duration / 150 s) like 3dDeconvolve.
+    """
+    if polort == "A":
+        polort = 1 + int(time_count * repetition_time // 150)
+
+    positions = numpy.linspace(-1, 1, time_count)
+    columns = [numpy.polynomial.legendre.legval(positions, numpy.eye(polort + 1)[degree]) for degree in range(polort + 1)]
+    labels = [f"Run#1Pol#{degree}" for degree in range(polort + 1)]
+
+    if nuisance is not None:
+        if len(nuisance) != time_count:
+            raise ValueError(f"Nuisance regressors have {len(nuisance)} rows but the image has {time_count} time points")
+        columns += [nuisance[name].to_numpy(dtype=numpy.float64) for name in nuisance]
+        labels += [f"{name}#0" for name in nuisance]
+
+    times = repetition_time * numpy.arange(time_count)
+    stimuli = {}
+    for label, stimulus_onsets in onsets.items():
+        response = sum((basis(times - onset) for onset in numpy.asarray(stimulus_onsets, dtype=numpy.float64)), numpy.zeros((time_count, basis.knots.size)))
+        stimuli[label] = numpy.arange(len(columns), len(columns) + basis.knots.size)
+        columns += list(response.T)
+        labels += [f"{label}#{i}" for i in range(basis.knots.size)]
+
+    return Design(numpy.column_stack(columns), labels, stimuli)
+
+def main(series_path: PathLike, events_tsv: PathLike, out_dir: PathLike, subject_id: str, confounds_path: Optional[PathLike]=None, basis: str="CSPLINzero(0,18,10)", polort="A", repetition_time: Optional[float]=None, block_voxels: int=4096, processes: Optional[int]=None, write_residuals: bool=False, remove_first_trs: int=0) -> Dict[str, str]:
+    """
+    Fits a GLM to every voxel of a MaskedSeries and writes the results as NIfTI images in out_dir.
+
+    Writes sub-<id>_bold_deconvolved.nii (the bucket), sub-<id>_bold_IRF.nii, optionally sub-<id>_bold_errts.nii,
+    and the design matrix as sub-<id>_design.1D. The sub-brick labels of the bucket go into a JSON sidecar.
+
+    Parameters
+    ----------
+    series_path : str or Path
+        MaskedSeries saved as .npy, like the scaled series smooth_scale.py keeps.
+    events_tsv : str or Path
+        BIDS events file. All onsets are modelled as a single stimulus labelled "all", like deconvolve.py does.
+    out_dir : str or Path
+        Directory to write outputs into.
+    subject_id : str
+        ID of the subject, used to name outputs.
+    confounds_path : str or Path
+        Nuisance matrix written by confounds.py.
+    basis : str
+        Response basis, spelled like 3dDeconvolve's -stim_times.
+    polort : int or "A"
+        Degree of the Legendre drift polynomial.
+    repetition_time : float
+        Seconds between volumes. Read from the image header if None.
+    block_voxels : int
+        Number of voxels each worker solves at once.
+    processes : int, optional
+        Number of worker processes. Defaults to the cores allotted to this task.
+    write_residuals : bool
+        Also write the residual time series, like 3dDeconvolve -errts.
+    remove_first_trs : int
+        Number of volumes to leave out of the fit from the start of the scan. Onsets are shifted to match.
+    """
+    out_dir = Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    series = MaskedSeries.load(series_path)
+    time_count = series.data.shape[1] - remove_first_trs
+    repetition_time = repetition_time or float(series.header.get_zooms()[3])
+    basis = Basis.parse(basis)
+
+    onsets = {"all": pandas.read_table(events_tsv, usecols=["onset"], dtype={"onset": numpy.float64})["onset"].to_numpy() - remove_first_trs * repetition_time}
+    nuisance = None
+    if confounds_path:
+        matrix, labels = read_matrix(confounds_path)
+        nuisance = pandas.DataFrame(matrix[remove_first_trs:], columns=labels)
+    design = build_design(time_count, repetition_time, onsets, basis, nuisance, polort)
+
+    bucket_labels = ["Full_Fstat"]
+    for label, columns in design.stimuli.items():
+        bucket_labels += [f"{label}#{i}_Coef" for i in range(columns.size)] + [f"{label}_Fstat"]
+    irf_times = basis.grid(repetition_time)
+
+    # Allocate outputs as memory-mapped masked series that the workers fill in.
+    out_paths = {
+        "bucket": out_dir / f"sub-{subject_id}_bold_deconvolved.nii",
+        "IRF": out_dir / f"sub-{subject_id}_bold_IRF.nii",
+    }
+    shapes = {"bucket": len(bucket_labels), "IRF": irf_times.size * len(design.stimuli)}
+    if write_residuals:
+        out_paths["errts"] = out_dir / f"sub-{subject_id}_bold_errts.nii"
+        shapes["errts"] = time_count
+    results = {key: MaskedSeries.empty(series.mask, series.header, shapes[key], out_dir / f"temp_{path.stem}.npy") for key, path in out_paths.items()}
+    for result in results.values():
+        result.data.flush()
+
+    # Factor the design here so every worker receives the factorization instead of redoing it.
+    design.pseudo_inverse
+    voxel_count = series.data.shape[0]
+    with ProcessPoolExecutor(processes or allotted_cores()) as pool:
+        futures = [
+            pool.submit(fit_block, Path(series_path).with_suffix(".npy"), {key: result.data.filename for key, result in results.items()}, design, basis(irf_times), first, min(first + block_voxels, voxel_count), remove_first_trs)
+            for first in range(0, voxel_count, block_voxels)
+        ]
+        for future in futures:
+            future.result()
+
+    for key, path in out_paths.items():
+        results[key].write(path, numpy.load(results[key].data.filename, mmap_mode="r"))
+        Path(results[key].data.filename).unlink()
+    sidecar = {
+        "SubBrickLabels": bucket_labels,
+        "Basis": str(basis),
+        "IRFTimes": irf_times.tolist(),
+        "DegreesOfFreedom": design.degrees_of_freedom,
+        "RepetitionTime": repetition_time,
+    }
+    with open(out_paths["bucket"].with_suffix(".json"), "w") as sidecar_file:
+        json.dump(sidecar, sidecar_file, indent="\t")
+    out_paths["design"] = design.write(out_dir / f"sub-{subject_id}_design.1D")
+
+    print(f"Fit {len(design.labels)} regressors to {voxel_count} voxels of {series_path}")
+    return {key: str(path) for key, path in out_paths.items()}
+
+def fit_block(series_path: PathLike, out_paths: Dict[str, str], design: Design, irf_basis: numpy.ndarray, first: int, last: int, skip: int=0) -> None:
+    """
+    Fits the design to voxels first through last - 1 and writes their results into the memory maps at out_paths.
+
+    The first skip volumes of each voxel are left out.
+    """
+    data = numpy.load(series_path, mmap_mode="r")[first:last, skip:].astype(numpy.float64)
+    betas = data @ design.pseudo_inverse.T
+    residuals = data - betas @ design.matrix.T
+    mean_square_error = numpy.einsum("vt,vt->v", residuals, residuals) / max(design.degrees_of_freedom, 1)
+
+    all_columns = numpy.concatenate(list(design.stimuli.values()))
+    bucket = [_f_statistic(betas, design.covariance, all_columns, mean_square_error)]
+    irfs = []
+    for columns in design.stimuli.values():
+        bucket += [betas[:, columns], _f_statistic(betas, design.covariance, columns, mean_square_error)]
+        irfs.append(betas[:, columns] @ irf_basis.T)
+
+    outputs = {"bucket": numpy.column_stack(bucket), "IRF": numpy.column_stack(irfs), "errts": residuals}
+    for key, path in out_paths.items():
+        out_file = numpy.load(path, mmap_mode="r+")
+        out_file[first:last] = outputs[key]
+        out_file.flush()
+
+def _f_statistic(betas: numpy.ndarray, covariance: numpy.ndarray, columns: numpy.ndarray, mean_square_error: numpy.ndarray) -> numpy.ndarray:
+    """
+    Returns the F-statistic testing whether the coefficients in columns are all zero, for each voxel.
+    """
+    subset = betas[:, columns]
+    extra_sum_of_squares = numpy.einsum("vi,ij,vj->v", subset, numpy.linalg.pinv(covariance[numpy.ix_(columns, columns)]), subset)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        f = extra_sum_of_squares / columns.size / mean_square_error
+
+    return numpy.nan_to_num(f, nan=0.0, posinf=0.0)[:, numpy.newaxis]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit a voxelwise GLM in-process, as an alternative to 3dDeconvolve.")
+    parser.add_argument("series_path", help="MaskedSeries saved as .npy.")
+    parser.add_argument("events_tsv", help="BIDS events file.")
+    parser.add_argument("--out-dir", required=True, help="Directory to write outputs into.")
+    parser.add_argument("--subject-id", required=True, help="ID of the subject.")
+    parser.add_argument("--confounds", default=None, help="Nuisance matrix written by confounds.py.")
+    parser.add_argument("--basis", default="CSPLINzero(0,18,10)", help="Response basis.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--errts", action="store_true", help="Also write residuals.")
+    parser.add_argument("--remove-first-trs", type=int, default=0, help="Number of volumes to leave out from the start.")
+    args = parser.parse_args()
+
+    main(args.series_path, args.events_tsv, args.out_dir, args.subject_id, args.confounds, args.basis, processes=args.processes, write_residuals=args.errts, remove_first_trs=args.remove_first_trs)
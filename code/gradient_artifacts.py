@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Remove the MR gradient artifact from EEG recorded inside the scanner.
+
+Each fMRI volume the scanner acquires leaves the same artifact in the EEG, starting at its R128 marker. We estimate
+the artifact of each volume as the average of the neighbouring volumes and subtract it. The recording is streamed a
+chunk of volumes at a time and runs of consecutive volumes are spread across a process pool, so memory use stays
+constant no matter how long the recording is.
+"""
+# Import external libraries and modules.
+from concurrent.futures import ProcessPoolExecutor
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Optional
+import argparse
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Import CSEA libraries and modules.
+from eeg import Eeg
+from resources import allotted_cores
+from vhdr import write_vhdr
+from vmrk import Vmrk, write_vmrk
+
+def main(vhdr_path: PathLike, out_dir: PathLike, template_volumes: int=21, chunk_volumes: int=64, processes: Optional[int]=None) -> Dict[str, str]:
+    """
+    Writes a copy of a recording with the gradient artifact removed into out_dir.
+
+    The copy keeps the name of the original and is stored as float32 in µV.
+
+    Parameters
+    ----------
+    vhdr_path : str or Path
+        Header of the recording to clean.
+    out_dir : str or Path
+        Directory to write the cleaned .vhdr, .vmrk and .eeg into.
+    template_volumes : int
+        Width in volumes of the window around each volume whose other volumes are averaged into its template. Must be
+        at least 2.
+    chunk_volumes : int
+        Number of volumes to clean at once.
+    processes : int, optional
+        Number of worker processes. Defaults to the cores allotted to this task.
+    """
+    if template_volumes < 2:
+        raise ValueError(f"template_volumes must be at least 2 so each template has a neighbour to average, not {template_volumes}.")
+
+    eeg = Eeg(vhdr_path)
+    vmrk = Vmrk(eeg.header.marker_path)
+    out_dir = Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_paths = {
+        "vhdr": out_dir / eeg.path.name,
+        "vmrk": out_dir / eeg.path.with_suffix(".vmrk").name,
+        "eeg": out_dir / eeg.path.with_suffix(".eeg").name,
+    }
+
+    # Allocate the cleaned recording on disk.
+    numpy.memmap(out_paths["eeg"], dtype="<f4", mode="w+", shape=(eeg.sample_count, eeg.header.channel_count)).flush()
+
+    volume_starts, volume_length = artifact_onsets(vmrk, eeg.sample_count)
+    processes = min(processes or allotted_cores(), volume_starts.size)
+
+    # Give each worker a run of consecutive volumes and the samples around them. Every worker then writes one contiguous
+    # block of the multiplexed file instead of sharing every page with the others.
+    parts = [part for part in numpy.array_split(numpy.arange(volume_starts.size), processes) if part.size]
+    bounds = [0] + [int(volume_starts[part[0]]) for part in parts[1:]] + [eeg.sample_count]
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [
+            pool.submit(clean_volumes, eeg.path, out_paths["eeg"], volume_starts, volume_length, part[0], part[-1] + 1, bounds[i], bounds[i + 1], template_volumes, chunk_volumes)
+            for i, part in enumerate(parts)
+        ]
+        for future in futures:
+            future.result()
+
+    channels = eeg.header.channels.copy()
+    channels["resolution"] = 1
+    write_vhdr(out_paths["vhdr"], out_paths["eeg"].name, out_paths["vmrk"].name, channels, eeg.header.sampling_interval)
+    write_vmrk(out_paths["vmrk"], vmrk.markers, out_paths["eeg"].name)
+
+    print(f"Removed the gradient artifact of {volume_starts.size} volumes from {eeg.path} into {out_paths['eeg']}")
+    return {key: str(path) for key, path in out_paths.items()}
+
+def artifact_onsets(vmrk: Vmrk, sample_count: int):
+    """
+    Returns the first sample of each volume's artifact and the number of samples every artifact lasts.
+
+    Every artifact is cut to the shortest distance between two volume markers, so no two of them overlap.
+    """
+    volume_starts = vmrk.volume_positions - 1
+    if volume_starts.size < 2:
+        raise LookupError(f"Need at least two fMRI volume markers in {vmrk.path} to remove the gradient artifact.")
+
+    volume_length = int(numpy.diff(volume_starts).min())
+    volume_starts = volume_starts[volume_starts + volume_length <= sample_count]
+
+    return volume_starts, volume_length
+
+def clean_volumes(vhdr_path: PathLike, out_path: PathLike, volume_starts: numpy.ndarray, volume_length: int, first_volume: int, last_volume: int, first_sample: int, last_sample: int, template_volumes: int=21, chunk_volumes: int=64, chunk_samples: int=1 << 18) -> None:
+    """
+    Removes the gradient artifact from volumes first_volume up to last_volume and writes samples first_sample up to
+    last_sample of every channel into out_path.
+
+    The sample range must hold all of those volumes. Samples outside of any volume are copied as they are. Templates
+    are built from every volume of the recording, not just this range.
+    """
+    eeg = Eeg(vhdr_path)
+    cleaned = numpy.memmap(out_path, dtype="<f4", mode="r+", shape=(eeg.sample_count, eeg.header.channel_count)).T
+    resolutions = eeg.header.channels["resolution"][:, numpy.newaxis].astype(numpy.float32)
+
+    # Copy the whole range first. The artifacts get overwritten below.
+    for start in range(first_sample, last_sample, chunk_samples):
+        stop = min(start + chunk_samples, last_sample)
+        cleaned[:, start:stop] = eeg.raw[:, start:stop] * resolutions
+
+    windows = sliding_window_view(eeg.raw, volume_length, axis=1)
+    half_width = template_volumes // 2
+    volume_count = volume_starts.size
+    volume_offsets = numpy.arange(volume_length)
+
+    for first in range(first_volume, last_volume, chunk_volumes):
+        last = min(first + chunk_volumes, last_volume)
+
+        # Read the chunk plus enough neighbouring volumes on each side to build every template.
+        read_first, read_last = max(first - half_width, 0), min(last + half_width, volume_count)
+        artifacts = windows[:, volume_starts[read_first:read_last]].astype(numpy.float32)
+        artifacts *= resolutions[..., numpy.newaxis]
+
+        # Average the neighbours of each volume using a running sum over volumes. Each volume is left out of its own
+        # template, otherwise the subtraction would take part of its real signal along with the artifact.
+        running_sum = numpy.zeros((eeg.header.channel_count, read_last - read_first + 1, volume_length), dtype=numpy.float64)
+        numpy.cumsum(artifacts, axis=1, out=running_sum[:, 1:])
+        volumes = numpy.arange(first, last)
+        lows = numpy.maximum(volumes - half_width, 0) - read_first
+        highs = numpy.minimum(volumes + half_width + 1, volume_count) - read_first
+        current = artifacts[:, first - read_first:last - read_first]
+        templates = (running_sum[:, highs] - running_sum[:, lows] - current) / (highs - lows - 1)[:, numpy.newaxis]
+
+        sample_indices = volume_starts[first:last, numpy.newaxis] + volume_offsets
+        cleaned[:, sample_indices] = current - templates
+
+    cleaned.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove the MR gradient artifact from EEG recorded inside the scanner.")
+    parser.add_argument("vhdr_path", help="Header of the recording to clean.")
+    parser.add_argument("--out-dir", required=True, help="Directory to write the cleaned recording into.")
+    parser.add_argument("--template-volumes", type=int, default=21, help="Width in volumes of the window each template is averaged over. The volume itself is left out.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args()
+
+    main(args.vhdr_path, args.out_dir, args.template_volumes, processes=args.processes)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Keep a history of how long every pipeline task takes, and use it to plan the next run.
+
+Each task run records its wall time, CPU time and peak memory in a local SQLite database. dodo.py starts the tasks it
+expects to take longest first, so a slow subject doesn't start last and stretch the whole batch. From the command line
+this module estimates when the pending tasks will finish and reports how each stage's runtime has trended.
+
+Only the standard library is imported here, since dodo.py reads the history to order tasks.
+"""
+# Import external libraries and modules.
+from contextlib import contextmanager
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+import argparse
+import datetime
+import heapq
+import itertools
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+HISTORY_PATH = Path(__file__).resolve().parent.parent / "outputs" / "runtime_history.sqlite"
+
+# Number of recent runs a prediction is based on.
+RECENT_RUNS = 5
+
+# Seconds we assume a task takes when neither it nor its stage has ever run.
+DEFAULT_SECONDS = 60.0
+
+# Peak memory in MB of the tools run inside each open record() block, innermost last. See note_child_peak().
+_child_peaks: List[float] = []
+
+class History():
+    """
+    Class to read and write the runtime history of our pipeline tasks.
+
+    Parameters
+    ----------
+    path : str or Path
+        Where the history database lives.
+    """
+
+    def __init__(self, path: PathLike=HISTORY_PATH):
+        self.path = Path(path)
+        self._connection = None
+
+    @contextmanager
+    def record(self, task: str, stage: str, cores: int=1) -> Iterator[None]:
+        """
+        Records the wall time, CPU time and peak memory of whatever runs inside the block as one run of task.
+
+        CPU time covers this process and every subprocess it waits for. Peak memory is the larger of this process's
+        peak during the block and that of the largest subprocess the block waited for. Both are measured per block,
+        so a big task doesn't inflate the peaks of the tasks a long-lived worker runs after it. Tools run through
+        tool_runner.py report their own peaks. Other subprocesses, like those of a process pool, only count when
+        they outgrow every subprocess this process waited for before.
+        """
+        started = time.time()
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_seconds()
+        start_children_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        _reset_peak_rss()
+        _child_peaks.append(0.0)
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = _cpu_seconds() - start_cpu
+            children_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            peak_mb = max(_peak_rss_mb(), _child_peaks.pop(), children_mb if children_mb > start_children_mb else 0.0)
+            with self.connection:
+                self.connection.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (task, stage, started, wall, cpu, peak_mb, cores, int(succeeded)))
+
+    def predicted_seconds(self, task: str, stage: Optional[str]=None) -> float:
+        """
+        Predicts the wall time of task from the median of its recent successful runs.
+
+        Falls back to the median of its stage, and then to DEFAULT_SECONDS.
+        """
+        for column, value in (("task", task), ("stage", stage)):
+            if value is None:
+                continue
+            rows = self.connection.execute(f"SELECT wall FROM runs WHERE {column} = ? AND succeeded = 1 ORDER BY started DESC LIMIT ?", (value, RECENT_RUNS)).fetchall()
+            if rows:
+                return statistics.median(row[0] for row in rows)
+
+        return DEFAULT_SECONDS
+
+    def longest_first(self, tasks: Iterable[str]) -> List[str]:
+        """
+        Returns the names of tasks sorted so the longest predicted ones come first.
+        """
+        return sorted(tasks, key=lambda task: -self.predicted_seconds(task, stage_of(task)))
+
+    def cores(self, stage: str) -> int:
+        """
+        Returns the cores the latest run of a stage was given, or 1 if it never ran.
+        """
+        row = self.connection.execute("SELECT cores FROM runs WHERE stage = ? ORDER BY started DESC LIMIT 1", (stage,)).fetchone()
+        return row[0] if row else 1
+
+    def runs(self, stage: Optional[str]=None) -> List[Tuple]:
+        """
+        Returns every run as (task, stage, started, wall, cpu, peak_mb, cores, succeeded), oldest first.
+        """
+        query = "SELECT * FROM runs" + (" WHERE stage = ?" if stage else "") + " ORDER BY started"
+        return self.connection.execute(query, (stage,) if stage else ()).fetchall()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Opens the history the first time it's needed.
+        """
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS runs (task TEXT, stage TEXT, started REAL, wall REAL, cpu REAL, peak_mb REAL, cores INTEGER, succeeded INTEGER)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS runs_by_task ON runs (task, started)")
+        return self._connection
+
+def stage_of(task: str) -> str:
+    """
+    Returns the stage of a task: the words of its name before the subject id, like "sweep glm" for "sweep glm 104 blur-4".
+    """
+    words = task.split()
+    return " ".join(itertools.takewhile(lambda word: not word.isdigit(), words)) or task
+
+def estimate(history: History, tasks: Iterable[str], cores: int) -> float:
+    """
+    Returns how many seconds tasks should take to finish on a node with this many cores.
+
+    Simulates starting the tasks longest first, each as soon as enough cores are free.
+    """
+    free_cores = cores
+    clock = 0.0
+    running = []
+    for task in history.longest_first(tasks):
+        needed = min(history.cores(stage_of(task)), cores)
+        while free_cores < needed:
+            clock, released = heapq.heappop(running)
+            free_cores += released
+        heapq.heappush(running, (clock + history.predicted_seconds(task, stage_of(task)), needed))
+        free_cores -= needed
+
+    return max((end for end, _ in running), default=clock)
+
+def pending_tasks(doit_args: Iterable[str]=()) -> List[str]:
+    """
+    Asks doit which tasks would run right now. doit_args are passed along, like "sweep=1".
+    """
+    command = [sys.executable, "-m", "doit", "list", "--all", "--status", "--quiet", *doit_args]
+    listing = subprocess.run(command, cwd=Path(__file__).resolve().parent, capture_output=True, text=True, check=True)
+    return [task for status, _, task in (line.partition(" ") for line in listing.stdout.splitlines()) if status == "R"]
+
+def report(history: History, regression: float=1.25) -> str:
+    """
+    Returns a table of each stage's runtime per day, flagging stages whose recent runs got slower.
+
+    A stage is flagged when the median wall time of its latest RECENT_RUNS runs is more than regression times the
+    median of the runs before them.
+    """
+    lines = [f"{'stage':<24}{'day':<12}{'runs':>6}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}"]
+    stages = [row[0] for row in history.connection.execute("SELECT DISTINCT stage FROM runs ORDER BY stage")]
+    for stage in stages:
+        runs = [run for run in history.runs(stage) if run[7]]
+        days = {}
+        for run in runs:
+            days.setdefault(datetime.date.fromtimestamp(run[2]).isoformat(), []).append(run)
+        for day, day_runs in days.items():
+            lines.append(f"{stage:<24}{day:<12}{len(day_runs):>6}{statistics.median(r[3] for r in day_runs):>10.1f}{statistics.median(r[4] for r in day_runs):>10.1f}{max(r[5] for r in day_runs):>10.0f}")
+
+        walls = [run[3] for run in runs]
+        if len(walls) > RECENT_RUNS:
+            before, recent = statistics.median(walls[:-RECENT_RUNS]), statistics.median(walls[-RECENT_RUNS:])
+            if recent > regression * before:
+                lines.append(f"{stage:<24}REGRESSION: recent median {recent:.1f}s vs {before:.1f}s before")
+
+    return "\n".join(lines)
+
+def note_child_peak(peak_mb: float) -> None:
+    """
+    Tells every open record() block that a subprocess it waited for peaked at peak_mb.
+    """
+    for i, previous in enumerate(_child_peaks):
+        _child_peaks[i] = max(previous, peak_mb)
+
+def _reset_peak_rss() -> None:
+    """
+    Resets this process's peak resident memory to its current size. Only Linux 4.0 and later can, elsewhere the peak
+    keeps covering the whole life of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+def _peak_rss_mb() -> float:
+    """
+    Returns this process's peak resident memory in MB since it was last reset.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _cpu_seconds() -> float:
+    """
+    Returns the CPU time used so far by this process and the subprocesses it has waited for.
+    """
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate when pending pipeline tasks will finish, or report runtime trends.")
+    parser.add_argument("command", choices=["eta", "report"], help="eta: predict when the tasks doit would run now finish. report: show per-stage trends.")
+    parser.add_argument("--cores", type=int, default=None, help="Cores of the node to plan for. Defaults to this node's.")
+    parser.add_argument("doit_args", nargs="*", help="Variables to pass to doit when listing pending tasks, like sweep=1.")
+    args = parser.parse_args()
+
+    history = History()
+    if args.command == "report":
+        print(report(history))
+    else:
+        from resources import node_capacity
+
+        tasks = pending_tasks(args.doit_args)
+        seconds = estimate(history, tasks, args.cores or node_capacity()["cores"])
+        finish = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        print(f"{len(tasks)} tasks to run, predicted to take {datetime.timedelta(seconds=round(seconds))} and finish around {finish:%Y-%m-%d %H:%M}")
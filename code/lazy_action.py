@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Class to point doit at a function without importing its module until the task actually runs.
+
+Our pipeline modules pull in pandas, numpy, nibabel and friends. Importing them just to list tasks or check whether
+targets are up to date makes every doit command slow, so dodo.py only names them.
+"""
+# Import external libraries and modules.
+from importlib import import_module
+from typing import Any, Callable
+
+class LazyAction():
+    """
+    Class to point doit at a function without importing its module until the task actually runs.
+
+    Instances can be pickled, so they work with doit's multiprocessing too.
+
+    Parameters
+    ----------
+    module : str
+        Name of the module containing the function, such as "bidsify_subject".
+    function : str
+        Name of the function, such as "main".
+    """
+
+    def __init__(self, module: str, function: str="main"):
+        self.module = module
+        self.function = function
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        return f"{self.module}.{self.function}"
+
+    def resolve(self) -> Callable:
+        """
+        Imports the module and returns the function.
+        """
+        return getattr(import_module(self.module), self.function)
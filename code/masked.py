@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Class to hold the in-brain voxels of a functional image as a compact voxel x time array.
+
+Rows are voxels inside the mask, ordered like a NIfTI image is stored on disk: x fastest, then y, then z. That way the
+voxels of any run of slices are a contiguous block of rows, so images can be gathered and scattered a slab at a time.
+"""
+# Import external libraries and modules.
+from dataclasses import dataclass
+from functools import cached_property
+from os import PathLike
+from pathlib import Path
+from typing import Optional, Tuple
+import nibabel
+import numpy
+
+# Offset of the data in the NIfTI-1 files we write.
+VOX_OFFSET = 352
+
+@dataclass
+class MaskedSeries():
+    """
+    Class to hold the in-brain voxels of a functional image as a compact voxel x time array.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        3D boolean array marking which voxels to keep.
+    data : numpy.ndarray
+        Array of shape (voxels in mask, time points). May be a memory map.
+    header : nibabel.Nifti1Header
+        Header of the image the voxels came from. Used to write them back out as an image.
+
+    Attributes
+    ----------
+    row_offsets : numpy.ndarray
+        Index of the first row of each slice, plus the total number of rows at the end.
+    """
+    mask: numpy.ndarray
+    data: numpy.ndarray
+    header: nibabel.Nifti1Header
+
+    @classmethod
+    def empty(cls, mask: numpy.ndarray, header: nibabel.Nifti1Header, time_count: int, path: Optional[PathLike]=None) -> "MaskedSeries":
+        """
+        Returns a series of zeros for the voxels in mask. Keeps it in a .npy memory map at path if given.
+        """
+        mask = numpy.asarray(mask, dtype=bool)
+        shape = (int(mask.sum()), time_count)
+        if path:
+            data = numpy.lib.format.open_memmap(path, mode="w+", dtype=numpy.float32, shape=shape)
+        else:
+            data = numpy.zeros(shape, dtype=numpy.float32)
+
+        return cls(mask, data, header)
+
+    @classmethod
+    def from_image(cls, image_path: PathLike, mask_path: Optional[PathLike]=None, slab_size: int=8, path: Optional[PathLike]=None) -> "MaskedSeries":
+        """
+        Reads the voxels of an image that fall inside a mask, a slab of slices at a time.
+
+        Keeps every voxel if there's no mask. Keeps the series in a .npy memory map at path if given.
+        """
+        image = nibabel.load(image_path, mmap=True)
+        mask = read_mask(mask_path, image.shape[:3])
+        series = cls.empty(mask, image.header, image.shape[3], path)
+        for first in range(0, image.shape[2], slab_size):
+            last = min(first + slab_size, image.shape[2])
+            series.set_slab(first, last, numpy.asarray(image.dataobj[:, :, first:last], dtype=numpy.float32))
+
+        return series
+
+    @classmethod
+    def load(cls, path: PathLike, mmap: bool=True) -> "MaskedSeries":
+        """
+        Loads a series saved with save(). Maps its data into memory instead of reading it if mmap is true.
+        """
+        path = Path(path)
+        mask_image = nibabel.load(_mask_path(path))
+        data = numpy.load(path.with_suffix(".npy"), mmap_mode="r" if mmap else None)
+
+        # The mask is saved with a single volume so its header keeps the voxel size in time.
+        header = mask_image.header.copy()
+        header.set_data_shape(mask_image.shape[:3] + data.shape[1:])
+
+        return cls(numpy.asarray(mask_image.dataobj, dtype=bool)[..., 0], data, header)
+
+    def save(self, path: PathLike) -> Path:
+        """
+        Saves the series as <path>.npy beside its mask as <path>_mask.nii.gz. Returns the path to the .npy file.
+        """
+        path = Path(path).with_suffix(".npy")
+        if not (isinstance(self.data, numpy.memmap) and Path(self.data.filename) == path.resolve()):
+            numpy.save(path, self.data)
+        mask_header = self.header.copy()
+        mask_header.set_data_dtype(numpy.uint8)
+        mask_header.set_data_shape(self.mask.shape + (1,))
+        nibabel.save(nibabel.Nifti1Image(self.mask[..., numpy.newaxis].astype(numpy.uint8), None, mask_header), _mask_path(path))
+
+        return path
+
+    @cached_property
+    def row_offsets(self) -> numpy.ndarray:
+        return numpy.concatenate([[0], numpy.cumsum(self.mask.sum(axis=(0, 1)))])
+
+    def rows(self, first: int, last: int) -> slice:
+        """
+        Returns the rows holding the voxels of slices first through last - 1.
+        """
+        return slice(self.row_offsets[first], self.row_offsets[last])
+
+    def slab(self, first: int, last: int, data: Optional[numpy.ndarray]=None) -> numpy.ndarray:
+        """
+        Scatters the rows of slices first through last - 1 into an (x, y, slices, time) array with zeros outside the mask.
+
+        Scatters data instead of our own if given. data must have one row per voxel in the mask.
+        """
+        data = self.data if data is None else data
+        rows = data[self.rows(first, last)]
+        slab = numpy.zeros(self.mask.shape[:2] + (last - first, rows.shape[1]), dtype=numpy.float32)
+        slab.transpose(2, 1, 0, 3)[self.mask[:, :, first:last].T] = rows
+
+        return slab
+
+    def set_slab(self, first: int, last: int, slab: numpy.ndarray) -> None:
+        """
+        Gathers the voxels inside the mask from an (x, y, slices, time) array covering slices first through last - 1.
+        """
+        self.data[self.rows(first, last)] = slab.transpose(2, 1, 0, 3)[self.mask[:, :, first:last].T]
+
+    def write(self, path: PathLike, data: Optional[numpy.ndarray]=None, slab_size: int=8) -> Path:
+        """
+        Scatters the series back into a float32 NIfTI image at path, a slab of slices at a time.
+
+        Writes data instead of our own if given. data must have one row per voxel in the mask.
+        """
+        data = self.data if data is None else data
+        path, volume = create_nifti(path, self.header, self.mask.shape + (data.shape[1],))
+        for first in range(0, self.mask.shape[2], slab_size):
+            last = min(first + slab_size, self.mask.shape[2])
+            volume[:, :, first:last] = self.slab(first, last, data)
+        volume.flush()
+
+        return path
+
+def read_mask(mask_path: Optional[PathLike], shape: Tuple[int, ...]) -> numpy.ndarray:
+    """
+    Reads a mask image as a boolean array. Returns a mask of every voxel if mask_path is None.
+
+    Raises
+    ------
+    ValueError
+        If the mask doesn't have the given shape.
+    """
+    if mask_path is None:
+        return numpy.ones(shape, dtype=bool)
+
+    mask = numpy.asarray(nibabel.load(mask_path).dataobj) > 0
+    if mask.shape != tuple(shape):
+        raise ValueError(f"{mask_path} has shape {mask.shape} but the image has shape {tuple(shape)}")
+
+    return mask
+
+def create_nifti(path: PathLike, template: nibabel.Nifti1Header, shape: Tuple[int, ...]) -> Tuple[Path, numpy.memmap]:
+    """
+    Writes a float32 NIfTI-1 header at path based on template, then maps its data into memory for us to fill in.
+
+    Returns the path along with the memory map.
+    """
+    path = Path(path)
+    header = template.copy()
+    header.set_data_dtype(numpy.float32)
+    header.set_data_shape(shape)
+    header.set_slope_inter(1, 0)
+    header["vox_offset"] = VOX_OFFSET
+    with open(path, "wb") as out_file:
+        header.write_to(out_file)
+        out_file.write(b"\0" * (VOX_OFFSET - out_file.tell()))
+
+    data = numpy.memmap(path, dtype=numpy.float32, mode="r+", offset=VOX_OFFSET, shape=shape, order="F")
+    return path, data
+
+def _mask_path(path: Path) -> Path:
+    """
+    Returns where the mask of a saved series lives.
+    """
+    return path.with_name(f"{path.with_suffix('').name}_mask.nii.gz")
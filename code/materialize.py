@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Put copies of files where they need to go without duplicating storage when possible.
+
+Files can be hardlinked, reflinked, symlinked or fully copied. A destination that already matches its source is left
+alone. One that's stale or truncated gets replaced atomically.
+"""
+# Import external libraries and modules.
+from concurrent.futures import ThreadPoolExecutor
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+
+MODES = ("hardlink", "reflink", "symlink", "copy")
+
+# ioctl request that asks the filesystem to share the blocks of one file with another (Linux FICLONE).
+FICLONE = 0x40049409
+
+# Size of each block fast_hash reads.
+BLOCK_SIZE = 1 << 20
+
+def main(pairs: Iterable[Tuple[PathLike, PathLike]], mode: str="hardlink", verify: str="stat", threads: Optional[int]=None) -> List[Path]:
+    """
+    Materializes many files at once. Each pair is (source, destination).
+
+    Returns the destinations in the same order as the pairs.
+    """
+    pairs = list(pairs)
+    with ThreadPoolExecutor(threads or len(pairs) or 1) as pool:
+        return list(pool.map(lambda pair: materialize(pair[0], pair[1], mode, verify), pairs))
+
+def materialize(source: PathLike, destination: PathLike, mode: str="hardlink", verify: str="stat") -> Path:
+    """
+    Makes destination a copy of source unless it already is one.
+
+    Parameters
+    ----------
+    source : str or Path
+        File to copy.
+    destination : str or Path
+        Where to put the copy.
+    mode : str
+        "hardlink" links destination to the same inode as source. "reflink" shares source's blocks if the filesystem
+        supports it and otherwise copies in the kernel with copy_file_range. "symlink" points destination at source.
+        "copy" writes a full copy. Hardlinks fall back to reflinks across filesystems. Beware that writing to a hardlinked
+        destination writes to source too.
+    verify : str
+        "stat" compares size and mtime. "hash" also compares fast_hash.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}. Choose one of {MODES}.")
+
+    source = Path(source).resolve()
+    destination = Path(destination).absolute()
+    if is_current(source, destination, verify, mode):
+        return destination
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    partial = destination.with_name(f".{destination.name}.partial")
+    if partial.is_symlink() or partial.exists():
+        partial.unlink()
+
+    try:
+        if mode == "hardlink":
+            try:
+                os.link(source, partial)
+            except OSError as error:
+                if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                _reflink(source, partial)
+        elif mode == "reflink":
+            _reflink(source, partial)
+        elif mode == "symlink":
+            partial.symlink_to(source)
+        else:
+            shutil.copy2(source, partial)
+
+        os.replace(partial, destination)
+    except BaseException:
+        # Don't leave half a copy behind.
+        if partial.is_symlink() or partial.exists():
+            partial.unlink()
+        raise
+    print(f"Materialized ({mode}) {source}  ->  {destination}")
+    return destination
+
+def is_current(source: PathLike, destination: PathLike, verify: str="stat", mode: str="hardlink") -> bool:
+    """
+    Returns true if destination already holds the contents of source the way mode would have put them there.
+
+    A symlink to source only counts in "symlink" mode and a hardlink only in "hardlink" mode, so switching to a mode
+    that keeps destination apart from source replaces links made before. Copies must match source's size and mtime,
+    and also its fast_hash if verify is "hash".
+    """
+    source, destination = Path(source), Path(destination)
+    if destination.is_symlink():
+        return mode == "symlink" and destination.resolve() == source.resolve()
+    if not destination.exists():
+        return False
+
+    source_stat, destination_stat = source.stat(), destination.stat()
+    if (source_stat.st_dev, source_stat.st_ino) == (destination_stat.st_dev, destination_stat.st_ino):
+        return mode == "hardlink"
+    if (source_stat.st_size, source_stat.st_mtime_ns) != (destination_stat.st_size, destination_stat.st_mtime_ns):
+        return False
+    if verify == "hash":
+        return fast_hash(source) == fast_hash(destination)
+
+    return True
+
+def fast_hash(path: PathLike, blocks: int=3) -> str:
+    """
+    Hashes the size of a file plus a few evenly spaced blocks of it, including its first and last.
+
+    Reads at most blocks * BLOCK_SIZE bytes no matter how big the file is.
+    """
+    size = Path(path).stat().st_size
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as in_file:
+        for offset in sorted({i * max(size - BLOCK_SIZE, 0) // max(blocks - 1, 1) for i in range(blocks)}):
+            in_file.seek(offset)
+            digest.update(in_file.read(BLOCK_SIZE))
+
+    return digest.hexdigest()
+
+def _reflink(source: Path, destination: Path) -> None:
+    """
+    Copies source to destination by sharing its blocks, by copying inside the kernel, or by copying normally,
+    whichever works first. Keeps source's mtime.
+    """
+    with open(source, "rb") as in_file, open(destination, "wb") as out_file:
+        try:
+            fcntl.ioctl(out_file.fileno(), FICLONE, in_file.fileno())
+        except OSError:
+            _copy_file_range(in_file, out_file, os.fstat(in_file.fileno()).st_size)
+    shutil.copystat(source, destination)
+
+def _copy_file_range(in_file, out_file, size: int) -> None:
+    """
+    Copies size bytes from one open file to another inside the kernel. Falls back to a normal copy if that's
+    unsupported or stops short.
+    """
+    copied = 0
+    try:
+        while copied < size:
+            step = os.copy_file_range(in_file.fileno(), out_file.fileno(), size - copied)
+            if step == 0:
+                break
+            copied += step
+    except (AttributeError, OSError):
+        copied = None
+
+    if copied != size:
+        in_file.seek(0)
+        out_file.seek(0)
+        out_file.truncate()
+        shutil.copyfileobj(in_file, out_file, BLOCK_SIZE)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Read and cache the header of NIfTI-1 images without opening the whole image.
+
+Only the first 348 bytes of each image are read, and for .nii.gz only as much of the stream as it takes to
+decompress them. Headers are cached in a small SQLite database keyed by path, size and mtime, so reading the same
+header twice costs a single lookup.
+"""
+# Import external libraries and modules.
+from dataclasses import dataclass
+from os import PathLike
+from pathlib import Path
+from typing import Dict
+import gzip
+import json
+import os
+import sqlite3
+import struct
+
+HEADER_CACHE_PATH = Path(__file__).resolve().parent.parent / "outputs" / "nifti_headers.sqlite"
+HEADER_SIZE = 348
+
+# Factor converting the time unit stored in xyzt_units into seconds. Code 0 means the units are unknown.
+TIME_UNITS = {8: 1.0, 16: 1e-3, 24: 1e-6}
+
+def read_header(path: PathLike) -> Dict:
+    """
+    Reads the header of a NIfTI-1 image and returns the fields we use.
+
+    Returns a dict containing dim, pixdim, datatype, bitpix, slice_start, slice_end, slice_code, slice_duration,
+    xyzt_units, scl_slope, scl_inter and vox_offset. See repetition_time() for the TR in seconds.
+
+    Raises
+    ------
+    ValueError
+        If the file isn't a NIfTI-1 image.
+    """
+    path = Path(path)
+    opener = gzip.open if path.name.endswith(".gz") else open
+    with opener(path, "rb") as image_file:
+        raw = image_file.read(HEADER_SIZE)
+
+    if len(raw) < HEADER_SIZE:
+        raise ValueError(f"{path} is too short to be a NIfTI-1 image")
+
+    for endian in "<>":
+        if struct.unpack_from(f"{endian}i", raw, 0)[0] == HEADER_SIZE:
+            break
+    else:
+        raise ValueError(f"{path} isn't a NIfTI-1 image")
+
+    dim = list(struct.unpack_from(f"{endian}8h", raw, 40))
+    pixdim = list(struct.unpack_from(f"{endian}8f", raw, 76))
+    xyzt_units = raw[123]
+    header = {
+        "dim": dim[1:dim[0] + 1],
+        "pixdim": pixdim[1:dim[0] + 1],
+        "datatype": struct.unpack_from(f"{endian}h", raw, 70)[0],
+        "bitpix": struct.unpack_from(f"{endian}h", raw, 72)[0],
+        "slice_start": struct.unpack_from(f"{endian}h", raw, 74)[0],
+        "vox_offset": struct.unpack_from(f"{endian}f", raw, 108)[0],
+        "scl_slope": struct.unpack_from(f"{endian}f", raw, 112)[0],
+        "scl_inter": struct.unpack_from(f"{endian}f", raw, 116)[0],
+        "slice_end": struct.unpack_from(f"{endian}h", raw, 120)[0],
+        "slice_code": raw[122],
+        "xyzt_units": xyzt_units,
+        "slice_duration": struct.unpack_from(f"{endian}f", raw, 132)[0],
+    }
+
+    return header
+
+def repetition_time(header: Dict, path: PathLike="image") -> float:
+    """
+    Returns the repetition time in seconds recorded in a header from read_header(), or 0 if it records none.
+
+    Raises
+    ------
+    ValueError
+        If the header records a repetition time but its time units are unknown. Guessing would shift every onset.
+    """
+    if len(header["dim"]) < 4 or not header["pixdim"][3]:
+        return 0.0
+
+    unit_code = header["xyzt_units"] & 0x38
+    if unit_code not in TIME_UNITS:
+        raise ValueError(f"{path} records a repetition time of {header['pixdim'][3]:g} in unknown time units (xyzt_units time code {unit_code}). Give the repetition time in seconds explicitly instead, like \"doit tr=2\" or \"async_runner.py --tr 2\".")
+
+    return header["pixdim"][3] * TIME_UNITS[unit_code]
+
+@dataclass
+class HeaderCache():
+    """
+    Class to cache the headers of NIfTI-1 images.
+
+    Parameters
+    ----------
+    cache_path : str or Path
+        Where to keep the cache.
+    """
+    cache_path: PathLike = HEADER_CACHE_PATH
+
+    def __post_init__(self):
+        self.cache_path = Path(self.cache_path)
+        self._connection = None
+
+    def header(self, path: PathLike) -> Dict:
+        """
+        Returns the header of an image, reading it only if the image is new or has changed since it was cached.
+        """
+        path = Path(path).resolve()
+        stat = os.stat(path)
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+
+        row = self.connection.execute("SELECT header FROM headers WHERE path = ? AND size = ? AND mtime = ?", key).fetchone()
+        if row:
+            return json.loads(row[0])
+
+        header = read_header(path)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", key + (json.dumps(header),))
+
+        return header
+
+    def slice_count(self, path: PathLike) -> int:
+        """
+        Returns the number of slices acquired in each volume of an image.
+        """
+        header = self.header(path)
+        return header["slice_end"] - header["slice_start"] + 1
+
+    def repetition_time(self, path: PathLike, default: float=2.0) -> float:
+        """
+        Returns the repetition time of an image in seconds, or default if the header doesn't record one.
+
+        Raises
+        ------
+        ValueError
+            If the header records a repetition time in unknown time units.
+        """
+        return repetition_time(self.header(path), path) or default
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Opens the cache the first time it's needed.
+        """
+        if self._connection is None:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.cache_path, timeout=60)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, header TEXT)")
+        return self._connection
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Class to keep an index of the raw files of every subject.
+
+Scanning our raw directories over the network filesystem is slow, so we scan them once, save what we find, and
+afterwards only rescan subject directories whose mtime has changed. Only the standard library is used so that
+loading the index stays cheap.
+"""
+# Import external libraries and modules.
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from functools import cached_property
+from os import PathLike
+from pathlib import Path
+from typing import Dict, List, Optional
+import json
+import os
+
+RAW_DIR = Path(__file__).resolve().parent.parent / "raw" / "subjects-complete"
+INDEX_PATH = Path(__file__).resolve().parent.parent / "outputs" / "raw_index.json"
+
+# Pattern each kind of raw file matches. {id} is replaced by the subject ID.
+ROLES = {
+    "eeg": "contrascan_{id}.eeg",
+    "vhdr": "contrascan_{id}.vhdr",
+    "vmrk": "contrascan_{id}.vmrk",
+    "func": "Keil_{id}_*EPI_2s_Gain_*_1.nii",
+    "anat": "Keil_{id}_*sT1W_3D_FFE_SAG_*_1.nii",
+    "dat": "SFcontrascan_{id}.dat",
+}
+
+@dataclass
+class RawIndex():
+    """
+    Class to keep an index of the raw files of every subject.
+
+    Parameters
+    ----------
+    root : str or Path
+        Directory containing one sub-<id> directory per subject.
+    index_path : str or Path
+        Where to save the index.
+    threads : int, optional
+        Number of directories to scan at once.
+
+    Attributes
+    ----------
+    subjects : dict
+        Maps each subject ID to the mtime of its directory and the size, mtime and role of each of its files.
+    """
+    root: PathLike = RAW_DIR
+    index_path: PathLike = INDEX_PATH
+    threads: Optional[int] = None
+
+    def __post_init__(self):
+        self.root = Path(self.root).resolve()
+        self.index_path = Path(self.index_path)
+
+    @cached_property
+    def subjects(self) -> Dict[str, Dict]:
+        """
+        Loads the saved index and rescans any subject directory that's new or whose mtime has changed.
+
+        Saves the index again if anything changed.
+        """
+        saved = self._read()
+        directories = {}
+        if self.root.is_dir():
+            directories = {entry.name[len("sub-"):]: entry for entry in os.scandir(self.root) if entry.name.startswith("sub-") and entry.is_dir()}
+
+        subjects = {}
+        stale = []
+        for subject_id, entry in directories.items():
+            mtime = entry.stat().st_mtime_ns
+            if saved.get(subject_id, {}).get("mtime") == mtime:
+                subjects[subject_id] = saved[subject_id]
+            else:
+                stale.append((subject_id, entry.path, mtime))
+
+        if stale:
+            with ThreadPoolExecutor(self.threads) as pool:
+                for subject_id, record in zip([item[0] for item in stale], pool.map(lambda item: _scan(*item), stale)):
+                    subjects[subject_id] = record
+
+        if stale or subjects.keys() != saved.keys():
+            self._write(subjects)
+
+        return subjects
+
+    def sources(self, subject_id: str) -> Dict[str, Path]:
+        """
+        Returns the path of each raw file of a subject, keyed by its role.
+
+        Raises
+        ------
+        NotADirectoryError
+            If the subject has no directory.
+        FileNotFoundError
+            If a role has no file.
+        IOError
+            If a role has more than one file.
+        """
+        if subject_id not in self.subjects:
+            raise NotADirectoryError(f"{self.root / f'sub-{subject_id}'} either doesn't exist or isn't a directory at all!")
+
+        sources = {}
+        for role in ROLES:
+            files = self.subjects[subject_id]["files"].get(role, [])
+            if len(files) > 1:
+                raise IOError(f"sub-{subject_id} has more than one {role} file: {[file['path'] for file in files]}")
+            elif len(files) == 0:
+                raise FileNotFoundError(f"sub-{subject_id} has no {role} file matching '{ROLES[role].format(id=subject_id)}'")
+            sources[role] = Path(files[0]["path"])
+
+        return sources
+
+    def _read(self) -> Dict[str, Dict]:
+        """
+        Returns the saved index if it belongs to our root. Otherwise returns an empty index.
+        """
+        try:
+            with open(self.index_path) as index_file:
+                saved = json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+        return saved["subjects"] if saved.get("root") == str(self.root) else {}
+
+    def _write(self, subjects: Dict[str, Dict]) -> None:
+        """
+        Saves the index atomically.
+        """
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = self.index_path.with_name(self.index_path.name + ".partial")
+        with open(partial_path, "w") as index_file:
+            json.dump({"root": str(self.root), "subjects": subjects}, index_file, indent="\t")
+        os.replace(partial_path, self.index_path)
+
+def _scan(subject_id: str, directory: str, mtime: int) -> Dict:
+    """
+    Scans one subject directory. Records the size, mtime and role of every file that has a role.
+    """
+    patterns = {role: pattern.format(id=subject_id) for role, pattern in ROLES.items()}
+    files: Dict[str, List[Dict]] = {}
+    for entry in os.scandir(directory):
+        for role, pattern in patterns.items():
+            if fnmatchcase(entry.name, pattern):
+                stat = entry.stat()
+                files.setdefault(role, []).append({"path": entry.path, "size": stat.st_size, "mtime": stat.st_mtime_ns})
+
+    return {"mtime": mtime, "files": files}
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Give each pipeline task a budget of cores and memory, and only start it once the node has room for it.
+
+Every doit worker claims its task's budget in a small JSON ledger shared by all processes on the node before the task
+runs. A task waits while the claims of running tasks plus its own would exceed the node's cores or memory, or while
+the memory actually available is short of its budget. While it runs, OMP_NUM_THREADS and friends are set to its
+cores, so AFNI programs, BLAS and our own process pools all stay within the budget. Each run of a named task is
+recorded in the runtime history. See history.py.
+
+Only the standard library is imported here, since dodo.py uses this module to declare budgets.
+"""
+# Import external libraries and modules.
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import time
+
+# Import CSEA libraries and modules.
+from history import History, stage_of
+
+# Environment variables that cap how many threads a process uses.
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS", "PIPELINE_CORES")
+
+# Where the processes on a node keep their claims. Each node of a cluster gets its own ledger.
+LEDGER_PATH = Path(tempfile.gettempdir()) / f"csea-resources-{os.getuid()}-{socket.gethostname()}.json"
+
+class ResourcedAction():
+    """
+    Class to run a doit action only once its budget of cores and memory fits on the node.
+
+    Instances can be pickled, so they work with doit's multiprocessing too.
+
+    Parameters
+    ----------
+    action : callable
+        The action to run, such as a LazyAction.
+    cores : int
+        Number of cores the action may use.
+    memory_gb : float
+        Peak memory the action is expected to use, in GB.
+    task : str, optional
+        Name of the doit task. If given, every run of the action is recorded in the runtime history under it.
+    """
+
+    def __init__(self, action: Callable, cores: int=1, memory_gb: float=1.0, task: Optional[str]=None):
+        self.action = action
+        self.cores = cores
+        self.memory_gb = memory_gb
+        self.task = task
+
+    def __call__(self, *args, **kwargs) -> Any:
+        with claim(self.cores, self.memory_gb, label=self.task or repr(self.action)) as cores:
+            with thread_environment(cores):
+                if self.task is None:
+                    return self.action(*args, **kwargs)
+                with History().record(self.task, stage_of(self.task), cores):
+                    return self.action(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        return f"{self.action!r} [{self.cores} cores, {self.memory_gb:g} GB]"
+
+def node_capacity() -> Dict[str, float]:
+    """
+    Returns the cores this process may run on and the total memory of the node in GB.
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return {"cores": cores, "memory_gb": _meminfo("MemTotal")}
+
+def allotted_cores() -> int:
+    """
+    Returns the number of cores the running task was given, or every core if it runs outside of a claim.
+    """
+    return int(os.environ.get("PIPELINE_CORES", 0)) or node_capacity()["cores"]
+
+@contextmanager
+def claim(cores: int, memory_gb: float, label: str="", ledger_path: Path=LEDGER_PATH, poll_seconds: float=2.0) -> Iterator[int]:
+    """
+    Waits until cores and memory_gb fit on the node, then holds them until the block exits. Yields the cores granted.
+
+    A budget bigger than the whole node is cut down to the node, so it runs once nothing else does.
+    """
+    capacity = node_capacity()
+    cores = max(1, min(cores, capacity["cores"]))
+    memory_gb = min(memory_gb, capacity["memory_gb"] * 0.9)
+    request = {"cores": cores, "memory_gb": memory_gb, "label": label, "since": time.time()}
+    key = str(os.getpid())
+
+    announced = False
+    while True:
+        with _ledger(ledger_path) as claims:
+            used_cores = sum(other["cores"] for other in claims.values())
+            used_memory = sum(other["memory_gb"] for other in claims.values())
+            fits = used_cores + cores <= capacity["cores"] and used_memory + memory_gb <= capacity["memory_gb"] * 0.9
+            if fits and (not claims or _meminfo("MemAvailable") >= memory_gb):
+                claims[key] = request
+                break
+        if not announced:
+            print(f"Waiting for {cores} cores and {memory_gb:g} GB to free up for {label or key}")
+            announced = True
+        time.sleep(poll_seconds)
+
+    try:
+        yield cores
+    finally:
+        with _ledger(ledger_path) as claims:
+            claims.pop(key, None)
+
+@contextmanager
+def thread_environment(cores: int) -> Iterator[None]:
+    """
+    Caps the threads of this process and every subprocess it starts at cores until the block exits.
+    """
+    previous = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    os.environ.update({name: str(cores) for name in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+@contextmanager
+def _ledger(ledger_path: Path) -> Iterator[Dict[str, Dict]]:
+    """
+    Locks the ledger and yields its claims for editing. Claims of processes that have died are dropped.
+    """
+    with open(ledger_path, "a+") as ledger_file:
+        fcntl.flock(ledger_file, fcntl.LOCK_EX)
+        ledger_file.seek(0)
+        text = ledger_file.read()
+        claims = {key: value for key, value in (json.loads(text) if text else {}).items() if _is_alive(int(key))}
+
+        yield claims
+
+        ledger_file.seek(0)
+        ledger_file.truncate()
+        json.dump(claims, ledger_file)
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _meminfo(field: str) -> float:
+    """
+    Returns a field of /proc/meminfo in GB. Falls back to total physical memory where there's no /proc/meminfo.
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / (1 << 20)
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1 << 30)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Smooth a functional image and scale each voxel to percent of its mean in a single pass.
+
+Does the work of the 3dmerge -> 3dTstat -> 3dcalc chain in deconvolve.py without writing the smoothed image or the
+means to disk in between. The image is processed a slab of slices at a time, so memory stays bounded by the slab size,
+and only voxels inside the brain mask are kept once they've been blurred.
+"""
+# Import external libraries and modules.
+from os import PathLike
+from pathlib import Path
+from typing import Optional, Tuple
+import gzip
+import math
+import shutil
+import nibabel
+import numpy
+
+# Import CSEA libraries and modules.
+from masked import MaskedSeries, read_mask
+
+def main(func_path: PathLike, out_dir: PathLike, subject_id: str, mask_path: Optional[PathLike]=None, fwhm: float=4.0, slab_size: int=4, keep_intermediates: bool=False) -> Path:
+    """
+    Smooths a functional image, then expresses each voxel as percent signal change from its mean.
+
+    Writes <out_dir>/sub-<id>_bold_scaled.nii as float32 and returns its path. Voxels outside the mask are zero.
+
+    Parameters
+    ----------
+    func_path : str or Path
+        The functional image to smooth and scale.
+    out_dir : str or Path
+        Directory to write outputs into.
+    subject_id : str
+        ID of the subject, used to name outputs.
+    mask_path : str or Path
+        Mask of the voxels to scale. Scales every voxel if None.
+    fwhm : float
+        Full width at half maximum of the Gaussian blur in mm, like 3dmerge -1blur_fwhm.
+    slab_size : int
+        Number of slices to process at once.
+    keep_intermediates : bool
+        Also write the smoothed image and the voxel means for quality control.
+    """
+    out_dir = Path(out_dir).resolve()
+    scaled = smooth_and_scale(func_path, out_dir, subject_id, mask_path, fwhm, slab_size, keep_intermediates)
+
+    return scaled.write(out_dir / f"sub-{subject_id}_bold_scaled.nii")
+
+def smooth_and_scale(func_path: PathLike, out_dir: PathLike, subject_id: str, mask_path: Optional[PathLike]=None, fwhm: float=4.0, slab_size: int=4, keep_intermediates: bool=False, in_memory: bool=False) -> MaskedSeries:
+    """
+    Smooths a functional image, then expresses each voxel inside the mask as percent signal change from its mean.
+
+    Returns the scaled voxels as a MaskedSeries. Unless in_memory is true, it's kept in <out_dir>/sub-<id>_bold_scaled.npy
+    and can be loaded again with MaskedSeries.load().
+    Blurring uses voxels outside the mask too, just like 3dmerge. See main() for the other parameters.
+    """
+    out_dir = Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    image, temporary_path = _uncompressed(Path(func_path).resolve(), out_dir)
+    shape = image.shape
+    mask = read_mask(mask_path, shape[:3])
+    kernels = [gaussian_kernel(fwhm, voxel_size) for voxel_size in image.header.get_zooms()[:3]]
+    halo = kernels[2].size // 2
+
+    scaled = MaskedSeries.empty(mask, image.header, shape[3], None if in_memory else out_dir / f"sub-{subject_id}_bold_scaled.npy")
+    if keep_intermediates:
+        smoothed_series = MaskedSeries.empty(mask, image.header, shape[3], out_dir / f"temp_sub-{subject_id}_bold_smoothed.npy")
+        means = MaskedSeries.empty(mask, image.header, 1)
+
+    for first in range(0, shape[2], slab_size):
+        last = min(first + slab_size, shape[2])
+
+        # Read the slab plus enough neighbouring slices to blur across its edges. Repeat the outermost slices of the image.
+        read_first, read_last = max(first - halo, 0), min(last + halo, shape[2])
+        slab = numpy.asarray(image.dataobj[:, :, read_first:read_last], dtype=numpy.float32)
+        slab = numpy.pad(slab, ((0, 0), (0, 0), (read_first - (first - halo), (last + halo) - read_last), (0, 0)), mode="edge")
+
+        smoothed = _convolve(_convolve(slab, kernels[0], axis=0), kernels[1], axis=1)
+        smoothed = _convolve(smoothed, kernels[2], axis=2, pad=False)
+
+        # From here on only voxels inside the mask matter.
+        voxels = smoothed.transpose(2, 1, 0, 3)[mask[:, :, first:last].T]
+        mean = voxels.mean(axis=1, keepdims=True, dtype=numpy.float64).astype(numpy.float32)
+        if keep_intermediates:
+            smoothed_series.data[smoothed_series.rows(first, last)] = voxels
+            means.data[means.rows(first, last)] = mean
+
+        # ((a-b)/b)*100, like our 3dcalc expression. Voxels with a mean of zero become zero.
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            voxels = (voxels - mean) / mean * 100
+        voxels[~numpy.isfinite(voxels)] = 0
+        scaled.data[scaled.rows(first, last)] = voxels
+
+    if keep_intermediates:
+        smoothed_series.write(out_dir / f"sub-{subject_id}_bold_smoothed.nii")
+        means.write(out_dir / f"sub-{subject_id}_bold_mean.nii")
+        del smoothed_series
+        (out_dir / f"temp_sub-{subject_id}_bold_smoothed.npy").unlink()
+    if temporary_path:
+        temporary_path.unlink()
+    if not in_memory:
+        scaled.save(scaled.data.filename)
+
+    return scaled
+
+def gaussian_kernel(fwhm: float, voxel_size: float) -> numpy.ndarray:
+    """
+    Returns a normalized 1D Gaussian kernel with the given FWHM in mm, sampled at the voxel size in mm.
+
+    The kernel reaches out to 4 standard deviations on each side.
+    """
+    sigma = fwhm / (2 * math.sqrt(2 * math.log(2))) / voxel_size
+    radius = max(int(math.ceil(4 * sigma)), 1)
+    kernel = numpy.exp(-0.5 * (numpy.arange(-radius, radius + 1) / sigma) ** 2)
+
+    return (kernel / kernel.sum()).astype(numpy.float32)
+
+def _convolve(data: numpy.ndarray, kernel: numpy.ndarray, axis: int, pad: bool=True) -> numpy.ndarray:
+    """
+    Convolves data with a symmetric kernel along one axis.
+
+    If pad is true the output has the same shape as data, and the edges repeat the outermost values. Otherwise the
+    output is shorter by the width of the kernel minus one.
+    """
+    radius = kernel.size // 2
+    if pad:
+        padding = [(0, 0)] * data.ndim
+        padding[axis] = (radius, radius)
+        data = numpy.pad(data, padding, mode="edge")
+
+    length = data.shape[axis] - 2 * radius
+    result = numpy.zeros(data.shape[:axis] + (length,) + data.shape[axis + 1:], dtype=numpy.float32)
+    for offset, weight in enumerate(kernel):
+        result += weight * numpy.take(data, numpy.arange(offset, offset + length), axis=axis)
+
+    return result
+
+def _uncompressed(path: Path, out_dir: Path) -> Tuple[nibabel.Nifti1Image, Optional[Path]]:
+    """
+    Opens an image so its slabs can be read from a memory map.
+
+    A gzipped image can't be read a slab at a time, so it's streamed into an uncompressed copy in out_dir first.
+    Returns the image along with the path of that copy, which the caller should delete, or None.
+    """
+    if not path.name.endswith(".gz"):
+        return nibabel.load(path, mmap=True), None
+
+    uncompressed_path = out_dir / f"temp_{path.name[:-len('.gz')]}"
+    with gzip.open(path, "rb") as in_file, open(uncompressed_path, "wb") as out_file:
+        shutil.copyfileobj(in_file, out_file, 1 << 22)
+
+    return nibabel.load(uncompressed_path, mmap=True), uncompressed_path
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Measure the steady-state visual evoked potential (ssVEP) driven by our flickering gabors.
+
+Every function works on epochs indexed as [channel, trial, sample], as written by epochs.py. Trials are processed a
+chunk at a time, so memory-mapped epochs never need to fit into memory all at once.
+"""
+# Import external libraries and modules.
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+import argparse
+import numpy
+import pandas
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Import CSEA libraries and modules.
+from dat import Dat
+from epochs import read_epochs
+
+# The stimulus script flickers the gabors at about 12 Hz on the scanner's monitor.
+DRIVING_FREQUENCY = 12.0
+
+def spectrum(epochs: numpy.ndarray, sampling_rate: float, chunk_size: int=16) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Returns the frequencies and the amplitude spectrum of each channel and trial, indexed as [channel, trial, frequency].
+    """
+    sample_count = epochs.shape[-1]
+    frequencies = numpy.fft.rfftfreq(sample_count, d=1 / sampling_rate)
+    amplitudes = numpy.empty(epochs.shape[:-1] + frequencies.shape, dtype=numpy.float32)
+
+    for trials, chunk in _chunks(epochs, chunk_size):
+        amplitudes[:, trials] = numpy.abs(numpy.fft.rfft(chunk, axis=-1)) * (2 / sample_count)
+
+    return frequencies, amplitudes
+
+def amplitudes_at(epochs: numpy.ndarray, sampling_rate: float, frequency: float=DRIVING_FREQUENCY, chunk_size: int=16) -> numpy.ndarray:
+    """
+    Returns the amplitude at the frequency bin closest to frequency, indexed as [channel, trial].
+    """
+    sample_count = epochs.shape[-1]
+    frequency_bin = int(numpy.argmin(numpy.abs(numpy.fft.rfftfreq(sample_count, d=1 / sampling_rate) - frequency)))
+    amplitudes = numpy.empty(epochs.shape[:-1], dtype=numpy.float32)
+
+    for trials, chunk in _chunks(epochs, chunk_size):
+        amplitudes[:, trials] = numpy.abs(numpy.fft.rfft(chunk, axis=-1)[..., frequency_bin]) * (2 / sample_count)
+
+    return amplitudes
+
+def sliding_amplitudes(epochs: numpy.ndarray, sampling_rate: float, frequency: float=DRIVING_FREQUENCY, window: float=1.0, step: float=0.1, chunk_size: int=16) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Returns the amplitude at frequency within a window sliding along each trial, indexed as [channel, trial, window].
+
+    Also returns the center of each window in samples from the start of the trial.
+    """
+    window_length = int(round(window * sampling_rate))
+    step_length = max(1, int(round(step * sampling_rate)))
+    kernel = numpy.exp(-2j * numpy.pi * frequency * numpy.arange(window_length) / sampling_rate) * (2 / window_length)
+    centers = numpy.arange(0, epochs.shape[-1] - window_length + 1, step_length) + window_length // 2
+    amplitudes = numpy.empty(epochs.shape[:-1] + centers.shape, dtype=numpy.float32)
+
+    for trials, chunk in _chunks(epochs, chunk_size):
+        windows = sliding_window_view(chunk, window_length, axis=-1)[..., ::step_length, :]
+        amplitudes[:, trials] = numpy.abs(windows @ kernel)
+
+    return centers, amplitudes
+
+def hilbert_amplitudes(epochs: numpy.ndarray, sampling_rate: float, frequency: float=DRIVING_FREQUENCY, bandwidth: float=1.0, chunk_size: int=16) -> numpy.ndarray:
+    """
+    Returns the amplitude envelope of the signal around frequency at every sample, indexed as [channel, trial, sample].
+
+    Each trial is band-passed to frequency ± bandwidth / 2 in the frequency domain. Its analytic signal comes from the
+    same spectrum with the negative frequencies dropped, so no time-domain filter is ever run.
+    """
+    sample_count = epochs.shape[-1]
+    frequencies = numpy.fft.rfftfreq(sample_count, d=1 / sampling_rate)
+    in_band = numpy.abs(frequencies - frequency) <= bandwidth / 2
+    amplitudes = numpy.empty(epochs.shape, dtype=numpy.float32)
+
+    for trials, chunk in _chunks(epochs, chunk_size):
+        analytic_spectrum = numpy.zeros(chunk.shape, dtype=numpy.complex64)
+        analytic_spectrum[..., :frequencies.size] = numpy.fft.rfft(chunk, axis=-1) * (2 * in_band)
+        amplitudes[:, trials] = numpy.abs(numpy.fft.ifft(analytic_spectrum, axis=-1))
+
+    return amplitudes
+
+def amplitude_table(epochs_path: PathLike, dat_path: PathLike, frequency: float=DRIVING_FREQUENCY, window: Optional[Tuple[float, float]]=None, chunk_size: int=16) -> pandas.DataFrame:
+    """
+    Returns one row per trial and channel containing the ssVEP amplitude of the trial along with its trial code and condition.
+
+    Parameters
+    ----------
+    epochs_path : str or Path
+        Epochs written by epochs.py.
+    dat_path : str or Path
+        The .dat file of the same subject.
+    frequency : float
+        Frequency in Hz at which to measure the amplitude.
+    window : (float, float), optional
+        Time window in seconds relative to the marker to analyze. Uses the whole trial by default.
+    chunk_size : int
+        Number of trials to analyze at once.
+    """
+    epochs, sidecar = read_epochs(epochs_path)
+    sampling_rate = sidecar["SamplingFrequency"]
+    if window is not None:
+        first_sample = int(round((window[0] - sidecar["EpochStart"]) * sampling_rate))
+        last_sample = int(round((window[1] - sidecar["EpochStart"]) * sampling_rate))
+        epochs = epochs[..., first_sample:last_sample]
+
+    amplitudes = amplitudes_at(epochs, sampling_rate, frequency, chunk_size)
+    trials = Dat(dat_path).dataframe.iloc[sidecar["Trials"]]
+    channel_count, trial_count = amplitudes.shape
+
+    return pandas.DataFrame({
+        "trial": numpy.tile(trials["trial"].to_numpy(), channel_count),
+        "condition": numpy.tile(trials["condition"].to_numpy(), channel_count),
+        "channel": numpy.repeat(sidecar["Channels"], trial_count),
+        "amplitude": amplitudes.ravel(),
+    })
+
+def main(epochs_paths: Iterable[PathLike], dat_paths: Iterable[PathLike], out_dir: PathLike, frequency: float=DRIVING_FREQUENCY, window: Optional[Tuple[float, float]]=None) -> Dict[str, str]:
+    """
+    Measures the ssVEP amplitude of every trial of many subjects.
+
+    Writes <out_dir>/<epochs>_ssvep.tsv for each epochs file. Returns a dict mapping each epochs file to its table.
+    """
+    out_dir = Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    out_paths = {}
+    for epochs_path, dat_path in zip(epochs_paths, dat_paths):
+        out_path = out_dir / f"{Path(epochs_path).stem}_ssvep.tsv"
+        amplitude_table(epochs_path, dat_path, frequency, window).to_csv(out_path, sep="\t", index=False)
+        out_paths[str(epochs_path)] = str(out_path)
+        print(f"Wrote ssVEP amplitudes of {epochs_path} to {out_path}")
+
+    return out_paths
+
+def _chunks(epochs: numpy.ndarray, chunk_size: int) -> Iterator[Tuple[slice, numpy.ndarray]]:
+    """
+    Yields the trials of epochs a chunk at a time as float32, along with the slice of trials each chunk covers.
+    """
+    for start in range(0, epochs.shape[1], chunk_size):
+        trials = slice(start, min(start + chunk_size, epochs.shape[1]))
+        yield trials, numpy.asarray(epochs[:, trials], dtype=numpy.float32)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the ssVEP amplitude of every trial.")
+    parser.add_argument("--epochs", nargs="+", required=True, help="Epochs written by epochs.py.")
+    parser.add_argument("--dats", nargs="+", required=True, help="The .dat file of each subject, in the same order.")
+    parser.add_argument("--out-dir", required=True, help="Directory to write amplitude tables to.")
+    parser.add_argument("--frequency", type=float, default=DRIVING_FREQUENCY, help="Frequency in Hz at which to measure the amplitude.")
+    parser.add_argument("--window", type=float, nargs=2, default=None, help="Time window in seconds relative to the marker to analyze.")
+    args = parser.parse_args()
+
+    main(args.epochs, args.dats, args.out_dir, args.frequency, args.window)
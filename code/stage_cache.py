@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Class to skip subprocess stages whose command, tool and inputs haven't changed since they last ran.
+
+Each invocation is keyed by a hash of its full argument list, the version of the tool it runs and the contents of its
+input files. Its outputs are kept in a shared content-addressed store and restored by hardlink the next time the same
+key comes up, so rerunning a pipeline after changing a late stage skips every unchanged stage before it. Objects are
+read-only, and so are the outputs linked to them, so a tool that edits an output in place fails instead of silently
+changing the cached copy every other run restores. Before a stage runs, its outputs that are still linked to the store
+are unlinked, so the stage writes fresh files. The store evicts its least recently used entries once it grows past a
+size limit. Processes sharing the store take a lock on it while they link objects in or out, so one never deletes an
+object another is about to commit.
+"""
+# Import external libraries and modules.
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import subprocess
+import time
+
+# Import CSEA libraries and modules.
+from materialize import materialize
+from tool_runner import ToolRunner
+from uptodate import SampledChecker
+
+STAGE_CACHE_DIR = Path(__file__).resolve().parent.parent / "outputs" / "stage-cache"
+
+# Write permission bits taken off every object.
+WRITE_BITS = 0o222
+
+# Options that only change how fast a tool runs, not what it writes. They and their value are left out of the key.
+SPEED_OPTIONS = {"-jobs"}
+
+@dataclass
+class StageCache():
+    """
+    Class to skip subprocess stages whose command, tool and inputs haven't changed since they last ran.
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        Directory of the shared store.
+    max_bytes : int
+        Size the store may grow to before its least recently used entries are evicted.
+    """
+    store_dir: PathLike = STAGE_CACHE_DIR
+    max_bytes: int = 50 << 30
+
+    def __post_init__(self):
+        self.store_dir = Path(self.store_dir)
+        self.checker = SampledChecker(self.store_dir / "file-hashes.sqlite")
+        self._connections = {}
+
+    def run(self, command: List[str], cwd: PathLike, inputs: Iterable[PathLike], outputs: Iterable[str], runner: Optional[ToolRunner]=None, stage: Optional[str]=None) -> bool:
+        """
+        Runs command in cwd, unless an identical run is cached, in which case its outputs are restored into cwd.
+
+        Returns true if the outputs came from the cache. Either way the run is profiled by runner.
+
+        Parameters
+        ----------
+        command : list of str
+            The command to run. Its first item is the tool.
+        cwd : str or Path
+            Directory to run the command in.
+        inputs : list of str or Path
+            Files the command reads. AFNI datasets given by their .HEAD bring their .BRIK along.
+        outputs : list of str
+            Glob patterns relative to cwd matching the files the command writes. Matched directories are stored whole.
+        runner : ToolRunner, optional
+            Runs and profiles the command. Defaults to one writing its profile into cwd.
+        stage : str, optional
+            Name to profile the run under. Defaults to the name of the tool.
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            If the command fails. Nothing is cached then.
+        """
+        cwd = Path(cwd).resolve()
+        runner = runner or ToolRunner(cwd / "profile.jsonl")
+        started = time.time()
+        key = self.key(command, inputs)
+        if self.restore(key, cwd):
+            print(f"Restored {command[0]} outputs from the stage cache into {cwd}")
+            runner.record(stage or Path(command[0]).name, Command=[str(argument) for argument in command], Start=started, WallSeconds=time.time() - started, ExitCode=0, Cached=True)
+            return True
+
+        self.release(cwd, outputs)
+        runner.run(command, cwd, stage)
+        self.store(key, cwd, outputs)
+        self.evict()
+
+        return False
+
+    def key(self, command: List[str], inputs: Iterable[PathLike]) -> str:
+        """
+        Returns the key of an invocation: a hash of its arguments, its tool's version and its inputs' contents.
+
+        Options in SPEED_OPTIONS are ignored, so a run given a different number of cores still hits the cache.
+        """
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        input_hashes = {}
+        for path in inputs:
+            for companion in _with_companions(Path(path).resolve()):
+                input_hashes[str(companion)] = self._hash(companion)
+
+        description = json.dumps({"command": _without_speed_options([str(argument) for argument in command]), "tool": tool_version(str(command[0])), "inputs": input_hashes}, sort_keys=True)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def restore(self, key: str, cwd: Path) -> bool:
+        """
+        Hardlinks the outputs cached under key into cwd. Returns false if nothing is cached under key.
+        """
+        row = self.connection.execute("SELECT files FROM entries WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return False
+
+        files = json.loads(row[0])
+        with self._locked():
+            if not all(self._object_path(digest).exists() for digest in files.values()):
+                return False
+            for relative_path, digest in files.items():
+                materialize(self._object_path(digest), cwd / relative_path, mode="hardlink")
+        with self.connection:
+            self.connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        return True
+
+    def store(self, key: str, cwd: Path, outputs: Iterable[str]) -> Dict[str, str]:
+        """
+        Hardlinks the outputs matching the patterns in cwd into the store under key. Returns the hash of each.
+        """
+        files = {str(file_path.relative_to(cwd)): self._hash(file_path) for file_path in _output_files(cwd, outputs)}
+
+        # Until the entry is committed its objects look unused, so hold off evict() in other processes.
+        with self._locked():
+            for relative_path, digest in files.items():
+                object_path = self._object_path(digest)
+                if not object_path.exists():
+                    materialize(cwd / relative_path, object_path, mode="hardlink")
+                object_path.chmod(object_path.stat().st_mode & ~WRITE_BITS)
+            size = sum(self._object_path(digest).stat().st_size for digest in set(files.values()))
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, json.dumps(files), size, time.time()))
+
+        return files
+
+    def release(self, cwd: PathLike, outputs: Iterable[str]) -> List[Path]:
+        """
+        Unlinks the outputs in cwd that are still linked to objects of the store, so writing new ones can't change the
+        objects. Returns the paths unlinked.
+        """
+        released = []
+        for path in _output_files(Path(cwd), outputs):
+            stat = path.stat()
+            if stat.st_nlink > 1 and not stat.st_mode & WRITE_BITS:
+                path.unlink()
+                released.append(path)
+
+        return released
+
+    def evict(self) -> None:
+        """
+        Drops the least recently used entries until the store fits in max_bytes, then deletes objects no entry uses.
+        """
+        with self._locked():
+            rows = self.connection.execute("SELECT key, files FROM entries ORDER BY last_used DESC").fetchall()
+            referenced = set()
+            total = 0
+            for key, files in rows:
+                new_objects = set(json.loads(files).values()) - referenced
+                size = sum(self._object_path(digest).stat().st_size for digest in new_objects if self._object_path(digest).exists())
+                if referenced and total + size > self.max_bytes:
+                    with self.connection:
+                        self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    continue
+                referenced |= new_objects
+                total += size
+
+            objects_dir = self.store_dir / "objects"
+            if objects_dir.exists():
+                for object_path in objects_dir.glob("*/*"):
+                    if object_path.name not in referenced:
+                        object_path.unlink()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Opens the index of the store the first time this thread needs it. SQLite connections can't be shared between threads.
+        """
+        if threading.get_ident() not in self._connections:
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            connection = self._connections[threading.get_ident()] = sqlite3.connect(self.store_dir / "index.sqlite", timeout=60)
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, files TEXT, size INTEGER, last_used REAL)")
+        return self._connections[threading.get_ident()]
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """
+        Holds an exclusive lock on the store until the block exits.
+        """
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.store_dir / "lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _object_path(self, digest: str) -> Path:
+        return self.store_dir / "objects" / digest[:2] / digest
+
+    def _hash(self, path: Path) -> str:
+        """
+        Returns the hash of a file's contents, reusing any hash computed before for the same version of the file.
+        """
+        return self.checker.hashes(path, os.stat(path), full=True)[1]
+
+@lru_cache(maxsize=None)
+def tool_version(program: str) -> str:
+    """
+    Returns a string that changes whenever the installed version of a program does.
+
+    Combines where the executable lives, its size and mtime, and whatever it prints for -ver, which AFNI programs
+    answer with their version.
+    """
+    executable = shutil.which(program)
+    if executable is None:
+        return "missing"
+
+    stat = os.stat(executable)
+    try:
+        version = subprocess.run([executable, "-ver"], capture_output=True, text=True, timeout=30).stdout.strip()
+    except (OSError, subprocess.TimeoutExpired):
+        version = ""
+
+    return f"{executable}:{stat.st_size}:{stat.st_mtime_ns}:{version}"
+
+def _without_speed_options(arguments: List[str]) -> List[str]:
+    """
+    Returns arguments without any option in SPEED_OPTIONS or the value that follows it.
+    """
+    kept = []
+    skip_value = False
+    for argument in arguments:
+        if skip_value:
+            skip_value = False
+        elif argument in SPEED_OPTIONS:
+            skip_value = True
+        else:
+            kept.append(argument)
+
+    return kept
+
+def _output_files(cwd: Path, outputs: Iterable[str]) -> List[Path]:
+    """
+    Returns every file in cwd matching the glob patterns in outputs. Matched directories bring every file inside them.
+    """
+    files = []
+    for pattern in outputs:
+        for path in sorted(cwd.glob(pattern)):
+            files += [path] if path.is_file() else sorted(child for child in path.rglob("*") if child.is_file())
+
+    return files
+
+def _with_companions(path: Path) -> List[Path]:
+    """
+    Returns path along with the .BRIK or .BRIK.gz that holds its data if it's the .HEAD of an AFNI dataset.
+    """
+    paths = [path]
+    if path.suffix == ".HEAD":
+        paths += [companion for companion in (path.with_suffix(".BRIK"), path.with_suffix(".BRIK.gz")) if companion.exists()]
+
+    return paths
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Stages of a parameter sweep over our fMRI analysis. dodo.py expands the grid into tasks that call these.
+
+Smoothing only depends on the blur and confound prep only depends on the regressor set, so each of them runs once per
+value and every variant that shares the value reads the same outputs. Only the GLM runs once per variant.
+"""
+# Import external libraries and modules.
+from os import PathLike
+from pathlib import Path
+from typing import Dict, List, Optional
+import json
+
+# Import CSEA libraries and modules.
+from deconvolve import REGRESSORS
+from materialize import materialize
+import confounds
+import glm
+import smooth_scale
+
+# Named sets of confounds a sweep can regress out.
+REGRESSOR_SETS = {
+    "all": REGRESSORS,
+    "motion": [name for name in REGRESSORS if name.startswith(("trans_", "rot_"))],
+    "basic": "csf white_matter trans_x trans_y trans_z rot_x rot_y rot_z".split(),
+}
+
+def smooth(func_path: PathLike, mask_path: PathLike, out_dir: PathLike, subject_id: str, fwhm: float) -> Dict[str, str]:
+    """
+    Smooths and scales the in-mask voxels of a functional image, keeping them as a MaskedSeries in out_dir.
+    """
+    series = smooth_scale.smooth_and_scale(func_path, out_dir, subject_id, mask_path, fwhm)
+    return {"series": str(series.data.filename)}
+
+def confound_matrix(tsv_path: PathLike, regressor_set: str, out_path: PathLike, components: Optional[float]=None) -> Dict[str, str]:
+    """
+    Writes the nuisance matrix of a regressor set to out_path. The matrix itself lives in the confounds cache.
+    """
+    cached_path = confounds.main(tsv_path, REGRESSOR_SETS[regressor_set], components=components)
+    return {"confounds": str(materialize(cached_path, out_path, mode="hardlink"))}
+
+def fit(series_path: PathLike, events_tsv: PathLike, confounds_path: PathLike, out_dir: PathLike, subject_id: str, basis: str, remove_first_trs: int) -> Dict[str, str]:
+    """
+    Fits the GLM of one variant for one subject.
+    """
+    return glm.main(series_path, events_tsv, out_dir, subject_id, confounds_path, basis, remove_first_trs=remove_first_trs)
+
+def write_manifest(variants: List[Dict], path: PathLike) -> Dict[str, str]:
+    """
+    Writes a JSON manifest listing the parameters and output directory of every variant.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as manifest_file:
+        json.dump({"Variants": variants}, manifest_file, indent="\t")
+
+    return {"manifest": str(path)}
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Tests that Events names each trial after the condition column of its .dat file.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+import pandas
+
+# Import CSEA libraries and modules.
+from dat import Dat
+from events import Events
+from vmrk import Vmrk
+
+VMRK_TEXT = """Brain Vision Data Exchange Marker File, Version 1.0
+
+[Common Infos]
+Codepage=UTF-8
+DataFile=sub-999.eeg
+SamplingInterval=200
+
+[Marker Infos]
+Mk1=New Segment,,1,1,0,20200101120000000000
+Mk2=Response,R128,5001,1,0
+Mk3=Stimulus,S  2,6001,1,0
+Mk4=Response,R128,15001,1,0
+Mk5=Stimulus,S  2,16001,1,0
+Mk6=Response,R128,25001,1,0
+Mk7=Stimulus,S  2,26001,1,0
+Mk8=Stimulus,S  2,31001,1,0
+"""
+
+# Columns: subject, phase, trial, condition, duration. Trial numbers and conditions differ on purpose.
+DAT_TEXT = """999 1 1 4 2.0
+999 1 2 1 2.0
+999 1 3 4 2.0
+999 1 4 1 2.0
+"""
+
+def _events(tmp_path: Path, **kwargs) -> Events:
+    vmrk_path = tmp_path / "sub-999.vmrk"
+    dat_path = tmp_path / "sub-999.dat"
+    vmrk_path.write_text(VMRK_TEXT)
+    dat_path.write_text(DAT_TEXT)
+    return Events(Vmrk(vmrk_path), Dat(dat_path), **kwargs)
+
+def test_trial_types_are_conditions(tmp_path):
+    tsv_path = _events(tmp_path).write_tsv(tmp_path / "events.tsv")
+    events = pandas.read_table(tsv_path, dtype={"trial_type": str})
+
+    assert events["trial_type"].tolist() == ["4", "1", "4", "1"]
+
+def test_condition_names(tmp_path):
+    tsv_path = _events(tmp_path, condition_names={1: "low", 4: "high"}).write_tsv(tmp_path / "events.tsv")
+    events = pandas.read_table(tsv_path)
+
+    assert events["trial_type"].tolist() == ["high", "low", "high", "low"]
+
+def test_one_stim_times_file_per_condition(tmp_path):
+    paths = _events(tmp_path).write_stim_times(tmp_path / "stim_times")
+
+    assert sorted(paths) == ["1", "4"]
+    assert sorted(path.name for path in (tmp_path / "stim_times").iterdir()) == ["stim_times_1.1D", "stim_times_4.1D"]
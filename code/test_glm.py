@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Tests that the response bases of glm.py build the same regressors as 3dDeconvolve.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+import shutil
+import subprocess
+import numpy
+import pytest
+
+# Import CSEA libraries and modules.
+import glm
+
+BASES = ["CSPLINzero(0,18,10)", "CSPLIN(0,18,10)", "TENTzero(0,18,10)"]
+
+# Stimulus onsets in seconds, placed so TR=1 samples land both on and between the knots of every basis.
+ONSETS = [5.0, 27.0, 50.5]
+
+@pytest.mark.parametrize("spec", BASES)
+def test_basis_is_cardinal_at_its_knots(spec):
+    basis = glm.Basis.parse(spec)
+
+    numpy.testing.assert_allclose(basis(basis.knots), numpy.eye(basis.knots.size), atol=1e-12)
+
+@pytest.mark.skipif(shutil.which("3dDeconvolve") is None, reason="3dDeconvolve isn't on the PATH")
+@pytest.mark.parametrize("spec", BASES)
+def test_basis_matches_3ddeconvolve_x1d(tmp_path: Path, spec):
+    time_count, repetition_time = 80, 1.0
+    command = [
+        "3dDeconvolve",
+        "-nodata", str(time_count), str(repetition_time),
+        "-polort", "0",
+        "-num_stimts", "1",
+        "-stim_times", "1", "1D: " + " ".join(f"{onset:g}" for onset in ONSETS), spec,
+        "-x1D", "X.xmat.1D",
+        "-x1D_stop",
+    ]
+    subprocess.run(command, cwd=tmp_path, check=True, capture_output=True)
+    afni_columns = numpy.loadtxt(tmp_path / "X.xmat.1D", comments="#", ndmin=2)
+
+    design = glm.build_design(time_count, repetition_time, {"stim": numpy.array(ONSETS)}, glm.Basis.parse(spec), polort=0)
+    numpy.testing.assert_allclose(design.matrix[:, design.stimuli["stim"]], afni_columns[:, 1:], atol=1e-4)
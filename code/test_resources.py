@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Tests that the resource ledger admits tasks only while their budgets fit on the node and forgets tasks that died.
+"""
+# Import external libraries and modules.
+from functools import partial
+from pathlib import Path
+import json
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import threading
+import pytest
+
+# Import CSEA libraries and modules.
+import resources
+from history import History
+from resources import THREAD_VARIABLES, ResourcedAction, claim, node_capacity, thread_environment
+
+# Seconds to wait for a claim before failing.
+TIMEOUT_SECONDS = 30
+
+@pytest.fixture
+def ledger_path(tmp_path: Path) -> Path:
+    return tmp_path / "ledger.json"
+
+def claims(ledger_path: Path):
+    text = ledger_path.read_text()
+    return json.loads(text) if text else {}
+
+def fill_node(ledger_path: Path, pid: int) -> None:
+    """
+    Writes a claim on every core of the node for process pid into the ledger.
+    """
+    ledger_path.write_text(json.dumps({str(pid): {"cores": node_capacity()["cores"], "memory_gb": 0.0, "label": "other", "since": 0.0}}))
+
+def cores_in_thread_variables():
+    return {os.environ.get(name) for name in THREAD_VARIABLES}
+
+def add(a, b):
+    return a + b
+
+def test_claim_is_held_until_the_block_exits(ledger_path):
+    with claim(1, 0.1, "task", ledger_path) as cores:
+        assert cores == 1
+        assert claims(ledger_path)[str(os.getpid())]["label"] == "task"
+
+    assert claims(ledger_path) == {}
+
+def test_budget_bigger_than_the_node_is_cut_down(ledger_path):
+    with claim(10 ** 6, 0.1, "task", ledger_path) as cores:
+        assert cores == node_capacity()["cores"]
+
+def test_claim_of_a_dead_process_is_dropped(ledger_path):
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    fill_node(ledger_path, process.pid)
+
+    with claim(1, 0.1, "task", ledger_path, poll_seconds=60):
+        assert list(claims(ledger_path)) == [str(os.getpid())]
+
+def test_claim_waits_for_a_running_process_to_free_the_node(ledger_path):
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"])
+    fill_node(ledger_path, process.pid)
+    granted = threading.Event()
+
+    def wait_for_claim():
+        with claim(1, 0.1, "task", ledger_path, poll_seconds=0.05):
+            granted.set()
+
+    waiter = threading.Thread(target=wait_for_claim)
+    waiter.start()
+    try:
+        assert not granted.wait(0.5)
+    finally:
+        process.kill()
+        process.wait()
+    assert granted.wait(TIMEOUT_SECONDS)
+    waiter.join()
+
+def test_thread_environment_is_restored(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "7")
+    monkeypatch.delenv("PIPELINE_CORES", raising=False)
+
+    with thread_environment(3):
+        assert cores_in_thread_variables() == {"3"}
+        assert resources.allotted_cores() == 3
+
+    assert os.environ["OMP_NUM_THREADS"] == "7"
+    assert "PIPELINE_CORES" not in os.environ
+
+def test_resourced_action_runs_in_its_budget_and_is_recorded(tmp_path, ledger_path, monkeypatch):
+    history_path = tmp_path / "history.sqlite"
+    monkeypatch.setattr(resources, "claim", partial(claim, ledger_path=ledger_path))
+    monkeypatch.setattr(resources, "History", partial(History, history_path))
+    action = ResourcedAction(add, cores=1, memory_gb=0.1, task="glm 104")
+
+    assert pickle.loads(pickle.dumps(action))(1, 2) == 3
+
+    rows = sqlite3.connect(history_path).execute("SELECT task, stage, cores, succeeded FROM runs").fetchall()
+    assert rows == [("glm 104", "glm", 1, 1)]
+    assert claims(ledger_path) == {}
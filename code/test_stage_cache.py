@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Tests that StageCache reruns a stage only when its command or inputs change, and that nothing a stage writes can
+change what the store holds.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+import shutil
+import sys
+from typing import List
+import pytest
+
+# Import CSEA libraries and modules.
+from stage_cache import WRITE_BITS, StageCache
+from tool_runner import ToolRunner
+
+# Counts its runs in calls.log, then writes its input upper-cased into out.txt and into results/ in cwd.
+TOOL = """
+import pathlib, sys
+with open("calls.log", "a") as log_file:
+    log_file.write("run\\n")
+text = pathlib.Path(sys.argv[1]).read_text().upper()
+pathlib.Path("out.txt").write_text(text)
+pathlib.Path("results").mkdir(exist_ok=True)
+pathlib.Path("results", "copy.txt").write_text(text)
+"""
+
+OUTPUTS = ["out.txt", "results"]
+
+@pytest.fixture
+def cache(tmp_path: Path) -> StageCache:
+    return StageCache(tmp_path / "store")
+
+def make_subject(tmp_path: Path, text: str) -> Path:
+    cwd = tmp_path / "sub-1"
+    cwd.mkdir(exist_ok=True)
+    (cwd / "in.txt").write_text(text)
+    return cwd
+
+def run(cache: StageCache, cwd: Path, *options: str) -> bool:
+    command = [sys.executable, "-c", TOOL, "in.txt", *options]
+    return cache.run(command, cwd, [cwd / "in.txt"], OUTPUTS, ToolRunner(cwd / "profile.jsonl"), stage="tool")
+
+def clean(cwd: Path) -> None:
+    (cwd / "out.txt").unlink()
+    shutil.rmtree(cwd / "results")
+
+def calls(cwd: Path) -> int:
+    return len((cwd / "calls.log").read_text().split())
+
+def objects(cache: StageCache) -> List[str]:
+    return sorted(path.read_text() for path in (cache.store_dir / "objects").glob("*/*"))
+
+def test_identical_run_is_restored_instead_of_rerun(tmp_path, cache):
+    cwd = make_subject(tmp_path, "bold")
+    assert not run(cache, cwd)
+    clean(cwd)
+
+    assert run(cache, cwd)
+    assert calls(cwd) == 1
+    assert (cwd / "out.txt").read_text() == (cwd / "results" / "copy.txt").read_text() == "BOLD"
+    assert objects(cache) == ["BOLD"]
+
+def test_changed_command_or_inputs_rerun_the_stage(tmp_path, cache):
+    cwd = make_subject(tmp_path, "bold")
+    run(cache, cwd)
+
+    assert not run(cache, cwd, "-verbose")
+    make_subject(tmp_path, "anat")
+    assert not run(cache, cwd)
+    assert calls(cwd) == 3
+    assert (cwd / "out.txt").read_text() == "ANAT"
+
+def test_key_ignores_speed_options_only(tmp_path, cache):
+    cwd = make_subject(tmp_path, "bold")
+    inputs = [cwd / "in.txt"]
+    key = cache.key(["3dDeconvolve", "-input", "in.txt", "-jobs", "4"], inputs)
+
+    assert cache.key(["3dDeconvolve", "-input", "in.txt", "-jobs", "16"], inputs) == key
+    assert cache.key(["3dDeconvolve", "-input", "in.txt"], inputs) == key
+    assert cache.key(["3dDeconvolve", "-input", "in.txt", "-polort", "2"], inputs) != key
+
+def test_objects_and_restored_outputs_are_read_only(tmp_path, cache):
+    cwd = make_subject(tmp_path, "bold")
+    run(cache, cwd)
+    clean(cwd)
+    run(cache, cwd)
+
+    for path in list((cache.store_dir / "objects").glob("*/*")) + [cwd / "out.txt", cwd / "results" / "copy.txt"]:
+        assert not path.stat().st_mode & WRITE_BITS
+
+def test_rerun_over_restored_outputs_leaves_the_store_alone(tmp_path, cache):
+    cwd = make_subject(tmp_path, "bold")
+    run(cache, cwd)
+    clean(cwd)
+    run(cache, cwd)
+
+    # A new input makes the stage rerun where the restored outputs still link to the store.
+    make_subject(tmp_path, "anat")
+    assert not run(cache, cwd)
+
+    assert (cwd / "out.txt").read_text() == "ANAT"
+    assert objects(cache) == ["ANAT", "BOLD"]
+    make_subject(tmp_path, "bold")
+    assert run(cache, cwd)
+    assert (cwd / "out.txt").read_text() == "BOLD"
+
+def test_release_unlinks_only_outputs_linked_to_the_store(tmp_path, cache):
+    cwd = make_subject(tmp_path, "bold")
+    run(cache, cwd)
+    (cwd / "notes.txt").write_text("mine")
+
+    # results/copy.txt holds the same bytes as out.txt, whose link became the object, so it stays a file of its own.
+    assert cache.release(cwd, OUTPUTS + ["notes.txt"]) == [cwd / "out.txt"]
+    assert (cwd / "results" / "copy.txt").exists()
+    assert not (cwd / "out.txt").exists()
+    assert (cwd / "notes.txt").exists()
+
+def test_evict_drops_least_recently_used_entries(tmp_path):
+    cache = StageCache(tmp_path / "store", max_bytes=6)
+    cwd = make_subject(tmp_path, "bold")
+    run(cache, cwd)
+    make_subject(tmp_path, "anat")
+    run(cache, cwd)
+
+    assert objects(cache) == ["ANAT"]
+    assert run(cache, cwd)
+    make_subject(tmp_path, "bold")
+    assert not run(cache, cwd)
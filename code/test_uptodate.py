@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Tests that SampledChecker tells changed file dependencies from touched ones and never hashes a version twice.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+import os
+import pytest
+
+# Import CSEA libraries and modules.
+import uptodate
+from uptodate import SampledChecker
+
+@pytest.fixture
+def checker(tmp_path: Path) -> SampledChecker:
+    return SampledChecker(tmp_path / "hashes.sqlite")
+
+@pytest.fixture
+def dependency(tmp_path: Path) -> Path:
+    path = tmp_path / "bold.nii"
+    path.write_bytes(bytes(range(256)) * 64)
+    return path
+
+def touch(path: Path) -> None:
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def saved_state(checker: SampledChecker, path: Path):
+    return checker.get_state(str(path), None)
+
+def test_untouched_file_is_unchanged(checker, dependency):
+    state = saved_state(checker, dependency)
+
+    assert not checker.check_modified(str(dependency), dependency.stat(), state)
+    assert checker.get_state(str(dependency), state) is None
+
+def test_touched_file_with_the_same_contents_is_unchanged(checker, dependency):
+    state = saved_state(checker, dependency)
+    touch(dependency)
+
+    assert not checker.check_modified(str(dependency), dependency.stat(), state)
+
+@pytest.mark.parametrize("contents", [b"\xff" * 256 * 64, b"\x00" * 100])
+def test_rewritten_file_is_changed(checker, dependency, contents):
+    state = saved_state(checker, dependency)
+    dependency.write_bytes(contents)
+    touch(dependency)
+
+    assert checker.check_modified(str(dependency), dependency.stat(), state)
+
+def test_state_saved_by_another_checker_counts_as_changed(checker, dependency):
+    assert checker.check_modified(str(dependency), dependency.stat(), "d41d8cd98f00b204e9800998ecf8427e")
+    assert checker.check_modified(str(dependency), dependency.stat(), None)
+
+def test_each_version_is_hashed_once(tmp_path, dependency, monkeypatch):
+    calls = []
+    full_file_hash = uptodate.full_file_hash
+    monkeypatch.setattr(uptodate, "full_file_hash", lambda path: calls.append(path) or full_file_hash(path))
+
+    state = saved_state(SampledChecker(tmp_path / "hashes.sqlite"), dependency)
+    touch(dependency)
+    for _ in range(3):
+        # A new checker every time, like every doit invocation.
+        assert not SampledChecker(tmp_path / "hashes.sqlite").check_modified(str(dependency), dependency.stat(), state)
+
+    assert len(calls) == 2
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Tests that several workers sharing a WorkQueue run every task exactly once, in dependency order, and pick up the
+tasks of a worker that died.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import pytest
+
+# Import CSEA libraries and modules.
+import work_queue
+from work_queue import WorkQueue
+
+# Seconds to wait for the workers before failing.
+TIMEOUT_SECONDS = 60
+
+# Appends the task's name to runs.log in cwd. While a file named "block" exists, it then writes its pid and hangs.
+COMMAND = """
+import os, sys, time
+with open("runs.log", "a") as log_file:
+    log_file.write(sys.argv[1] + "\\n")
+if os.path.exists("block"):
+    with open(sys.argv[1] + ".pid", "w") as pid_file:
+        pid_file.write(str(os.getpid()))
+    time.sleep(600)
+"""
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(work_queue, "POLL_SECONDS", 0.05)
+    monkeypatch.setattr(work_queue, "HEARTBEAT_SECONDS", 0.2)
+
+def put(queue: WorkQueue, cwd: Path, name: str, dependencies=(), predicted_seconds: float=0.0) -> None:
+    queue.put(name, [sys.executable, "-c", COMMAND, name], cwd, dependencies, predicted_seconds)
+
+def start_workers(queue: WorkQueue, count: int, prefix: str="worker"):
+    # Fork, so the workers inherit the patched polling intervals.
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=work_queue.work, args=(queue, f"{prefix}{i}")) for i in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+def join(workers) -> None:
+    for worker in workers:
+        worker.join(TIMEOUT_SECONDS)
+        assert worker.exitcode == 0, f"{worker.name} didn't finish cleanly"
+
+def wait_for(path: Path) -> None:
+    deadline = time.monotonic() + TIMEOUT_SECONDS
+    while not path.exists():
+        assert time.monotonic() < deadline, f"{path} never appeared"
+        time.sleep(0.05)
+
+def runs(cwd: Path):
+    return (cwd / "runs.log").read_text().split()
+
+def test_workers_run_every_task_once_after_its_dependencies(tmp_path: Path):
+    queue = WorkQueue(tmp_path / "queue")
+    names = [f"task{i}" for i in range(20)]
+    for i, name in enumerate(names):
+        # Every fifth task waits for the four before it.
+        put(queue, tmp_path, name, names[i - 4:i] if i % 5 == 4 else (), predicted_seconds=i)
+
+    join(start_workers(queue, 4))
+
+    assert sorted(runs(tmp_path)) == sorted(names)
+    assert sorted(unit["Name"] for unit in queue.units("done")) == sorted(names)
+    assert not queue.units("pending") and not queue.units("claimed") and not queue.units("failed")
+    order = runs(tmp_path)
+    for i in range(4, len(names), 5):
+        assert all(order.index(dependency) < order.index(names[i]) for dependency in names[i - 4:i])
+
+def test_put_ignores_a_task_already_in_the_queue(tmp_path: Path):
+    queue = WorkQueue(tmp_path / "queue")
+    put(queue, tmp_path, "task")
+
+    assert not queue.put("task", ["true"], tmp_path)
+    assert queue.state("task") == "pending"
+
+def test_claim_of_a_killed_worker_is_requeued_and_run_once_more(tmp_path: Path):
+    queue = WorkQueue(tmp_path / "queue", stale_seconds=1)
+    put(queue, tmp_path, "slow", predicted_seconds=10)
+    for i in range(5):
+        put(queue, tmp_path, f"task{i}", ["slow"])
+
+    (tmp_path / "block").touch()
+    doomed, = start_workers(queue, 1, prefix="doomed")
+    wait_for(tmp_path / "slow.pid")
+    doomed.kill()
+    doomed.join()
+    os.kill(int((tmp_path / "slow.pid").read_text()), signal.SIGKILL)
+    (tmp_path / "block").unlink()
+    assert queue.state("slow") == "claimed"
+
+    join(start_workers(queue, 3))
+
+    assert runs(tmp_path).count("slow") == 2
+    assert sorted(runs(tmp_path)) == sorted(["slow", "slow"] + [f"task{i}" for i in range(5)])
+    done = {unit["Name"]: unit for unit in queue.units("done")}
+    assert sorted(done) == sorted(["slow"] + [f"task{i}" for i in range(5)])
+    assert not done["slow"]["Worker"].startswith("doomed")
+
+def test_finish_fails_once_the_claim_was_taken_away(tmp_path: Path):
+    queue = WorkQueue(tmp_path / "queue", stale_seconds=0)
+    put(queue, tmp_path, "task")
+    unit = queue.claim("first")
+
+    assert queue.requeue_stale() == ["task"]
+    assert not queue.heartbeat(unit)
+    assert not queue.finish(unit, 0)
+    assert queue.state("task") == "pending"
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Run the external tools of our pipeline, like AFNI programs, and profile every invocation.
+
+Each run appends one JSON line to a profile next to the subject's outputs with its wall and CPU time, the peak memory
+and block I/O of the tool and every process it waited for, and its exit code. The tool's output goes to a log beside
+the profile. From the command line this module sums the profiles up into a table per stage and subject.
+"""
+# Import external libraries and modules.
+from dataclasses import dataclass
+from os import PathLike
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+import argparse
+import json
+import os
+import subprocess
+import time
+
+# Import CSEA libraries and modules.
+from history import note_child_peak
+
+# Bytes in one block of ru_inblock and ru_oublock.
+BLOCK_SIZE = 512
+
+# Lines from the end of a failed tool's log to put in the error.
+ERROR_TAIL_LINES = 20
+
+@dataclass
+class ToolRunner():
+    """
+    Class to run the external tools of one subject, appending a profile of every run to profile_path.
+
+    Parameters
+    ----------
+    profile_path : str or Path
+        JSON-lines file to append each run's profile to. Tool output goes to logs/<stage>.log in the same directory.
+    subject_id : str, optional
+        Subject the tools run for.
+    """
+    profile_path: PathLike
+    subject_id: Optional[str] = None
+
+    def __post_init__(self):
+        self.profile_path = Path(self.profile_path)
+
+    def run(self, command: List[str], cwd: PathLike, stage: Optional[str]=None, check: bool=True) -> Dict[str, Any]:
+        """
+        Runs command in cwd and returns its profile.
+
+        Peak memory and I/O come from the rusage of the tool, which covers every process it waited for. I/O is
+        counted in blocks that hit the disk, so reads served by the page cache don't count.
+
+        Parameters
+        ----------
+        command : list of str
+            The command to run. Its first item is the tool.
+        cwd : str or Path
+            Directory to run the command in.
+        stage : str, optional
+            Name to file the run under. Defaults to the name of the tool.
+        check : bool
+            Raise CalledProcessError if the tool fails.
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            If check is true and the tool exits with anything but 0. The error's output holds the end of the log.
+        """
+        command = [str(argument) for argument in command]
+        stage = stage or Path(command[0]).name
+        log_path = self.log_path(stage)
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+
+        started = time.time()
+        start_wall = time.perf_counter()
+        with open(log_path, "a") as log_file:
+            log_file.write(f"$ {' '.join(command)}\n")
+            log_file.flush()
+            process = subprocess.Popen(command, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT)
+            _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        note_child_peak(usage.ru_maxrss / 1024)
+
+        profile = self.record(
+            stage,
+            Command=command,
+            Start=started,
+            WallSeconds=time.perf_counter() - start_wall,
+            UserSeconds=usage.ru_utime,
+            SystemSeconds=usage.ru_stime,
+            MaxRSSMB=usage.ru_maxrss / 1024,
+            BytesRead=usage.ru_inblock * BLOCK_SIZE,
+            BytesWritten=usage.ru_oublock * BLOCK_SIZE,
+            ExitCode=process.returncode,
+            Cached=False,
+            Log=str(log_path),
+        )
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, output=_tail(log_path, ERROR_TAIL_LINES))
+
+        return profile
+
+    def record(self, stage: str, **fields) -> Dict[str, Any]:
+        """
+        Appends a profile of a stage to the profile of this subject and returns it.
+        """
+        profile = {"Stage": stage, "Subject": self.subject_id, **fields}
+        self.profile_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.profile_path, "a") as profile_file:
+            profile_file.write(json.dumps(profile) + "\n")
+
+        return profile
+
+    def log_path(self, stage: str) -> Path:
+        """
+        Returns where the output of a stage goes.
+        """
+        return self.profile_path.parent / "logs" / f"{stage}.log"
+
+def read_profiles(paths: Iterable[PathLike]) -> List[Dict[str, Any]]:
+    """
+    Returns every record in the profiles found at or below paths.
+    """
+    records = []
+    for path in map(Path, paths):
+        for profile_path in ([path] if path.is_file() else sorted(path.rglob("profile.jsonl"))):
+            with open(profile_path) as profile_file:
+                records += [json.loads(line) for line in profile_file if line.strip()]
+
+    return records
+
+def summarize(records: Iterable[Dict[str, Any]]) -> str:
+    """
+    Returns a table with one row per stage and subject, totalling the time and I/O of their runs.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault((record["Stage"], str(record["Subject"])), []).append(record)
+
+    lines = [f"{'stage':<20}{'subject':<10}{'runs':>6}{'cached':>8}{'failed':>8}{'wall s':>10}{'cpu s':>10}{'max MB':>10}{'read MB':>10}{'write MB':>10}"]
+    for (stage, subject), runs in sorted(groups.items()):
+        ran = [run for run in runs if not run.get("Cached")]
+        lines.append(
+            f"{stage:<20}{subject:<10}{len(runs):>6}{len(runs) - len(ran):>8}{sum(run['ExitCode'] != 0 for run in runs):>8}"
+            f"{sum(run['WallSeconds'] for run in runs):>10.1f}"
+            f"{sum(run.get('UserSeconds', 0) + run.get('SystemSeconds', 0) for run in ran):>10.1f}"
+            f"{max((run.get('MaxRSSMB', 0) for run in ran), default=0):>10.0f}"
+            f"{sum(run.get('BytesRead', 0) for run in ran) / 1e6:>10.1f}"
+            f"{sum(run.get('BytesWritten', 0) for run in ran) / 1e6:>10.1f}"
+        )
+
+    return "\n".join(lines)
+
+def _tail(path: Path, line_count: int) -> str:
+    with open(path, errors="replace") as text_file:
+        return "".join(text_file.readlines()[-line_count:])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the profiles of the external tools our pipeline ran, per stage and subject.")
+    parser.add_argument("paths", nargs="*", default=[str(Path(__file__).resolve().parent.parent / "outputs")], help="Profiles, or directories to search for profile.jsonl files. Defaults to ../outputs.")
+    args = parser.parse_args()
+
+    print(summarize(read_profiles(args.paths)))
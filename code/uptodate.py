@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Class to check whether doit's file dependencies have changed without reading gigabytes of data.
+
+doit's default checker falls back to an md5 of the full file whenever a file's mtime changes. Because doit doesn't
+save new state for tasks that turn out to be up to date, a file that was merely touched gets hashed again on every
+single invocation. Our checker compares cheap signatures first and remembers every hash it computes in a small
+SQLite database keyed by path, size, mtime and inode, so no version of a file is ever hashed twice.
+"""
+# Import external libraries and modules.
+from os import PathLike
+from pathlib import Path
+from typing import Optional, Tuple
+import hashlib
+import os
+import sqlite3
+import threading
+
+from doit.dependency import FileChangedChecker
+
+# Import CSEA libraries and modules.
+from materialize import fast_hash
+
+HASH_CACHE_PATH = Path(__file__).resolve().parent.parent / "outputs" / "uptodate-hashes.sqlite"
+
+class SampledChecker(FileChangedChecker):
+    """
+    Class to check whether doit's file dependencies have changed without reading gigabytes of data.
+
+    The state of each file is (mtime, size, sampled hash, full hash). A file is unchanged if its mtime and size are
+    the same. It has changed if its size or sampled hash differ. Only if the size and sampled hash match but the mtime
+    doesn't do we compare full hashes.
+
+    Use it by setting DOIT_CONFIG["check_file_uptodate"] = SampledChecker.
+    """
+
+    def __init__(self, cache_path: PathLike=HASH_CACHE_PATH):
+        self.cache_path = Path(cache_path)
+        self._connections = {}
+
+    def check_modified(self, file_path, file_stat, state) -> bool:
+        """
+        Returns true if file_path has changed since state was saved.
+        """
+        if state is None or len(state) != 4:
+            return True
+
+        mtime, size, sampled_hash, full_hash = state
+        if file_stat.st_size != size:
+            return True
+        if file_stat.st_mtime_ns == mtime:
+            return False
+        if self.hashes(file_path, file_stat, full=False)[0] != sampled_hash:
+            return True
+
+        return self.hashes(file_path, file_stat, full=True)[1] != full_hash
+
+    def get_state(self, dep, current_state) -> Optional[Tuple]:
+        """
+        Returns the state to save for dep after its task ran. Returns None if dep hasn't changed.
+        """
+        file_stat = os.stat(dep)
+        if current_state is not None and len(current_state) == 4 and (current_state[0], current_state[1]) == (file_stat.st_mtime_ns, file_stat.st_size):
+            return None
+
+        sampled_hash, full_hash = self.hashes(dep, file_stat, full=True)
+        return file_stat.st_mtime_ns, file_stat.st_size, sampled_hash, full_hash
+
+    def hashes(self, path: PathLike, file_stat: os.stat_result, full: bool) -> Tuple[str, Optional[str]]:
+        """
+        Returns the sampled hash and, if full is true, the full hash of a file. Reuses any hash computed before for
+        the same version of the file.
+        """
+        key = (str(Path(path).resolve()), file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        row = self.connection.execute("SELECT sampled, full FROM hashes WHERE path = ? AND size = ? AND mtime = ? AND inode = ?", key).fetchone()
+        sampled_hash, full_hash = row if row else (None, None)
+
+        if sampled_hash is None:
+            sampled_hash = fast_hash(path)
+        if full and full_hash is None:
+            full_hash = full_file_hash(path)
+        if row != (sampled_hash, full_hash):
+            with self.connection:
+                self.connection.execute("DELETE FROM hashes WHERE path = ?", key[:1])
+                self.connection.execute("INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?)", key + (sampled_hash, full_hash))
+
+        return sampled_hash, full_hash
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Opens the hash cache the first time this thread needs it. SQLite connections can't be shared between threads.
+        """
+        if threading.get_ident() not in self._connections:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            connection = self._connections[threading.get_ident()] = sqlite3.connect(self.cache_path, timeout=60)
+            connection.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, sampled TEXT, full TEXT)")
+        return self._connections[threading.get_ident()]
+
+def full_file_hash(path: PathLike, block_size: int=1 << 22) -> str:
+    """
+    Hashes the full contents of a file.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as in_file:
+        for block in iter(lambda: in_file.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
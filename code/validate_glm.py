@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Check glm.py against a synthetic dataset with a known response, and against 3dDeconvolve when AFNI is installed.
+
+Builds a small image whose voxels respond to a train of stimuli with a known IRF on top of drift, nuisance signals and
+noise. Exits with status 1 if the recovered IRF strays from the truth, or from 3dDeconvolve's, by more than the
+tolerance.
+"""
+# Import external libraries and modules.
+from pathlib import Path
+from typing import Dict
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import nibabel
+import numpy
+import pandas
+
+# Import CSEA libraries and modules.
+import confounds
+import glm
+from masked import MaskedSeries
+
+def main(basis: str="CSPLINzero(0,18,10)", tolerance: float=0.05, seed: int=0) -> bool:
+    """
+    Returns true if glm.py recovers the synthetic IRF, and matches 3dDeconvolve if it's on the PATH.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        inputs = make_dataset(work_dir, glm.Basis.parse(basis), seed)
+        outputs = glm.main(inputs["series"], inputs["events_tsv"], work_dir / "glm", "synthetic", inputs["confounds"], basis)
+
+        irf = MaskedSeries.from_image(outputs["IRF"], inputs["mask_path"]).data
+        error = numpy.abs(irf - inputs["irf"]).max() / numpy.abs(inputs["irf"]).max()
+        print(f"glm.py vs truth: largest IRF error {error:.4f} of the peak response")
+        passed = error <= tolerance
+
+        if shutil.which("3dDeconvolve"):
+            afni_irf = MaskedSeries.from_image(run_3ddeconvolve(work_dir, inputs, basis), inputs["mask_path"]).data
+            error = numpy.abs(irf - afni_irf).max() / numpy.abs(afni_irf).max()
+            print(f"glm.py vs 3dDeconvolve: largest IRF difference {error:.4f} of the peak response")
+            passed = passed and error <= tolerance
+        else:
+            print("3dDeconvolve isn't on the PATH. Skipped the comparison against AFNI.")
+
+    return passed
+
+def make_dataset(work_dir: Path, basis: glm.Basis, seed: int, shape=(6, 5, 4), time_count: int=300, repetition_time: float=2.0) -> Dict:
+    """
+    Writes a synthetic scaled image, its mask, an events file and a confounds file into work_dir.
+    """
+    rng = numpy.random.default_rng(seed)
+    onsets = numpy.sort(rng.choice(numpy.arange(4, time_count * repetition_time - 30, 2.0), size=40, replace=False))
+    nuisance = pandas.DataFrame({"trans_x": rng.normal(size=time_count).cumsum() / 10, "csf": rng.normal(size=time_count)})
+    design = glm.build_design(time_count, repetition_time, {"all": onsets}, basis, nuisance, "A")
+
+    # Every voxel gets a scaled copy of the same response shape plus its own drift, nuisance weights and noise.
+    mask = numpy.zeros(shape, dtype=bool)
+    mask[1:-1, 1:-1, :] = True
+    voxel_count = int(mask.sum())
+    response = numpy.sin(numpy.pi * basis.knots / basis.stop)
+    amplitudes = rng.uniform(0.5, 2.0, size=voxel_count)
+    stimulus_columns = design.stimuli["all"]
+    betas = rng.normal(size=(voxel_count, design.matrix.shape[1]))
+    betas[:, stimulus_columns] = amplitudes[:, numpy.newaxis] * response
+    data = betas @ design.matrix.T + rng.normal(scale=0.1, size=(voxel_count, time_count))
+
+    header = nibabel.Nifti1Header()
+    header.set_data_shape(shape + (time_count,))
+    header.set_zooms((3.0, 3.0, 3.0, repetition_time))
+    series = MaskedSeries(mask, data.astype(numpy.float32), header)
+    series_path = series.save(work_dir / "scaled")
+    image_path = series.write(work_dir / "scaled.nii")
+    nibabel.save(nibabel.Nifti1Image(mask.astype(numpy.uint8), numpy.eye(4)), work_dir / "mask.nii.gz")
+
+    pandas.DataFrame({"onset": onsets, "duration": 0.0, "trial_type": "all"}).to_csv(work_dir / "events.tsv", sep="\t", index=False)
+    nuisance.to_csv(work_dir / "confounds.tsv", sep="\t", index=False)
+    confounds_path = confounds.main(work_dir / "confounds.tsv", list(nuisance), cache_dir=work_dir)
+
+    return {
+        "series": series_path,
+        "image": image_path,
+        "mask_path": work_dir / "mask.nii.gz",
+        "events_tsv": work_dir / "events.tsv",
+        "confounds": confounds_path,
+        "onsets": onsets,
+        "irf": amplitudes[:, numpy.newaxis] * (basis(basis.grid(repetition_time)) @ response),
+    }
+
+def run_3ddeconvolve(work_dir: Path, inputs: Dict, basis: str) -> Path:
+    """
+    Fits the same model with 3dDeconvolve and returns the path to its IRF.
+    """
+    numpy.savetxt(work_dir / "onsets.1D", inputs["onsets"][numpy.newaxis], fmt="%g")
+    command = f"""
+        3dDeconvolve
+        -input {inputs['image']}
+        -mask {inputs['mask_path']}
+        -polort A
+        -fout
+        -bucket afni_bucket
+        -ortvec {inputs['confounds']} confounds
+        -num_stimts 1
+        -stim_times 1 onsets.1D {basis}
+        -stim_label 1 all
+        -iresp 1 afni_IRF
+    """.split()
+    subprocess.run(command, cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+
+    return work_dir / "afni_IRF+orig.HEAD"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check glm.py against a synthetic dataset and 3dDeconvolve.")
+    parser.add_argument("--basis", default="CSPLINzero(0,18,10)", help="Response basis.")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Largest IRF error allowed, as a fraction of the peak response.")
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args.basis, args.tolerance) else 1)
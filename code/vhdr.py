@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Class to organize and extract data from a .vhdr file.
+"""
+
+from pathlib import Path
+import numpy
+import re
+from dataclasses import dataclass
+from os import PathLike
+from functools import cached_property
+from typing import Dict
+
+# Numpy types of the binary formats BrainVision can write. Data is always little-endian.
+BINARY_FORMATS = {
+    "INT_16": numpy.dtype("<i2"),
+    "UINT_16": numpy.dtype("<u2"),
+    "INT_32": numpy.dtype("<i4"),
+    "IEEE_FLOAT_32": numpy.dtype("<f4"),
+}
+
+# Python encodings of the code pages a BrainVision header or marker file can declare. Files without a Codepage line
+# predate it and are ANSI. Latin-1 decodes any byte, so a stray Windows-1252 character can't stop us reading a header.
+CODEPAGES = {
+    "UTF-8": "utf-8",
+    "ANSI": "latin-1",
+}
+
+# Layout of one channel entry. Each entry looks like Ch<number>=<name>,<reference>,<resolution>,<unit>
+CHANNEL_DTYPE = numpy.dtype([
+    ("name", "U32"),
+    ("reference", "U32"),
+    ("resolution", numpy.float64),
+    ("unit", "U8"),
+])
+
+@dataclass
+class Vhdr():
+    """
+    Class to organize and extract data from a .vhdr file.
+
+    Parameters
+    ----------
+    input_path : str or Path
+        Path to a .vhdr file.
+
+    Attributes
+    ----------
+    path : Path
+        Path to a .vhdr file.
+    sections : dict
+        Every key and value of the header, grouped by section.
+    channels : ndarray
+        Structured array containing one row per channel. Fields are described by CHANNEL_DTYPE.
+    """
+    path: PathLike
+
+    def __post_init__(self):
+        self.path = Path(self.path).absolute()
+
+    @cached_property
+    def sections(self) -> Dict[str, Dict[str, str]]:
+        """
+        Reads the .vhdr file and returns each of its sections as a dict of keys and values.
+
+        Comments and lines outside of any section are skipped.
+        """
+        sections = {}
+        section = None
+        with self.path.open(encoding=text_encoding(self.path)) as vhdr_file:
+            for line in vhdr_file:
+                line = line.strip()
+                if line.startswith("[") and line.endswith("]"):
+                    section = sections.setdefault(line[1:-1], {})
+                elif section is not None and "=" in line and not line.startswith(";"):
+                    key, _, value = line.partition("=")
+                    section[key.strip()] = value.strip()
+
+        return sections
+
+    @cached_property
+    def data_path(self) -> Path:
+        """
+        Returns the path to the .eeg file described by the header.
+
+        Falls back to the .eeg file next to the header with the same name, which is where BIDS puts it after renaming.
+        """
+        return self._sibling(self.sections["Common Infos"]["DataFile"], ".eeg")
+
+    @cached_property
+    def marker_path(self) -> Path:
+        """
+        Returns the path to the .vmrk file described by the header.
+
+        Falls back to the .vmrk file next to the header with the same name, which is where BIDS puts it after renaming.
+        """
+        return self._sibling(self.sections["Common Infos"]["MarkerFile"], ".vmrk")
+
+    @cached_property
+    def data_format(self) -> str:
+        """
+        Returns the format of the .eeg file. Usually BINARY.
+        """
+        return self.sections["Common Infos"].get("DataFormat", "BINARY").upper()
+
+    @cached_property
+    def orientation(self) -> str:
+        """
+        Returns MULTIPLEXED if the samples of all channels are interleaved or VECTORIZED if each channel is stored in one piece.
+        """
+        return self.sections["Common Infos"].get("DataOrientation", "MULTIPLEXED").upper()
+
+    @cached_property
+    def channel_count(self) -> int:
+        """
+        Returns the number of channels recorded.
+        """
+        return int(self.sections["Common Infos"]["NumberOfChannels"])
+
+    @cached_property
+    def sampling_interval(self) -> float:
+        """
+        Returns the time between two samples in microseconds.
+        """
+        return float(self.sections["Common Infos"]["SamplingInterval"])
+
+    @cached_property
+    def sampling_rate(self) -> float:
+        """
+        Returns the number of samples per second.
+        """
+        return 1e6 / self.sampling_interval
+
+    @cached_property
+    def binary_format(self) -> numpy.dtype:
+        """
+        Returns the numpy type of each value in the .eeg file.
+        """
+        if self.data_format != "BINARY":
+            raise ValueError(f"{self.path} describes {self.data_format} data. Only BINARY data is supported.")
+
+        binary_format = self.sections.get("Binary Infos", {}).get("BinaryFormat", "INT_16").upper()
+        try:
+            return BINARY_FORMATS[binary_format]
+        except KeyError:
+            raise ValueError(f"{self.path} uses unsupported binary format {binary_format}")
+
+    @cached_property
+    def channels(self) -> numpy.ndarray:
+        """
+        Returns the name, reference, resolution and unit of each channel in the order they're stored.
+
+        A missing resolution means 1.
+        """
+        channel_infos = self.sections["Channel Infos"]
+        channels = numpy.zeros(self.channel_count, dtype=CHANNEL_DTYPE)
+        for i in range(self.channel_count):
+            fields = channel_infos[f"Ch{i + 1}"].split(",") + ["", "", "", ""]
+            channels[i] = (fields[0].replace(r"\1", ","), fields[1], float(fields[2] or 1), fields[3])
+
+        return channels
+
+    def _sibling(self, name: str, suffix: str) -> Path:
+        """
+        Returns the file the header names if it exists. Otherwise returns the file next to the header with the given suffix.
+        """
+        named_path = self.path.parent / name
+        if named_path.exists():
+            return named_path
+        return self.path.with_suffix(suffix)
+
+def text_encoding(path: PathLike) -> str:
+    """
+    Returns the Python encoding of a BrainVision .vhdr or .vmrk file, read from its Codepage line.
+
+    Raises ValueError for a code page missing from CODEPAGES.
+    """
+    with open(path, "rb") as text_file:
+        match = re.search(rb"^Codepage=(\S+)", text_file.read(4096), flags=re.MULTILINE)
+    codepage = match.group(1).decode("ascii").upper() if match else "ANSI"
+    if codepage not in CODEPAGES:
+        raise ValueError(f"{path} declares Codepage={codepage}, which we can't read. Known code pages are {', '.join(CODEPAGES)}.")
+
+    return CODEPAGES[codepage]
+
+def write_vhdr(path: PathLike, data_file: str, marker_file: str, channels: numpy.ndarray, sampling_interval: float, binary_format: str="IEEE_FLOAT_32", orientation: str="MULTIPLEXED") -> Path:
+    """
+    Writes a .vhdr file describing a binary .eeg file.
+
+    Parameters
+    ----------
+    path : str or Path
+        Where to write the header.
+    data_file : str
+        Name of the .eeg file, relative to the header.
+    marker_file : str
+        Name of the .vmrk file, relative to the header.
+    channels : ndarray
+        Structured array with the fields of CHANNEL_DTYPE.
+    sampling_interval : float
+        Time between two samples in microseconds.
+    binary_format : str
+        One of the keys of BINARY_FORMATS.
+    orientation : str
+        MULTIPLEXED or VECTORIZED.
+    """
+    path = Path(path)
+    channel_lines = []
+    for i, channel in enumerate(channels):
+        name = channel["name"].replace(",", r"\1")
+        channel_lines.append(f"Ch{i + 1}={name},{channel['reference']},{channel['resolution']:g},{channel['unit']}")
+    lines = [
+        "Brain Vision Data Exchange Header File Version 1.0",
+        "",
+        "[Common Infos]",
+        "Codepage=UTF-8",
+        f"DataFile={data_file}",
+        f"MarkerFile={marker_file}",
+        "DataFormat=BINARY",
+        f"DataOrientation={orientation}",
+        f"NumberOfChannels={len(channels)}",
+        "; Sampling interval in microseconds",
+        f"SamplingInterval={sampling_interval:g}",
+        "",
+        "[Binary Infos]",
+        f"BinaryFormat={binary_format}",
+        "",
+        "[Channel Infos]",
+        "; Each entry: Ch<Channel number>=<Name>,<Reference channel name>,<Resolution in \"Unit\">,<Unit>",
+        *channel_lines,
+    ]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    return path
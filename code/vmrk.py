@@ -7,12 +7,38 @@ Last updated 5/20/2021 by Ben Velie.
 """
 
 from pathlib import Path
+import numpy
 import pandas
 import re
 from dataclasses import dataclass
 from os import PathLike
 from functools import cached_property
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from vhdr import Vhdr, text_encoding
+
+# Layout of one marker line. Each entry looks like Mk<number>=<type>,<description>,<position>,<size>,<channel>[,<date>]
+MARKER_DTYPE = numpy.dtype([
+    ("number", numpy.int32),
+    ("type", "U16"),
+    ("description", "U32"),
+    ("position", numpy.int64),
+    ("size", numpy.int32),
+    ("channel", numpy.int16),
+    ("special", "U32"),
+])
+
+# Column names of Vmrk.dataframe when the header doesn't name one column per field of MARKER_DTYPE. These are the names
+# BrainVision Recorder writes into the comments of its headers.
+DEFAULT_COLUMN_NAMES = [
+    "Marker number",
+    "Type",
+    "Description",
+    "Position in data points",
+    "Size in data points",
+    "Channel number (0 = marker is related to all channels)",
+    "Special",
+]
 
 @dataclass
 class Vmrk():
@@ -28,6 +54,8 @@ class Vmrk():
     ----------
     path : Path
         Path to a .vmrk file.
+    markers : ndarray
+        Structured array containing one row per marker of the .vmrk file. Fields are described by MARKER_DTYPE.
     dataframe : DataFrame
         DataFrame containing the values of the body of the .vmrk file.
     """
@@ -38,49 +66,85 @@ class Vmrk():
     def __post_init__(self):
         self.path = Path(self.path).absolute()
 
+    @cached_property
+    def markers(self) -> numpy.ndarray:
+        """
+        Returns every marker in the .vmrk file as a structured array.
+        """
+        return self._parsed[1]
+
     @cached_property
     def dataframe(self) -> pandas.DataFrame:
         """
-        Reads the .vmrk file and returns it as a fresh, clean DataFrame.
+        Returns the markers of the .vmrk file as a typed DataFrame.
 
-        Columns are numbered in order. Rows are also numbered in order.
+        Columns hold the fields of MARKER_DTYPE and are named by column_names. Rows are numbered in order.
         """
+        return pandas.DataFrame(self.markers).set_axis(self.column_names, axis=1)
 
-        # Format our data into a clean list of lists.
-        line_list = [line.replace("Mk", "") for line in self.body_string.splitlines()]
-        split_line_list = [re.split(pattern="[,=]", string=line) for line in line_list]
+    @cached_property
+    def onsets(self) -> List:
+        """
+        Returns a list of onsets from the .vmrk file converted to seconds and adjusted to start time.
+        """
+        return self.onsets_for([self.ONSET_CODE]).tolist()
 
-        # From the list of lists birth a glorious DataFrame with column names extracted from the header.
-        dataframe = pandas.DataFrame(split_line_list, columns=self.column_names)
+    @cached_property
+    def sampling_rate(self) -> float:
+        """
+        Returns the number of samples per second of the recording the markers belong to.
 
-        return dataframe
+        Read from the .vhdr file next to the .vmrk file, or else from a SamplingInterval line in the .vmrk file itself
+        like the ones write_vmrk adds. Raises LookupError if neither is there.
+        """
+        vhdr_path = self.path.with_suffix(".vhdr")
+        if vhdr_path.exists():
+            return Vhdr(vhdr_path).sampling_rate
+
+        match = re.search(r"^SamplingInterval=(\S+)", self.header_string, flags=re.MULTILINE)
+        if match is None:
+            raise LookupError(f"Can't tell the sampling rate of {self.path}: there's no {vhdr_path.name} next to it and it has no SamplingInterval line.")
+        return 1e6 / float(match.group(1))
 
     @cached_property
-    def onsets(self) -> List:
+    def volume_positions(self) -> numpy.ndarray:
         """
-        Returns a list of onsets from the .vmrk file converted to seconds and adjusted to start time.
+        Returns the raw position of every fMRI volume marker. This is the train of R128 markers the scanner sends each TR.
         """
+        return self.positions_for([self.FMRI_CODE])
 
-        # Raw onsets stores our onsets unadjusted for start time or converted to seconds
-        raw_onsets = []
-        for i, code in enumerate(self.dataframe["Description"]):
-            if code == self.ONSET_CODE:
-                raw_onsets.append(float(self.dataframe["Position in data points"][i]))
+    def positions_for(self, codes: Iterable[str]) -> numpy.ndarray:
+        """
+        Returns the raw positions of all markers whose description matches any of the codes, in file order.
+        """
+        mask = numpy.isin(self.markers["description"], list(codes))
+        return self.markers["position"][mask]
 
-        return [self._converted_to_seconds_and_adjusted_to_start_time(timing) for timing in raw_onsets]
+    def descriptions_for(self, codes: Iterable[str]) -> numpy.ndarray:
+        """
+        Returns the descriptions of all markers whose description matches any of the codes, in file order.
+        """
+        mask = numpy.isin(self.markers["description"], list(codes))
+        return self.markers["description"][mask]
+
+    def onsets_for(self, codes: Iterable[str]) -> numpy.ndarray:
+        """
+        Returns the onsets of all markers matching any of the codes, converted to seconds and adjusted to start time.
+        """
+        return self.seconds_from_start(self.positions_for(codes))
 
     @cached_property
     def raw_start_time(self) -> float:
         """
         Returns the raw time at which the fMRI began scanning.
         """
-
-        for i, code in enumerate(self.dataframe["Description"]):
-            if code == self.FMRI_CODE:
-                return float(self.dataframe["Position in data points"][i])
+        matches = numpy.flatnonzero(self.markers["description"] == self.FMRI_CODE)
 
         # Raise an error if we can't find the start time.
-        raise LookupError("No fMRI start signal found.")
+        if matches.size == 0:
+            raise LookupError("No fMRI start signal found.")
+
+        return float(self.markers["position"][matches[0]])
 
     @cached_property
     def header_string(self) -> str:
@@ -88,10 +152,7 @@ class Vmrk():
         Returns the header of the vmrk file as a nice, big string.
 
         """
-
-        line_list = self.path.read_text().splitlines()
-        header_lines = [line for line in line_list if not re.search(pattern="Mk[0-9]+=", string=line)]
-        return "\n".join(header_lines)
+        return self._parsed[0]
 
     @cached_property
     def body_string(self) -> str:
@@ -99,10 +160,8 @@ class Vmrk():
         Returns the body of the vmrk file as a nice, big string without the header.
 
         """
-
-        line_list = self.path.read_text().splitlines()
-        body_lines = [line for line in line_list if re.search(pattern=r"Mk[0-9]+=", string=line)]
-        return "\n".join(body_lines)
+        with self.path.open(encoding=text_encoding(self.path)) as vmrk_file:
+            return "\n".join(line.rstrip("\r\n") for line in vmrk_file if _is_marker_line(line))
 
     @cached_property
     def column_names(self) -> list:
@@ -110,10 +169,11 @@ class Vmrk():
         Returns the name of each column in the .vmrk file as defined in the header.
 
         Includes one extra column named "Special" that catches any dangling bits of data appended to the end
-        of the .vmrk lines.
+        of the .vmrk lines, like the date of a new segment. Falls back to DEFAULT_COLUMN_NAMES if the header doesn't
+        name every field.
         """
-
-        return re.findall(pattern=r"(?<=\<).+?(?=\>)", string=self.header_string) + ["Special"]
+        names = re.findall(pattern=r"(?<=\<).+?(?=\>)", string=self.header_string) + ["Special"]
+        return names if len(names) == len(MARKER_DTYPE) else DEFAULT_COLUMN_NAMES
 
     def write_onsets_to(self, path: PathLike, add_to_onsets: float=0):
         """
@@ -129,13 +189,88 @@ class Vmrk():
         with output_path.open(mode='w') as txt_file:
             txt_file.writelines((f"{onset + add_to_onsets}\n" for onset in self.onsets))
 
-    def _converted_to_seconds_and_adjusted_to_start_time(self, timing):
+    @cached_property
+    def _parsed(self) -> Tuple[str, numpy.ndarray]:
+        """
+        Reads the .vmrk file in a single pass. Returns its header as a string and its markers as a structured array.
+
+        Marker lines are streamed straight into the array. Every other line is kept as part of the header.
+        """
+        header_lines = []
+
+        def marker_rows(vmrk_file) -> Iterator[Tuple]:
+            for line_number, line in enumerate(vmrk_file, start=1):
+                line = line.rstrip("\r\n")
+                if not _is_marker_line(line):
+                    header_lines.append(line)
+                    continue
+                key, _, values = line.partition("=")
+                fields = values.split(",")
+                try:
+                    yield (
+                        int(key[2:]),
+                        fields[0],
+                        fields[1],
+                        int(fields[2] or 0),
+                        int(fields[3] or 0),
+                        int(fields[4] or 0),
+                        ",".join(fields[5:]),
+                    )
+                except (IndexError, ValueError):
+                    raise ValueError(f"{self.path}, line {line_number}: expected Mk<number>=<type>,<description>,<position>,<size>,<channel> but found {line!r}") from None
+
+        with self.path.open(encoding=text_encoding(self.path)) as vmrk_file:
+            markers = numpy.fromiter(marker_rows(vmrk_file), dtype=MARKER_DTYPE)
+
+        return "\n".join(header_lines), markers
+
+    def seconds_from_start(self, timing):
         """
-        Converts a timing value into seconds and adjusts it to the start time.
+        Converts a raw position into seconds and adjusts it to the start time.
 
-        Each raw time is divided by 5000 to convert it to seconds. Also, the time list is adjusted to the
-        time the fMRI began scanning.
+        Each raw time is divided by the sampling rate to convert it to seconds. Also, the time list is adjusted to the
+        time the fMRI began scanning. Works on single values and on whole arrays of values.
         """
-        
-        raw_time = (timing - self.raw_start_time) / 5000
-        return (round(raw_time, 4))
+
+        raw_time = (numpy.asarray(timing, dtype=numpy.float64) - self.raw_start_time) / self.sampling_rate
+        return numpy.round(raw_time, 4)
+
+def _is_marker_line(line: str) -> bool:
+    """
+    Returns true if a line of a .vmrk file is a marker entry such as "Mk12=Stimulus,S  2,1234,1,0".
+    """
+    key, equals, _ = line.partition("=")
+    return bool(equals) and key.startswith("Mk") and key[2:].isdigit()
+
+def write_vmrk(path: PathLike, markers: numpy.ndarray, data_file: str, sampling_interval: Optional[float]=None) -> Path:
+    """
+    Writes markers into a new .vmrk file that points to data_file.
+
+    Parameters
+    ----------
+    path : str or Path
+        Where to write the .vmrk file.
+    markers : ndarray
+        Structured array with the fields of MARKER_DTYPE.
+    data_file : str
+        Name of the .eeg file the markers belong to, relative to the .vmrk file.
+    sampling_interval : float, optional
+        Microseconds between two samples of data_file. Recorded in the header for data files without a .vhdr.
+    """
+    path = Path(path)
+    lines = [
+        "Brain Vision Data Exchange Marker File, Version 1.0",
+        "",
+        "[Common Infos]",
+        "Codepage=UTF-8",
+        f"DataFile={data_file}",
+        *(["; Sampling interval in microseconds", f"SamplingInterval={sampling_interval:g}"] if sampling_interval is not None else []),
+        "",
+        "[Marker Infos]",
+        "; Each entry: Mk<Marker number>=<Type>,<Description>,<Position in data points>,",
+        "; <Size in data points>, <Channel number (0 = marker is related to all channels)>",
+        *(f"Mk{marker['number']}={marker['type']},{marker['description']},{marker['position']},{marker['size']},{marker['channel']}" + (f",{marker['special']}" if marker["special"] else "") for marker in markers),
+    ]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    return path
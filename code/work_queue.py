@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Spread our doit tasks across several machines that share a filesystem, using nothing but that filesystem.
+
+The queue is a directory with one small JSON file per task, moved between pending/, claimed/, done/ and failed/. A
+worker claims a task by renaming its file into claimed/ under its own name. Renames are atomic, even over NFS, so
+only one worker wins each task. While a task runs, its worker touches the claim every HEARTBEAT_SECONDS. Any worker
+that finds a claim untouched for longer than STALE_SECONDS returns it to pending/, so the tasks of a crashed node get
+picked up again. A task is only claimed once every task it depends on is done, and the longest ones go first.
+
+"fill" loads the doit task graph of dodo.py into the queue. "work" starts workers. Start several on one machine to try
+the queue out locally:
+
+    python work_queue.py fill
+    python work_queue.py work --workers 4
+    python work_queue.py status
+
+Workers run each task with "doit run --single", each keeping its own doit database in the queue for as long as it runs,
+since doit's database can't be shared between machines or even between processes. The queue is what records which
+tasks are done across the cluster.
+"""
+# Import external libraries and modules.
+from dataclasses import dataclass
+from os import PathLike
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+
+# Import CSEA libraries and modules.
+from history import History, pending_tasks, stage_of
+
+CODE_DIR = Path(__file__).resolve().parent
+QUEUE_DIR = CODE_DIR.parent / "outputs" / "queue"
+STATES = ("pending", "claimed", "done", "failed")
+
+# Seconds between heartbeats of a running task, and after which a claim without one counts as abandoned.
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 300
+
+# Seconds an idle worker waits before looking for work again.
+POLL_SECONDS = 10
+
+@dataclass
+class WorkQueue():
+    """
+    Class to queue tasks in a directory on a shared filesystem and hand them out to workers.
+
+    Parameters
+    ----------
+    queue_dir : str or Path
+        Directory of the queue. Every worker must see the same directory.
+    stale_seconds : float
+        Seconds after its last heartbeat that a claim gets returned to the queue.
+    """
+    queue_dir: PathLike = QUEUE_DIR
+    stale_seconds: float = STALE_SECONDS
+
+    def __post_init__(self):
+        self.queue_dir = Path(self.queue_dir)
+        for directory in (*STATES, "tmp", "logs"):
+            (self.queue_dir / directory).mkdir(parents=True, exist_ok=True)
+
+    def put(self, name: str, command: List[str], cwd: PathLike=CODE_DIR, dependencies: Iterable[str]=(), predicted_seconds: float=0.0) -> bool:
+        """
+        Adds a task to the queue. Returns false if a task with the same name is already queued, running or finished.
+
+        Parameters
+        ----------
+        name : str
+            Name of the task.
+        command : list of str
+            Command that runs the task.
+        cwd : str or Path
+            Directory to run the command in.
+        dependencies : list of str
+            Names of the tasks that must be done before this one starts.
+        predicted_seconds : float
+            How long the task is expected to take. Ready tasks are handed out longest first.
+        """
+        if self.state(name):
+            return False
+
+        unit = {"Name": name, "Command": list(command), "Cwd": str(cwd), "Dependencies": sorted(dependencies), "PredictedSeconds": predicted_seconds}
+        self._write(self.queue_dir / "pending" / f"{_slug(name)}.json", unit)
+        return True
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """
+        Claims the longest ready task for worker and returns it, or returns None if no task is ready.
+
+        Returns abandoned claims to the queue first.
+        """
+        self.requeue_stale()
+        done = {path.stem for path in (self.queue_dir / "done").glob("*.json")}
+        ready = []
+        for path in (self.queue_dir / "pending").glob("*.json"):
+            unit = _read(path)
+            if unit and all(_slug(dependency) in done for dependency in unit["Dependencies"]):
+                ready.append(unit)
+
+        for unit in sorted(ready, key=lambda unit: -unit["PredictedSeconds"]):
+            claim_path = self.queue_dir / "claimed" / f"{_slug(unit['Name'])}@{worker}.json"
+            try:
+                os.rename(self.queue_dir / "pending" / f"{_slug(unit['Name'])}.json", claim_path)
+            except FileNotFoundError:
+                # Another worker got there first.
+                continue
+            os.utime(claim_path)
+            return dict(unit, Worker=worker)
+
+        return None
+
+    def heartbeat(self, unit: Dict[str, Any]) -> bool:
+        """
+        Tells the other workers that unit is still running. Returns false if its claim was taken away.
+        """
+        try:
+            os.utime(self._claim_path(unit))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def finish(self, unit: Dict[str, Any], exit_code: int, **fields) -> bool:
+        """
+        Moves a claimed task to done/ if exit_code is 0 or to failed/ otherwise, recording fields along with it.
+
+        Returns false if the claim was taken away in the meantime. Then the task stays wherever it is now.
+        """
+        path = self.queue_dir / ("done" if exit_code == 0 else "failed") / f"{_slug(unit['Name'])}.json"
+        try:
+            os.rename(self._claim_path(unit), path)
+        except FileNotFoundError:
+            return False
+
+        self._write(path, dict(unit, ExitCode=exit_code, Finished=time.time(), **fields))
+        return True
+
+    def requeue_stale(self) -> List[str]:
+        """
+        Returns every claim without a heartbeat for stale_seconds to pending/. Returns the names of those tasks.
+        """
+        now = self._now()
+        requeued = []
+        for claim_path in (self.queue_dir / "claimed").glob("*.json"):
+            pending_path = self.queue_dir / "pending" / f"{claim_path.stem.rpartition('@')[0]}.json"
+            try:
+                if now - claim_path.stat().st_mtime < self.stale_seconds:
+                    continue
+                os.rename(claim_path, pending_path)
+            except FileNotFoundError:
+                # The task just finished, or another worker requeued it.
+                continue
+            requeued.append((_read(pending_path) or {"Name": pending_path.stem})["Name"])
+
+        return requeued
+
+    def requeue_failed(self) -> List[str]:
+        """
+        Returns every failed task to pending/. Returns the names of those tasks.
+        """
+        requeued = []
+        for path in (self.queue_dir / "failed").glob("*.json"):
+            unit = _read(path)
+            unit = {key: unit[key] for key in ("Name", "Command", "Cwd", "Dependencies", "PredictedSeconds")}
+            self._write(self.queue_dir / "pending" / path.name, unit)
+            path.unlink()
+            requeued.append(unit["Name"])
+
+        return requeued
+
+    def state(self, name: str) -> Optional[str]:
+        """
+        Returns which of STATES a task is in, or None if it isn't in the queue.
+        """
+        slug = _slug(name)
+        for state in STATES:
+            pattern = f"{slug}@*.json" if state == "claimed" else f"{slug}.json"
+            if any((self.queue_dir / state).glob(pattern)):
+                return state
+
+        return None
+
+    def units(self, state: str) -> List[Dict[str, Any]]:
+        """
+        Returns every task in a state.
+        """
+        units = []
+        for path in sorted((self.queue_dir / state).glob("*.json")):
+            unit = _read(path)
+            if unit:
+                if state == "claimed":
+                    unit.update(Worker=path.stem.rpartition("@")[2], HeartbeatAge=self._now() - path.stat().st_mtime)
+                units.append(unit)
+
+        return units
+
+    def log_path(self, unit: Dict[str, Any]) -> Path:
+        """
+        Returns where the output of a task goes.
+        """
+        return self.queue_dir / "logs" / f"{_slug(unit['Name'])}.log"
+
+    def db_path(self, worker: str) -> Path:
+        """
+        Returns the doit database of a worker. doit's dbm backends don't lock, so workers must not share one.
+        """
+        return self.queue_dir / f"doit-{_slug(worker)}.db"
+
+    def _claim_path(self, unit: Dict[str, Any]) -> Path:
+        return self.queue_dir / "claimed" / f"{_slug(unit['Name'])}@{unit['Worker']}.json"
+
+    def _write(self, path: Path, unit: Dict[str, Any]) -> None:
+        """
+        Writes unit to path in one atomic rename, so readers never see half a file.
+        """
+        temp_path = self.queue_dir / "tmp" / f"{path.name}.{socket.gethostname()}.{os.getpid()}"
+        with open(temp_path, "w") as unit_file:
+            json.dump(unit, unit_file, indent="\t")
+        os.replace(temp_path, path)
+
+    def _now(self) -> float:
+        """
+        Returns the time according to the file server, which stamps heartbeats, so clocks of workers needn't agree.
+        """
+        clock_path = self.queue_dir / "tmp" / f"clock.{socket.gethostname()}"
+        clock_path.touch()
+        os.utime(clock_path)
+        return clock_path.stat().st_mtime
+
+def fill_from_doit(queue: WorkQueue, variables: Iterable[str]=(), pending_only: bool=False) -> List[str]:
+    """
+    Loads the tasks of dodo.py into the queue, each depending on the tasks that produce its file dependencies.
+
+    Returns the names of the tasks added.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        Queue to fill.
+    variables : list of str
+        doit command line variables, like "sweep=1". Passed on to the workers too.
+    pending_only : bool
+        Only queue the tasks doit would run right now on this machine.
+    """
+    from doit.doit_cmd import reset_vars, set_var
+    from doit.loader import load_tasks
+
+    reset_vars()
+    for variable in variables:
+        set_var(*variable.split("=", 1))
+    import dodo
+    tasks = load_tasks(vars(dodo))
+
+    names = set(pending_tasks(variables)) if pending_only else {task.name for task in tasks}
+    producers = {os.path.abspath(CODE_DIR / target): task.name for task in tasks for target in task.targets}
+    queued = {task.name for task in tasks if task.name in names or queue.state(task.name)}
+    history = History()
+
+    added = []
+    for task in tasks:
+        if task.name not in names:
+            continue
+        dependencies = {producers.get(os.path.abspath(CODE_DIR / path)) for path in task.file_dep} | set(task.task_dep)
+        command = [sys.executable, "-m", "doit", "run", "--single", "--db-file", str(queue.queue_dir / "doit.db"), *variables, task.name]
+        if queue.put(task.name, command, CODE_DIR, dependencies & queued, history.predicted_seconds(task.name, stage_of(task.name))):
+            added.append(task.name)
+
+    return added
+
+def work(queue: WorkQueue, worker: Optional[str]=None) -> None:
+    """
+    Claims and runs tasks until none are left that could ever become ready.
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    while True:
+        unit = queue.claim(worker)
+        if unit is None:
+            if not queue.units("claimed"):
+                print(f"{worker}: nothing left to run")
+                for db_path in queue.queue_dir.glob(f"{queue.db_path(worker).name}*"):
+                    db_path.unlink()
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+
+        print(f"{worker}: running {unit['Name']}")
+        run_unit(queue, unit)
+
+def run_unit(queue: WorkQueue, unit: Dict[str, Any]) -> Optional[int]:
+    """
+    Runs a claimed task, sending heartbeats while it runs, and files it as done or failed. Returns its exit code.
+
+    Kills the task and returns None if its claim gets taken away, since another worker may be running it by then.
+    A --db-file in the command is pointed at the worker's own doit database.
+    """
+    command = list(unit["Command"])
+    if "--db-file" in command:
+        command[command.index("--db-file") + 1] = str(queue.db_path(unit["Worker"]))
+
+    started = time.time()
+    with open(queue.log_path(unit), "a") as log_file:
+        process = subprocess.Popen(command, cwd=unit["Cwd"], stdout=log_file, stderr=subprocess.STDOUT)
+        while True:
+            try:
+                exit_code = process.wait(timeout=HEARTBEAT_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                if not queue.heartbeat(unit):
+                    print(f"{unit['Worker']}: lost the claim on {unit['Name']}, stopping it")
+                    process.kill()
+                    process.wait()
+                    return None
+
+    queue.finish(unit, exit_code, WallSeconds=time.time() - started, Log=str(queue.log_path(unit)))
+    return exit_code
+
+def status(queue: WorkQueue) -> str:
+    """
+    Returns a summary of the queue: how many tasks are in each state, which are running where, and which failed.
+    """
+    done = {_slug(unit["Name"]) for unit in queue.units("done")}
+    pending = queue.units("pending")
+    ready = [unit for unit in pending if all(_slug(dependency) in done for dependency in unit["Dependencies"])]
+
+    lines = [f"{state}: {len(queue.units(state))}" for state in STATES]
+    lines.insert(1, f"  ready: {len(ready)}, waiting on dependencies: {len(pending) - len(ready)}")
+    lines += [f"running {unit['Name']} on {unit['Worker']}, last heartbeat {unit['HeartbeatAge']:.0f} s ago" for unit in queue.units("claimed")]
+    lines += [f"failed {unit['Name']} with exit code {unit['ExitCode']}, see {unit['Log']}" for unit in queue.units("failed")]
+    return "\n".join(lines)
+
+def _slug(name: str) -> str:
+    """
+    Returns a task name as a file name.
+    """
+    return re.sub(r"[^\w.-]+", "_", name)
+
+def _read(path: Path) -> Optional[Dict[str, Any]]:
+    """
+    Returns the task in a queue file, or None if the file moved before it could be read.
+    """
+    try:
+        with open(path) as unit_file:
+            return json.load(unit_file)
+    except FileNotFoundError:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run our doit tasks on every machine that shares the queue directory.")
+    parser.add_argument("command", choices=["fill", "work", "status", "requeue"], help="fill: queue the tasks of dodo.py. work: run queued tasks. status: summarize the queue. requeue: return abandoned, and with --failed failed, tasks to the queue.")
+    parser.add_argument("variables", nargs="*", help="doit variables for fill, like sweep=1.")
+    parser.add_argument("--queue-dir", default=str(QUEUE_DIR), help="Directory of the queue. Defaults to ../outputs/queue.")
+    parser.add_argument("--pending", action="store_true", help="fill: only queue the tasks doit would run right now.")
+    parser.add_argument("--workers", type=int, default=1, help="work: how many workers to start on this machine.")
+    parser.add_argument("--failed", action="store_true", help="requeue: also requeue failed tasks.")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue_dir)
+    if args.command == "fill":
+        added = fill_from_doit(queue, args.variables, args.pending)
+        print(f"Queued {len(added)} tasks in {queue.queue_dir}")
+    elif args.command == "work":
+        workers = [multiprocessing.Process(target=work, args=(queue,)) for _ in range(args.workers)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+    elif args.command == "status":
+        print(status(queue))
+    else:
+        requeued = queue.requeue_stale() + (queue.requeue_failed() if args.failed else [])
+        print(f"Requeued {len(requeued)} tasks: {', '.join(requeued)}")